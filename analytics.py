@@ -0,0 +1,157 @@
+'''
+Aggregate reports over pictures and statuses: popular tags, tags used together, and how many
+statuses users post.
+
+Tag counts are kept in memory and brought up to date from the changelog, so a refresh after a few
+new pictures reads those few changes rather than every picture's tags. The first refresh, and any
+refresh whose changelog position retention has removed, rebuilds the counts from the table.
+Statuses per user is a GROUP BY over the trigger-maintained user summaries.
+Both are cached on the table versions, so reports on unchanged tables do no work at all.
+
+Print the reports with: python analytics.py [limit]
+'''
+import sys
+import json
+import threading
+from collections import Counter
+from itertools import combinations
+
+from loguru import logger
+
+import changelog
+from socialnetwork_model import db, table_versions
+
+TOP_TAGS = 10
+
+
+def picture_tags(tags):
+    '''The distinct tags in a picture's tags string, sorted so pairs are always (lower, higher)'''
+    return tuple(sorted({sys.intern(tag) for tag in (tags or '').split()}))
+
+
+class TagStats:
+    '''Pictures per tag and per pair of tags, maintained incrementally from the changelog'''
+
+    def __init__(self):
+        self.tags = Counter()
+        self.pairs = Counter()
+        # Each picture's tags, so an update or delete knows what to take away
+        self.pictures = {}
+        self.position = None
+        self.version = None
+        self._lock = threading.Lock()
+
+    def _add(self, picture_id, tags):
+        self.pictures[picture_id] = tags
+        self.tags.update(tags)
+        self.pairs.update(combinations(tags, 2))
+
+    def _remove(self, picture_id):
+        tags = self.pictures.pop(picture_id, ())
+        self.tags.subtract(tags)
+        self.pairs.subtract(combinations(tags, 2))
+
+    def rebuild(self):
+        '''Recounts every picture's tags. Returns how many pictures were read'''
+        self.tags, self.pairs, self.pictures = Counter(), Counter(), {}
+        # One read transaction, so the changelog position matches the rows read
+        with db.atomic():
+            self.position = changelog.latest_seq()
+            for picture_id, tags in db.execute_sql('SELECT picture_id, tags FROM picturetable'):
+                self._add(picture_id, picture_tags(tags))
+        logger.info(f'Rebuilt tag stats from {len(self.pictures)} pictures')
+        return len(self.pictures)
+
+    def apply(self, change):
+        '''Folds one changelog entry into the counts'''
+        if change['table'] != 'picturetable':
+            return
+        self._remove(change['key'])
+        if change['operation'] != 'delete':
+            self._add(change['key'], picture_tags(change['data']['tags']))
+
+    def refresh(self):
+        '''Brings the counts up to date. Returns how many changes were applied, or None after a rebuild'''
+        with self._lock:
+            version = table_versions().get('picturetable')
+            if version == self.version:
+                return 0
+            if self.position is None:
+                self.rebuild()
+                self.version = version
+                return None
+            applied = 0
+            try:
+                for changes in changelog.iter_changes(self.position):
+                    for change in changes:
+                        self.apply(change)
+                    self.position = changes[-1]['seq']
+                    applied += len(changes)
+            except changelog.ChangesTruncated:
+                logger.warning('Tag stats fell behind changelog retention; rebuilding')
+                self.rebuild()
+                self.version = version
+                return None
+            # Subtracting leaves zero counts behind; drop them so most_common stays small
+            self.tags += Counter()
+            self.pairs += Counter()
+            self.version = version
+            return applied
+
+    def top_tags(self, limit=TOP_TAGS):
+        '''The limit tags on the most pictures, as [{'tag', 'pictures'}]'''
+        self.refresh()
+        # Another request's refresh updates the counters in place, so read them under the lock
+        with self._lock:
+            return [{'tag': tag, 'pictures': count} for tag, count in self.tags.most_common(limit)]
+
+    def tag_pairs(self, limit=TOP_TAGS, tag=None):
+        '''The limit pairs of tags most often on the same picture, or only the pairs including tag'''
+        self.refresh()
+        with self._lock:
+            pairs = self.pairs.items() if tag is None else ((pair, count) for pair, count in self.pairs.items()
+                                                            if tag in pair)
+            top = sorted(pairs, key=lambda item: (-item[1], item[0]))[:limit]
+        return [{'tags': list(pair), 'pictures': count} for pair, count in top]
+
+
+TAG_STATS = TagStats()
+_STATUS_CACHE = {}
+
+
+def statuses_per_user():
+    '''
+    How many users have posted each number of statuses, with the mean, median, 90th percentile and
+    maximum statuses per user. Cached until statuses or users change.
+    '''
+    versions = table_versions()
+    version = (versions.get('usertable'), versions.get('statustable'))
+    if _STATUS_CACHE.get('version') == version:
+        return _STATUS_CACHE['report']
+    histogram = db.execute_sql('SELECT status_count, COUNT(*) FROM usersummarytable '
+                               'GROUP BY status_count ORDER BY status_count').fetchall()
+    users = sum(count for _, count in histogram)
+    statuses = sum(level * count for level, count in histogram)
+
+    def percentile(fraction):
+        '''Statuses of the user at fraction of the way up the sorted users'''
+        rank, seen = fraction * (users - 1), 0
+        for level, count in histogram:
+            seen += count
+            if seen > rank:
+                return level
+        return None
+
+    report = {'users': users, 'statuses': statuses,
+              'mean': statuses / users if users else None,
+              'median': percentile(0.5), 'p90': percentile(0.9),
+              'max': histogram[-1][0] if histogram else None,
+              'distribution': [{'statuses': level, 'users': count} for level, count in histogram]}
+    _STATUS_CACHE.update(version=version, report=report)
+    return report
+
+
+if __name__ == '__main__':
+    report_size = int(sys.argv[1]) if len(sys.argv) > 1 else TOP_TAGS
+    print(json.dumps({'top_tags': TAG_STATS.top_tags(report_size), 'tag_pairs': TAG_STATS.tag_pairs(report_size),
+                      'statuses_per_user': statuses_per_user()}, indent=2))
@@ -1,11 +1,40 @@
+import os
+import math
+import gzip
+import json
+import sqlite3
+import time
+import threading
+from functools import wraps
+from collections import defaultdict
+from itertools import islice
 from pathlib import Path
 
-from flask import Flask, jsonify
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_restful import Api, Resource
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, select
 from sqlalchemy.exc import IntegrityError
+from loguru import logger
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library encoder is the fallback
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # zstd is only offered when zstandard is installed
+    zstandard = None
 
 import main
+import users
+import user_status
+import tag_index
+import jobs
+import changelog
+import events
+import analytics
 
 app = Flask(__name__, instance_path=str(Path(".").absolute()))
 app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///social_network.db"
@@ -57,34 +86,703 @@ class PictureRecord(db.Model):
             'tags': self.tags
         }
 
+class VersionRecord(db.Model):
+
+    __tablename__ = "tableversiontable"
+    table_name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer)
+
+class SummaryRecord(db.Model):
+
+    __tablename__ = "usersummarytable"
+    user_id = db.Column(db.String, primary_key=True)
+    status_count = db.Column(db.Integer)
+    picture_count = db.Column(db.Integer)
+    last_activity = db.Column(db.String)
+
+    def serialize(self):
+        return {
+            'user_id': self.user_id,
+            'status_count': self.status_count,
+            'picture_count': self.picture_count,
+            'last_activity': self.last_activity
+        }
+
+def dumps(data):
+    '''Encodes data as compact JSON bytes, with orjson when it is installed'''
+    if orjson is not None:
+        return orjson.dumps(data)  # pylint: disable=E1101
+    return json.dumps(data, separators=(',', ':')).encode()
+
+# Read snapshot: when enabled, reads come from a copy of the database taken with the SQLite online
+# backup API, so they never wait on a writer. SNAPSHOT_REFRESH is 'interval' (refresh every
+# SNAPSHOT_INTERVAL seconds) or 'on_change' (check the table versions every SNAPSHOT_INTERVAL
+# seconds and refresh only after a commit changed them).
+SNAPSHOT_PATH = os.environ.get('API_SNAPSHOT_PATH')
+SNAPSHOT_REFRESH = os.environ.get('API_SNAPSHOT_REFRESH', 'on_change')
+SNAPSHOT_INTERVAL = float(os.environ.get('API_SNAPSHOT_INTERVAL', '5'))
+SNAPSHOT_MMAP_SIZE = 256 * 1024 * 1024
+SNAPSHOT = {'engine': None, 'taken_at': None, 'versions': None}
+SNAPSHOT_LOCK = threading.Lock()
+
+def snapshot_engine(path):
+    '''A read-only, immutable, memory-mapped engine over a snapshot file'''
+    engine = create_engine(f"sqlite:///file:{os.path.abspath(path)}?mode=ro&immutable=1&uri=true")
+
+    @event.listens_for(engine, 'connect')
+    def set_mmap(connection, _):
+        connection.execute(f'PRAGMA mmap_size = {SNAPSHOT_MMAP_SIZE}')
+
+    return engine
+
+def refresh_snapshot(path=None):
+    '''Copies the live database to path with the online backup API and swaps readers over to it'''
+    path = path or SNAPSHOT_PATH
+    source = sqlite3.connect(db.engine.url.database)
+    target = sqlite3.connect(f"{path}.tmp")
+    try:
+        source.backup(target)
+        versions = dict(source.execute('SELECT table_name, version FROM tableversiontable').fetchall())
+    finally:
+        target.close()
+        source.close()
+    # Readers still on the old file keep it open; new connections see the new one
+    os.replace(f"{path}.tmp", path)
+    engine = snapshot_engine(path)
+    with SNAPSHOT_LOCK:
+        old = SNAPSHOT['engine']
+        SNAPSHOT.update(engine=engine, taken_at=time.time(), versions=versions)
+    if old is not None:
+        old.dispose()
+    count('snapshot_refreshes')
+    return versions
+
+def disable_snapshot():
+    '''Sends reads back to the live database'''
+    with SNAPSHOT_LOCK:
+        old = SNAPSHOT['engine']
+        SNAPSHOT.update(engine=None, taken_at=None, versions=None)
+    if old is not None:
+        old.dispose()
+
+def start_snapshot_refresher(path=None, refresh=None, interval=None):
+    '''Takes a snapshot now and keeps refreshing it on a daemon thread'''
+    refresh = refresh or SNAPSHOT_REFRESH
+    interval = interval or SNAPSHOT_INTERVAL
+    with app.app_context():
+        refresh_snapshot(path)
+
+    def refresher():
+        with app.app_context():
+            while True:
+                time.sleep(interval)
+                # A failed refresh keeps serving the previous snapshot and is retried next interval
+                try:
+                    if refresh == 'on_change':
+                        with sqlite3.connect(db.engine.url.database) as live:
+                            versions = dict(live.execute('SELECT table_name, version FROM tableversiontable')
+                                            .fetchall())
+                        if versions == SNAPSHOT['versions']:
+                            continue
+                    refresh_snapshot(path)
+                except Exception as error:  # pylint: disable=W0703
+                    count('snapshot_refresh_errors')
+                    logger.exception(f'Snapshot refresh failed: {error}')
+
+    threading.Thread(target=refresher, name='snapshot-refresher', daemon=True).start()
+
+@app.after_request
+def snapshot_age_header(response):
+    '''Tells clients how stale a snapshot-served response may be'''
+    taken_at = g.get('snapshot_taken_at')
+    if taken_at is not None:
+        response.headers['X-Snapshot-Age'] = f"{time.time() - taken_at:.3f}"
+    return response
+
+def snapshot_for_read():
+    '''
+    The snapshot engine to read from, or None for the live database. A snapshot read is noted on
+    the request, with the oldest snapshot it used, so only snapshot-served responses report an age.
+    '''
+    with SNAPSHOT_LOCK:
+        engine, taken_at = SNAPSHOT['engine'], SNAPSHOT['taken_at']
+    if engine is not None:
+        g.setdefault('snapshot_taken_at', taken_at)
+    return engine
+
+def read_rows(statement):
+    '''Runs a select and returns plain row tuples, without building model instances'''
+    engine = snapshot_for_read()
+    if engine is not None:
+        with engine.connect() as connection:
+            return connection.execute(statement).all()
+    return db.session.execute(statement).all()
+
+def select_columns(model):
+    '''A select of every column the model serializes'''
+    return select(*model.__table__.columns)
+
+def read_records(model, statement=None):
+    '''Reads rows of model's table as dicts keyed like model.serialize()'''
+    columns = [column.name for column in model.__table__.columns]
+    return [dict(zip(columns, row)) for row in read_rows(select_columns(model) if statement is None else statement)]
+
+# Multi-get: IN lists are batched under SQLite's bound variable limit, and one request is capped at MAX_IDS
+IDS_BATCH_SIZE = 999
+MAX_IDS = 10000
+
+def read_by_ids(model, key, ids):
+    '''
+    Rows of model whose key column is in ids, in the order the ids were first given,
+    and the ids that matched nothing
+    '''
+    ids = list(dict.fromkeys(ids))
+    found = {}
+    for start in range(0, len(ids), IDS_BATCH_SIZE):
+        statement = select_columns(model).where(key.in_(ids[start:start + IDS_BATCH_SIZE]))
+        found.update((record[key.name], record) for record in read_records(model, statement))
+    return [found[value] for value in ids if value in found], [value for value in ids if value not in found]
+
+def requested_ids():
+    '''IDs from ?ids=a,b,c or a JSON body {"ids": [...]}, or None if neither was sent'''
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        ids = body.get('ids') if isinstance(body, dict) else None
+        return [str(value) for value in ids] if isinstance(ids, list) else None
+    if 'ids' not in request.args:
+        return None
+    return [value for value in request.args['ids'].split(',') if value]
+
+def multi_get(model, key, name):
+    '''Response for a multi-get of model by key, or a 400 when no usable ID list was sent'''
+    ids = requested_ids()
+    if ids is None:
+        return json_response(dumps({'error': 'Send ids as ?ids=a,b,c or a JSON body {"ids": [...]}'}), status=400)
+    if len(ids) > MAX_IDS:
+        return json_response(dumps({'error': f'At most {MAX_IDS} ids per request'}), status=400)
+    found, missing = read_by_ids(model, key, ids)
+    return json_response(dumps({name: found, 'missing': missing}))
+
+def json_response(body, status=200):
+    '''Wraps encoded JSON bytes in a response'''
+    return Response(body, status=status, mimetype='application/json')
+
+# Response compression, best first. Bodies are cached per table version and encoding.
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+COMPRESSORS = {'gzip': lambda body: gzip.compress(body, GZIP_LEVEL)}
+if zstandard is not None:
+    COMPRESSORS = {'zstd': zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress, **COMPRESSORS}
+RESPONSE_CACHE = {}
+METRICS = defaultdict(float)
+METRICS_LOCK = threading.Lock()
+
+def count(metric, amount=1):
+    '''Adds amount to a metric reported at /metrics'''
+    with METRICS_LOCK:
+        METRICS[metric] += amount
+
+def gauge(metric, value):
+    '''Sets a metric reported at /metrics to its current value'''
+    with METRICS_LOCK:
+        METRICS[metric] = value
+
+class RouteLimit:
+    '''
+    Admission control for one route: a token bucket refilled at rate requests/second up to burst,
+    and at most concurrency requests running, with others queued for up to max_wait seconds.
+    '''
+    def __init__(self, concurrency, rate, burst, max_wait):
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.waiting = 0
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def take_token(self):
+        '''Takes a token, returning 0, or the seconds until one is available'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def adjust(self, waiting=0, running=0):
+        '''Tracks queue depth and requests in flight'''
+        with self.lock:
+            self.waiting += waiting
+            self.running += running
+            return self.waiting, self.running
+
+# Limits for routes that walk the filesystem; routes not listed here are not limited
+ROUTE_LIMITS = {
+    'diff': RouteLimit(concurrency=4, rate=10.0, burst=20, max_wait=2.0),
+    'differences': RouteLimit(concurrency=2, rate=1.0, burst=5, max_wait=5.0),
+}
+
+def too_many_requests(route, reason, retry_after):
+    '''A 429 response telling the client when to retry'''
+    count(f'{route}_{reason}')
+    response = json_response(dumps({'error': f'Too many {route} requests, retry later'}), status=429)
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def admission_controlled(route):
+    '''Decorates a Resource method so it runs within ROUTE_LIMITS[route], shedding excess with 429'''
+    def decorator(func):
+        @wraps(func)
+        def limited(*args, **kwargs):
+            limit = ROUTE_LIMITS.get(route)
+            if limit is None:
+                return func(*args, **kwargs)
+            retry_after = limit.take_token()
+            if retry_after:
+                return too_many_requests(route, 'rate_limited', retry_after)
+            gauge(f'{route}_queue_depth', limit.adjust(waiting=1)[0])
+            acquired = limit.slots.acquire(timeout=limit.max_wait)
+            gauge(f'{route}_queue_depth', limit.adjust(waiting=-1)[0])
+            if not acquired:
+                return too_many_requests(route, 'shed', limit.max_wait)
+            gauge(f'{route}_in_flight', limit.adjust(running=1)[1])
+            count(f'{route}_admitted')
+
+            def release():
+                gauge(f'{route}_in_flight', limit.adjust(running=-1)[1])
+                limit.slots.release()
+
+            try:
+                response = func(*args, **kwargs)
+            except BaseException:
+                release()
+                raise
+            if isinstance(response, Response) and response.is_streamed:
+                # Streamed bodies do their work while being sent, so hold the slot until then
+                response.call_on_close(release)
+            else:
+                release()
+            return response
+        return limited
+    return decorator
+
+def negotiate_encoding():
+    '''Picks the best encoding the client accepts, or identity'''
+    return request.accept_encodings.best_match(list(COMPRESSORS) + ['identity'], default='identity')
+
+def cached_response(route, tables, build):
+    '''
+    Serves build()'s JSON bytes compressed as the client prefers, from RESPONSE_CACHE while the
+    versions of tables are unchanged. A repeat request is a cache lookup, not a query.
+    '''
+    versions = dict(read_rows(select(VersionRecord.table_name, VersionRecord.version)))
+    version = tuple(versions.get(table) for table in tables)
+    encoding = negotiate_encoding()
+    cached = RESPONSE_CACHE.get((route, encoding))
+    if cached is not None and cached[0] == version:
+        count('response_cache_hits')
+        body = cached[1]
+    else:
+        count('response_cache_misses')
+        identity = RESPONSE_CACHE.get((route, 'identity'))
+        if identity is None or identity[0] != version:
+            identity = (version, build())
+            RESPONSE_CACHE[(route, 'identity')] = identity
+        body = identity[1]
+        if encoding != 'identity':
+            start = time.thread_time()
+            body = COMPRESSORS[encoding](body)
+            count(f'{encoding}_cpu_seconds', time.thread_time() - start)
+            count(f'{encoding}_bytes_in', len(identity[1]))
+            count(f'{encoding}_bytes_out', len(body))
+            RESPONSE_CACHE[(route, encoding)] = (version, body)
+    response = json_response(body)
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+def stream_json_array(records):
+    '''Encodes records as a JSON array one element at a time'''
+    yield b'['
+    for index, record in enumerate(records):
+        yield (b',\n' if index else b'') + dumps(record)
+    yield b']\n'
+
+# Related tables that /users?include= can nest under each user
+USER_INCLUDES = {'statuses': StatusRecord, 'pictures': PictureRecord}
+USER_PAGE_SIZE = 500
+# One page's user_ids are bound in a single IN list per include, so a page stays under the variable limit
+MAX_USER_PAGE = IDS_BATCH_SIZE
+
+def user_page(after, limit, include):
+    '''
+    One keyset page of users after the given user_id, each with its included rows nested.
+    Related rows come from one IN query per included table and are grouped in one pass.
+    '''
+    statement = select_columns(UserRecord).order_by(UserRecord.user_id)
+    if after is not None:
+        statement = statement.where(UserRecord.user_id > after)
+    page = read_records(UserRecord, statement.limit(limit))
+    user_ids = [record['user_id'] for record in page]
+    for name in include:
+        model = USER_INCLUDES[name]
+        grouped = defaultdict(list)
+        statement = select_columns(model).where(model.user_id.in_(user_ids)).order_by(model.user_id)
+        for record in read_records(model, statement):
+            grouped[record['user_id']].append(record)
+        for record in page:
+            record[name] = grouped[record['user_id']]
+    return page
+
+def iter_users(include):
+    '''Yields every user with included rows, reading USER_PAGE_SIZE users at a time'''
+    after = None
+    while True:
+        page = user_page(after, USER_PAGE_SIZE, include)
+        yield from page
+        if len(page) < USER_PAGE_SIZE:
+            return
+        after = page[-1]['user_id']
+
+# Most users one /users?prefix= search returns
+MAX_FIND_LIMIT = 1000
+
+def find_users():
+    '''Response for /users?prefix=&email_domain=&limit='''
+    limit = request.args.get('limit', users.FIND_LIMIT, type=int)
+    if limit < 1 or limit > MAX_FIND_LIMIT:
+        return json_response(dumps({'error': f'limit must be between 1 and {MAX_FIND_LIMIT}'}), status=400)
+    try:
+        found = main.find_users(request.args.get('prefix'), request.args.get('email_domain'), limit)
+    except ValueError as error:
+        return json_response(dumps({'error': str(error)}), status=400)
+    return json_response(dumps({'users': [dict(user) for user in found]}))
+
+def list_users():
+    '''Response for /users, /users?include= and /users?limit=&after='''
+    include = [name for name in request.args.get('include', '').split(',') if name]
+    unknown = [name for name in include if name not in USER_INCLUDES]
+    if unknown:
+        return json_response(dumps({'error': f"Unknown include: {', '.join(unknown)}"}), status=400)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        if limit < 1 or limit > MAX_USER_PAGE:
+            return json_response(dumps({'error': f'limit must be between 1 and {MAX_USER_PAGE}'}), status=400)
+        page = user_page(request.args.get('after'), limit, include)
+        return json_response(dumps({'users': page,
+                                    'next_after': page[-1]['user_id'] if len(page) == limit else None}))
+    if include:
+        # Rows are read after the headers are sent, so note a snapshot read up front
+        snapshot_for_read()
+        return Response(stream_with_context(stream_json_array(iter_users(include))),
+                        mimetype='application/json')
+    return cached_response('users', ['usertable'], lambda: dumps(read_records(UserRecord)))
+
 class User(Resource):
     def get(self):
-        return jsonify([record.serialize() for record in UserRecord.query.all()])
+        """
+        Lists users. ?include=statuses,pictures nests their rows under each user;
+        ?limit=N&after=<user_id> returns one keyset page with the user_id to continue after;
+        ?ids=a,b,c returns just those users, in that order, with the IDs not found;
+        ?prefix= and/or ?email_domain= find users by name or email prefix and by domain
+        """
+        if 'ids' in request.args:
+            return multi_get(UserRecord, UserRecord.user_id, 'users')
+        if 'prefix' in request.args or 'email_domain' in request.args:
+            return find_users()
+        return list_users()
+
+    def post(self):
+        """
+        Multi-get for ID lists too long for a URL: {"ids": [...]} returns those users and the IDs not found
+        """
+        return multi_get(UserRecord, UserRecord.user_id, 'users')
 
 class Status(Resource):
     def get(self):
-        return jsonify([record.serialize() for record in StatusRecord.query.all()])
+        """
+        Lists statuses, or with ?ids=a,b,c just those statuses, in that order, with the IDs not found
+        """
+        if 'ids' in request.args:
+            return multi_get(StatusRecord, StatusRecord.status_id, 'statuses')
+        return cached_response('statuses', ['statustable'], lambda: dumps(read_records(StatusRecord)))
+
+    def post(self):
+        """
+        Multi-get for ID lists too long for a URL: {"ids": [...]} returns those statuses and the IDs not found
+        """
+        return multi_get(StatusRecord, StatusRecord.status_id, 'statuses')
 
 class Picture(Resource):
     def get(self):
-        return jsonify([record.serialize() for record in PictureRecord.query.all()])
+        return cached_response('pictures', ['picturetable'], lambda: dumps(read_records(PictureRecord)))
+
+# Most picture_ids one /pictures/search returns
+MAX_SEARCH_LIMIT = 1000
+
+class PictureSearch(Resource):
+    '''Pictures matching a boolean tag query, answered from the in-process tag index'''
+    def get(self):
+        """
+        ?q=#skiing AND NOT #F1 (URL-encoded) returns how many pictures match and up to ?limit= of their
+        picture_ids, newest first. NOT binds tighter than AND, AND tighter than OR; parentheses group.
+        """
+        limit = request.args.get('limit', tag_index.QUERY_LIMIT, type=int)
+        if limit < 1 or limit > MAX_SEARCH_LIMIT:
+            return json_response(dumps({'error': f'limit must be between 1 and {MAX_SEARCH_LIMIT}'}), status=400)
+        try:
+            return json_response(dumps(main.search_tags(request.args.get('q', ''), limit)))
+        except tag_index.TagQueryError as error:
+            return json_response(dumps({'error': str(error)}), status=400)
+
+class Metrics(Resource):
+    '''Counters for response caching, compression and admission control'''
+    def get(self):
+        with METRICS_LOCK:
+            metrics = dict(METRICS)
+        metrics['event_subscribers'] = len(PUBLISHER.subscribers)
+        metrics['event_subscribers_dropped'] = PUBLISHER.dropped
+        for encoding in COMPRESSORS:
+            if metrics.get(f'{encoding}_bytes_out'):
+                metrics[f'{encoding}_compression_ratio'] = (metrics[f'{encoding}_bytes_in'] /
+                                                            metrics[f'{encoding}_bytes_out'])
+        return json_response(dumps(metrics))
+
+# Most rows a /stats report returns
+MAX_STATS_LIMIT = 1000
+
+def stats_limit():
+    '''?limit= for a /stats report, or None if it is out of range'''
+    limit = request.args.get('limit', analytics.TOP_TAGS, type=int)
+    return limit if 1 <= limit <= MAX_STATS_LIMIT else None
+
+class TopTags(Resource):
+    '''The tags on the most pictures'''
+    def get(self):
+        """
+        The ?limit= most used tags (10 by default) with how many pictures carry each
+        """
+        limit = stats_limit()
+        if limit is None:
+            return json_response(dumps({'error': f'limit must be between 1 and {MAX_STATS_LIMIT}'}), status=400)
+        return cached_response(f'stats/tags/{limit}', ['picturetable'],
+                               lambda: dumps(analytics.TAG_STATS.top_tags(limit)))
+
+class TagPairs(Resource):
+    '''Tags that appear together on pictures'''
+    def get(self):
+        """
+        The ?limit= pairs of tags most often on the same picture, or with ?tag= (URL-encoded, %23 for #) only the pairs including it
+        """
+        limit = stats_limit()
+        if limit is None:
+            return json_response(dumps({'error': f'limit must be between 1 and {MAX_STATS_LIMIT}'}), status=400)
+        tag = request.args.get('tag')
+        if tag is not None:
+            # Not kept in RESPONSE_CACHE, which would otherwise grow with every tag asked about
+            return json_response(dumps(analytics.TAG_STATS.tag_pairs(limit, tag)))
+        return cached_response(f'stats/tags/pairs/{limit}', ['picturetable'],
+                               lambda: dumps(analytics.TAG_STATS.tag_pairs(limit)))
+
+class StatusesPerUser(Resource):
+    '''How statuses are spread across users'''
+    def get(self):
+        return cached_response('stats/statuses_per_user', ['usertable', 'statustable'],
+                               lambda: dumps(analytics.statuses_per_user()))
+
+class UserSummary(Resource):
+    '''Status and picture counts for one user, read from their summary row'''
+    def get(self, user_id):
+        records = read_records(SummaryRecord, select_columns(SummaryRecord).where(SummaryRecord.user_id == user_id))
+        return json_response(dumps(records[0] if records else {}))
+
+# Largest page /users/<user_id>/timeline returns
+MAX_TIMELINE_PAGE = 100
+
+class UserTimeline(Resource):
+    '''One user's statuses, newest first, a page at a time'''
+    def get(self, user_id):
+        """
+        Up to ?limit= statuses (20 by default) older than ?before=<seq>, or the newest if before is omitted.
+        Pass next_before as the next before; it is null on the last page.
+        """
+        before = request.args.get('before', type=int)
+        limit = request.args.get('limit', user_status.TIMELINE_PAGE_SIZE, type=int)
+        if limit < 1 or limit > MAX_TIMELINE_PAGE:
+            return json_response(dumps({'error': f'limit must be between 1 and {MAX_TIMELINE_PAGE}'}), status=400)
+        statuses = [dict(status) for status in main.user_timeline(user_id, before, limit)]
+        return json_response(dumps({'statuses': statuses,
+                                    'next_before': statuses[-1]['seq'] if len(statuses) == limit else None}))
 
 class ImageDiff(Resource):
+    @admission_controlled('diff')
     def get(self, user_id):
         """
-        Attempts to call reconcile images and report out
+        Attempts to call reconcile images and report out. ?verify=1 also reports content mismatches
         """
         try:
-            return jsonify(main.reconcile_images(user_id))
+            image_diff = main.reconcile_images(user_id, request.args.get('verify', '0') not in ('0', 'false'))
+            return jsonify({key: sorted(value) for key, value in image_diff.items()})
         except Exception as e:
             return jsonify({'error': str(e),
                             'message': 'Unable to properly implement reconcile image function in Lesson 9'})
 
+def difference_record(difference, record):
+    '''Converts a reconcile difference into its JSON form'''
+    user_id, tags, filename = record
+    return {'difference': difference, 'user_id': user_id, 'tags': tags, 'file': filename}
+
+MAX_DIFFERENCES_PAGE = 10000
+
+class Differences(Resource):
+    '''Every image that is out of sync between the database and the pictures directory'''
+    @admission_controlled('differences')
+    def get(self):
+        """
+        Streams all differences as a JSON array, as NDJSON with ?format=ndjson,
+        or as one page with ?limit=N&offset=M
+        """
+        differences = (difference_record(*pair) for pair in main.reconcile_all_images())
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            offset = request.args.get('offset', 0, type=int)
+            if limit < 1 or limit > MAX_DIFFERENCES_PAGE:
+                return json_response(dumps({'error': f'limit must be between 1 and {MAX_DIFFERENCES_PAGE}'}),
+                                     status=400)
+            if offset < 0:
+                return json_response(dumps({'error': 'offset must not be negative'}), status=400)
+            page = list(islice(differences, offset, offset + limit + 1))
+            return jsonify({'differences': page[:limit],
+                            'next_offset': offset + limit if len(page) > limit else None})
+        if request.args.get('format') == 'ndjson':
+            return Response((dumps(record) + b'\n' for record in differences),
+                            mimetype='application/x-ndjson')
+        return Response(stream_json_array(differences), mimetype='application/json')
+
+class Jobs(Resource):
+    '''Queues a reconcile or load job for the jobs.py worker'''
+    def post(self):
+        """
+        Takes {"kind": ..., "params": {...}} and returns 202 with the job ID.
+        An identical job still queued or running is returned instead of a new one.
+        """
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get('params', {}), (dict, type(None))):
+            return json_response(dumps({'error': 'Send a JSON object {"kind": ..., "params": {...}}',
+                                        'kinds': sorted(jobs.JOB_KINDS)}), status=400)
+        try:
+            job_id, deduplicated = jobs.submit_job(body.get('kind'), body.get('params'))
+        except ValueError as error:
+            return json_response(dumps({'error': str(error), 'kinds': sorted(jobs.JOB_KINDS)}), status=400)
+        response = json_response(dumps({'job_id': job_id, 'deduplicated': deduplicated}), status=202)
+        response.headers['Location'] = f'/jobs/{job_id}'
+        return response
+
+class Job(Resource):
+    '''Status, progress and result of one job'''
+    def get(self, job_id):
+        job = jobs.job_status(job_id)
+        return json_response(dumps(job if job is not None else {}), status=200 if job is not None else 404)
+
+MAX_CHANGES_PAGE = 10000
+
+class Changes(Resource):
+    '''Inserts, updates and deletes in order, so downstream copies can sync without re-pulling tables'''
+    def get(self):
+        """
+        Changes after ?since=<seq>, oldest first, at most ?limit= of them. Pass next_since as the next since.
+        410 means retention removed changes after since: re-pull the tables, then continue from latest.
+        """
+        since = request.args.get('since', 0, type=int)
+        limit = request.args.get('limit', changelog.CHANGES_PAGE_SIZE, type=int)
+        if limit < 1 or limit > MAX_CHANGES_PAGE:
+            return json_response(dumps({'error': f'limit must be between 1 and {MAX_CHANGES_PAGE}'}), status=400)
+        latest = changelog.latest_seq()
+        try:
+            changes = changelog.read_changes(since, limit)
+        except changelog.ChangesTruncated as error:
+            return json_response(dumps({'error': str(error), 'truncated_through': error.truncated_through,
+                                        'latest': latest}), status=410)
+        return json_response(dumps({'changes': changes, 'next_since': changes[-1]['seq'] if changes else since,
+                                    'latest': latest}))
+
+# Tables /events can stream, by the names clients use in ?tables=
+EVENT_TABLES = {'statuses': 'statustable', 'pictures': 'picturetable'}
+EVENT_NAMES = {table: name for name, table in EVENT_TABLES.items()}
+PUBLISHER = events.ChangePublisher()
+
+def sse_message(kind, payload):
+    '''Encodes one events.iter_events item as a server-sent event'''
+    if kind == 'heartbeat':
+        return b': heartbeat\n\n'
+    if kind == 'overflow':
+        return b'event: overflow\ndata: ' + dumps({'reconnect_from': payload}) + b'\n\n'
+    header = f"id: {payload['seq']}\nevent: {EVENT_NAMES[payload['table']]}.{payload['operation']}\ndata: "
+    return header.encode() + dumps(payload) + b'\n\n'
+
+class Events(Resource):
+    '''Server-sent events for status and picture inserts, updates and deletes as they happen'''
+    def get(self):
+        """
+        Streams changes to ?tables=statuses,pictures (both by default). Reconnecting with Last-Event-ID,
+        or ?since=<seq>, replays what was missed from the changelog first. A client that falls behind
+        gets an overflow event and should reconnect from its reconnect_from seq.
+        """
+        names = [name for name in request.args.get('tables', ','.join(EVENT_TABLES)).split(',') if name]
+        unknown = [name for name in names if name not in EVENT_TABLES]
+        if unknown or not names:
+            return json_response(dumps({'error': f"Unknown tables: {', '.join(unknown)}",
+                                        'tables': sorted(EVENT_TABLES)}), status=400)
+        since = request.headers.get('Last-Event-ID', type=int)
+        if since is None:
+            since = request.args.get('since', type=int)
+        if since is not None and since < changelog.truncated_through():
+            return json_response(dumps({'error': f'Changes after {since} are no longer kept',
+                                        'latest': changelog.latest_seq()}), status=410)
+        subscriber = PUBLISHER.subscribe(EVENT_TABLES[name] for name in names)
+        stream = events.iter_events(PUBLISHER, subscriber, since)
+
+        def generate():
+            yield b': connected\n\n'
+            for kind, payload in stream:
+                yield sse_message(kind, payload)
+
+        response = Response(generate(), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        # Runs even if the client leaves before the stream starts
+        response.call_on_close(lambda: PUBLISHER.unsubscribe(subscriber))
+        return response
+
 #Define End Points
 api.add_resource(User, "/users")
+api.add_resource(UserSummary, "/users/<user_id>/summary")
+api.add_resource(UserTimeline, "/users/<user_id>/timeline")
 api.add_resource(Status, "/statuses")
 api.add_resource(Picture, "/pictures")
+api.add_resource(PictureSearch, "/pictures/search")
 api.add_resource(ImageDiff, "/diff/<user_id>")
+api.add_resource(Differences, "/differences")
+api.add_resource(Metrics, "/metrics")
+api.add_resource(Jobs, "/jobs")
+api.add_resource(Job, "/jobs/<int:job_id>")
+api.add_resource(Changes, "/changes")
+api.add_resource(Events, "/events")
+api.add_resource(TopTags, "/stats/tags")
+api.add_resource(TagPairs, "/stats/tags/pairs")
+api.add_resource(StatusesPerUser, "/stats/statuses_per_user")
 
 if __name__ == '__main__':
-    app.run(port=5002, debug=True)
\ No newline at end of file
+    if os.environ.get('PICTURE_WATCHER'):
+        # Optional: answer /diff from inotify-maintained state instead of walking pictures/
+        import picture_watcher
+        picture_watcher.start_watcher()
+    if SNAPSHOT_PATH:
+        start_snapshot_refresher()
+    app.run(port=5002, debug=True)
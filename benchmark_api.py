@@ -0,0 +1,64 @@
+'''
+Micro-benchmark of api.py serialization: model.serialize() + jsonify against column tuples + dumps.
+
+Runs against a scratch social_network.db in a temporary directory, so the real database is untouched.
+Usage: python benchmark_api.py [rows]
+'''
+import os
+import sys
+import time
+import tempfile
+
+
+def rows_per_second(func, rows, repeat=3):
+    '''Best rows/second over repeat calls of func'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return rows / best
+
+
+def populate(rows):
+    '''Fills the scratch database with rows users, statuses and pictures'''
+    # pylint: disable=C0415,E1120
+    from socialnetwork_model import db, UserTable, StatusTable, PictureTable
+    with db.atomic():
+        for start in range(0, rows, 500):
+            batch = range(start, min(start + 500, rows))
+            UserTable.insert_many([{'user_id': f'user{i}', 'first_name': 'First', 'last_name': 'Last',
+                                    'email': f'user{i}@example.com'} for i in batch]).execute()
+            StatusTable.insert_many([{'status_id': f'status{i}', 'user_id': f'user{i}',
+                                      'status_text': 'a status update of ordinary length'} for i in batch]).execute()
+            PictureTable.insert_many([{'picture_id': str(i).zfill(10), 'user_id': f'user{i}',
+                                       'tags': '#golf #skiing #F1'} for i in batch]).execute()
+
+
+def main(rows):
+    '''Prints rows/second for both serialization paths on every table'''
+    # pylint: disable=C0415
+    import api
+    from flask import jsonify
+    populate(rows)
+    print(f"encoder: {'orjson' if api.orjson is not None else 'json'}, rows per table: {rows}")
+    with api.app.test_request_context():
+        for model in (api.UserRecord, api.StatusRecord, api.PictureRecord):
+            def serialize_path(model=model):
+                return jsonify([record.serialize() for record in model.query.all()]).get_data()
+
+            def fast_path(model=model):
+                return api.dumps(api.read_records(model))
+
+            old = rows_per_second(serialize_path, rows)
+            new = rows_per_second(fast_path, rows)
+            print(f"{model.__tablename__:>14}: serialize() {old:12,.0f} rows/s | "
+                  f"tuples + dumps {new:12,.0f} rows/s | {new / old:5.1f}x")
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
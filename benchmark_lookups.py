@@ -0,0 +1,48 @@
+'''
+Benchmark of key lookups through DataSet.find_one/find against the precompiled lookup_table statements.
+
+Runs against a scratch social_network.db in a temporary directory, so the real database is untouched.
+Usage: python benchmark_lookups.py [rows] [lookups]
+'''
+import os
+import sys
+import time
+import random
+import tempfile
+
+
+def lookups_per_second(func, keys):
+    '''Calls func on every key and returns calls/second'''
+    start = time.perf_counter()
+    for key in keys:
+        func(key)
+    return len(keys) / (time.perf_counter() - start)
+
+
+def main(rows, lookups):
+    '''Prints lookups/second for the user, status and picture searches both ways'''
+    # pylint: disable=C0415,R0914
+    from benchmark_api import populate
+    from records import UserRow, StatusRow, PictureRow
+    from socialnetwork_model import Users, Statuses, Pictures, search_table, search_table_for_many, lookup_table
+    populate(rows)
+    ids = random.Random(0).sample(range(rows), min(lookups, rows))
+    cases = [
+        ('user by user_id', Users, 'user_id', UserRow, False, [f'user{i}' for i in ids]),
+        ('status by status_id', Statuses, 'status_id', StatusRow, False, [f'status{i}' for i in ids]),
+        ('picture by picture_id', Pictures, 'picture_id', PictureRow, False, [str(i).zfill(10) for i in ids]),
+        ('pictures by user_id', Pictures, 'user_id', PictureRow, True, [f'user{i}' for i in ids]),
+    ]
+    print(f'rows per table: {rows:,}, lookups: {len(ids):,}')
+    for name, table, column, row_type, many, keys in cases:
+        helper = search_table_for_many(table, row_type) if many else search_table(table, row_type)
+        old = lookups_per_second(lambda key, helper=helper, column=column: helper(**{column: key}), keys)
+        new = lookups_per_second(lookup_table(table, column, row_type, many), keys)
+        print(f'{name:>22}: DataSet {old:10,.0f}/s | precompiled {new:10,.0f}/s | {new / old:5.1f}x')
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000, int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
@@ -0,0 +1,43 @@
+'''
+Memory benchmark of a full-table scan returning DataSet dict rows against records.py row types.
+
+Runs against a scratch social_network.db in a temporary directory, so the real database is untouched.
+Usage: python benchmark_records.py [rows]
+'''
+import os
+import sys
+import tempfile
+import tracemalloc
+
+
+def peak_bytes(func):
+    '''Peak traced allocation while func runs, keeping its result alive'''
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def main(rows):
+    '''Prints peak memory for scanning every table as dicts and as records'''
+    # pylint: disable=C0415
+    from benchmark_api import populate
+    from records import UserRow, StatusRow, PictureRow
+    from socialnetwork_model import Users, Statuses, Pictures, search_table_for_many
+    populate(rows)
+    print(f'rows per table: {rows:,}')
+    for table, row_type in ((Users, UserRow), (Statuses, StatusRow), (Pictures, PictureRow)):
+        as_dicts = peak_bytes(lambda table=table: list(search_table_for_many(table)()))
+        as_records = peak_bytes(lambda table=table, row_type=row_type: search_table_for_many(table, row_type)())
+        print(f'{table.name:>14}: dicts {as_dicts / 2 ** 20:8.1f} MiB | {row_type.__name__} '
+              f'{as_records / 2 ** 20:8.1f} MiB | {as_dicts / as_records:4.1f}x smaller')
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,41 @@
+'''
+Benchmark of parallel ingest into sharding.ShardedStore against a single database file.
+
+Runs in a temporary directory, so the real databases are untouched.
+Usage: python benchmark_sharding.py [users] [shards]
+'''
+import os
+import sys
+import time
+import tempfile
+
+
+def ingest(store, users, statuses):
+    '''Seconds taken to bulk load users and then their statuses'''
+    start = time.perf_counter()
+    store.bulk_load('usertable', users)
+    store.bulk_load('statustable', statuses)
+    return time.perf_counter() - start
+
+
+def main(user_count, shard_count):
+    '''Prints rows/second for one shard and for shard_count shards'''
+    # pylint: disable=C0415
+    import sharding
+    users = [{'user_id': f'user{i}', 'first_name': 'First', 'last_name': 'Last', 'email': f'user{i}@example.com'}
+             for i in range(user_count)]
+    statuses = [{'status_id': f'status{i}.{j}', 'user_id': f'user{i}', 'status_text': 'a status update'}
+                for i in range(user_count) for j in range(4)]
+    rows = len(users) + len(statuses)
+    print(f'rows: {rows:,} ({len(users):,} users, {len(statuses):,} statuses)')
+    for count in (1, shard_count):
+        elapsed = ingest(sharding.ShardedStore(count, f'bench_{count}_{{index}}.db'), users, statuses)
+        print(f'{count:>3} shard(s): {elapsed:7.2f}s | {rows / elapsed:12,.0f} rows/s')
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+             int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 4)
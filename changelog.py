@@ -0,0 +1,122 @@
+'''
+Reads and trims the change log written by socialnetwork_model.CHANGELOG_TRIGGERS.
+
+Consumers keep the seq of the last change they applied and ask for the changes after it.
+Compaction drops entries superseded by a later change to the same row, so a consumer that has
+fallen behind still ends up at the right state. Retention deletes old entries outright; a consumer
+whose position is older than what retention removed has to resync from the full tables.
+
+Run retention and compaction with: python changelog.py
+'''
+# pylint: disable=E1120
+import os
+import json
+import random
+
+from loguru import logger
+
+from socialnetwork_model import db, ChangeLogTable, ChangeLogStateTable
+
+# Seconds before entries are compacted, and before they are deleted; CHANGELOG_MAX_ROWS caps the log size
+CHANGELOG_COMPACT_AFTER = float(os.environ.get('CHANGELOG_COMPACT_AFTER', 60 * 60))
+CHANGELOG_RETENTION = float(os.environ.get('CHANGELOG_RETENTION', 7 * 24 * 60 * 60))
+CHANGELOG_MAX_ROWS = int(os.environ.get('CHANGELOG_MAX_ROWS', 0)) or None
+CHANGES_PAGE_SIZE = 1000
+TRUNCATED_THROUGH = 'truncated_through'
+DATABASE_ID = 'database_id'
+
+
+class ChangesTruncated(Exception):
+    '''Raised when a consumer asks for changes older than retention has kept'''
+
+    def __init__(self, since, truncated):
+        super().__init__(f'Changes after {since} are no longer complete; retention removed up to {truncated}')
+        self.truncated_through = truncated
+
+
+def latest_seq():
+    '''The highest seq ever written, even if that entry has since been removed'''
+    row = db.execute_sql("SELECT seq FROM sqlite_sequence WHERE name = 'changelogtable'").fetchone()
+    return row[0] if row else 0
+
+
+def truncated_through():
+    '''The highest seq deleted by retention; consumers must be at or past it'''
+    state = ChangeLogStateTable.get_or_none(ChangeLogStateTable.name == TRUNCATED_THROUGH)
+    return state.value if state is not None else 0
+
+
+def database_id():
+    '''
+    A random ID chosen the first time it is asked for and kept with the changelog, so a seq saved
+    by a consumer can be told apart from the same seq in a deleted and recreated database
+    '''
+    with db.atomic():
+        ChangeLogStateTable.insert(name=DATABASE_ID, value=random.getrandbits(62)).on_conflict_ignore().execute()
+        return ChangeLogStateTable.get(ChangeLogStateTable.name == DATABASE_ID).value
+
+
+def change_record(seq, table_name, operation, row_key, data, changed_at):  # pylint: disable=R0913,R0917
+    '''Converts a changelog row into its JSON form'''
+    return {'seq': seq, 'table': table_name, 'operation': operation, 'key': row_key,
+            'data': None if data is None else json.loads(data), 'changed_at': str(changed_at)}
+
+
+def read_changes(since=0, limit=CHANGES_PAGE_SIZE):
+    '''Up to limit changes with seq greater than since, oldest first. Raises ChangesTruncated'''
+    with db.atomic():
+        truncated = truncated_through()
+        if since < truncated:
+            raise ChangesTruncated(since, truncated)
+        rows = (ChangeLogTable.select().where(ChangeLogTable.seq > since)
+                .order_by(ChangeLogTable.seq).limit(limit).tuples())
+        return [change_record(*row) for row in rows]
+
+
+def iter_changes(since=0, page_size=CHANGES_PAGE_SIZE):
+    '''
+    Yields the changes after since in pages of up to page_size, oldest first, until caught up.
+    Raises ChangesTruncated, possibly after some pages, once retention has removed changes the
+    reader needs; it then has to rebuild from the full tables.
+    '''
+    while True:
+        changes = read_changes(since, page_size)
+        if changes:
+            yield changes
+            since = changes[-1]['seq']
+        if len(changes) < page_size:
+            return
+
+
+def compact_changelog(compact_after=CHANGELOG_COMPACT_AFTER, retention=CHANGELOG_RETENTION,
+                      max_rows=CHANGELOG_MAX_ROWS):
+    '''
+    Deletes entries older than compact_after seconds that a later entry for the same row supersedes,
+    then entries older than retention seconds or beyond the newest max_rows.
+    Returns the counts removed and the new truncated_through.
+    '''
+    with db.atomic('IMMEDIATE'):
+        compacted = db.execute_sql(
+            """DELETE FROM changelogtable WHERE changed_at < datetime('now', ?) AND EXISTS (
+                SELECT 1 FROM changelogtable later WHERE later.table_name = changelogtable.table_name
+                AND later.row_key = changelogtable.row_key AND later.seq > changelogtable.seq)""",
+            (f'-{compact_after} seconds',)).rowcount
+        # Retention removes a prefix of the log: everything up to the newest expired entry
+        horizon = db.execute_sql("SELECT MAX(seq) FROM changelogtable WHERE changed_at < datetime('now', ?)",
+                                 (f'-{retention} seconds',)).fetchone()[0]
+        if max_rows is not None:
+            row = db.execute_sql('SELECT seq FROM changelogtable ORDER BY seq DESC LIMIT 1 OFFSET ?',
+                                 (max_rows,)).fetchone()
+            if row is not None:
+                horizon = max(horizon or 0, row[0])
+        removed = 0
+        if horizon is not None:
+            removed = ChangeLogTable.delete().where(ChangeLogTable.seq <= horizon).execute()
+            ChangeLogStateTable.replace(name=TRUNCATED_THROUGH, value=horizon).execute()
+    result = {'compacted': compacted, 'expired': removed, 'truncated_through': truncated_through()}
+    logger.info(f'Changelog compaction: {result}')
+    return result
+
+
+if __name__ == '__main__':
+    print(json.dumps(compact_changelog()))
@@ -0,0 +1,163 @@
+'''
+In-process publisher pushing changelog entries to server-sent event subscribers.
+
+One background thread tails the changelog and hands each new change to every subscriber's bounded
+queue, so the database is read once per poll however many clients are connected, and not at all
+when none are. A subscriber whose queue fills up is dropped rather than slowing the others down;
+its stream ends with an overflow event carrying the last seq it was sent, and the client resumes from
+there with Last-Event-ID, catching up from the changelog.
+'''
+import queue
+import threading
+
+from loguru import logger
+
+import changelog
+
+PUBLISH_INTERVAL = 0.5
+SUBSCRIBER_BUFFER = 256
+HEARTBEAT_INTERVAL = 15
+
+
+class Subscriber:
+    '''One client's filter and bounded queue of pending changes'''
+
+    def __init__(self, tables, buffer_size):
+        self.tables = tables
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.dropped = False
+        # Publisher position when this subscriber joined; older changes come from the changelog
+        self.start = 0
+
+    def offer(self, change):
+        '''Queues change if it matches. Returns False if the queue was full and the subscriber is dropped'''
+        if change['table'] not in self.tables:
+            return True
+        try:
+            self.queue.put_nowait(change)
+            return True
+        except queue.Full:
+            self.dropped = True
+            return False
+
+
+class ChangePublisher:
+    '''Polls the changelog on one thread and fans new changes out to every subscriber'''
+
+    def __init__(self, interval=PUBLISH_INTERVAL, buffer_size=SUBSCRIBER_BUFFER):
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.subscribers = set()
+        self.position = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, tables):
+        '''Registers a subscriber for changes to tables, starting the polling thread if needed'''
+        subscriber = Subscriber(set(tables), self.buffer_size)
+        with self._lock:
+            if not self.subscribers:
+                # Nothing was read while nobody was listening
+                self.position = changelog.latest_seq()
+            subscriber.start = self.position
+            self.subscribers.add(subscriber)
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='change-publisher', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        '''Removes a subscriber; safe to call more than once'''
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def poll(self):
+        '''Publishes changes written since the last poll. Returns how many were read'''
+        with self._lock:
+            if not self.subscribers:
+                return 0
+            read = 0
+            try:
+                for changes in changelog.iter_changes(self.position):
+                    for change in changes:
+                        self._drop([subscriber for subscriber in self.subscribers if not subscriber.offer(change)])
+                    self.position = changes[-1]['seq']
+                    read += len(changes)
+            except changelog.ChangesTruncated:
+                # Retention overtook the publisher; every subscriber has to resume from the changelog
+                self._drop(list(self.subscribers))
+                self.position = changelog.latest_seq()
+            return read
+
+    def _drop(self, subscribers):
+        '''Disconnects slow subscribers. Callers hold the lock'''
+        for subscriber in subscribers:
+            subscriber.dropped = True
+            self.subscribers.discard(subscriber)
+            self.dropped += 1
+        if subscribers:
+            logger.warning(f'Dropped {len(subscribers)} slow event subscribers')
+
+    def stop(self):
+        '''Stops the polling thread'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        '''Polls until stopped or nobody is subscribed'''
+        while not self._stop.wait(self.interval):
+            try:
+                read = self.poll()
+            except Exception as error:  # pylint: disable=W0718
+                # A database hiccup must not end the stream for every subscriber
+                logger.error(f'Change publisher poll failed: {error!r}')
+                continue
+            with self._lock:
+                if not read and not self.subscribers:
+                    self._thread = None
+                    return
+
+
+def catch_up(subscriber, since):
+    '''Yields changes after since up to where the subscriber went live, read from the changelog'''
+    if since >= subscriber.start:
+        return
+    for changes in changelog.iter_changes(since):
+        for change in changes:
+            if change['seq'] > subscriber.start:
+                return
+            if change['table'] in subscriber.tables:
+                yield change
+
+
+def iter_events(publisher, subscriber, since=None, heartbeat=HEARTBEAT_INTERVAL):
+    '''
+    Yields (kind, payload) for a subscriber: ('change', change) for the changelog after since and then
+    live changes, ('heartbeat', None) every heartbeat seconds while idle, and finally
+    ('overflow', last seq sent) if the subscriber is dropped.
+    '''
+    last = since if since is not None else subscriber.start
+    try:
+        if since is not None:
+            for change in catch_up(subscriber, since):
+                last = change['seq']
+                yield 'change', change
+        while True:
+            # A dropped subscriber still gets what was buffered before it fell behind
+            if subscriber.dropped and subscriber.queue.empty():
+                yield 'overflow', last
+                return
+            try:
+                change = subscriber.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield 'heartbeat', None
+                continue
+            if change['seq'] > last:
+                last = change['seq']
+                yield 'change', change
+    finally:
+        publisher.unsubscribe(subscriber)
@@ -1,51 +1,220 @@
 '''Defines functions related to user images'''
 
 import os
+import sys
 import csv
+import mmap
+import shutil
+import hashlib
+from itertools import groupby
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from loguru import logger
 # from peewee import IntegrityError
 
-from socialnetwork_model import insert_table, search_table, Pictures, search_table_for_many
+from socialnetwork_model import (db, insert_table, lookup_table, lookup_many_table, iter_table, Pictures, PictureTable,
+                                 UserTable)
+from records import PictureRow
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, thumbnails are skipped without it
+    Image = None
 
 PICTURE_DIR = "pictures/"
 path = Path.cwd() / PICTURE_DIR
 
+# On-disk layouts. 'tags' nests images under pictures/<user_id>/<sorted tags>/,
+# 'sharded' keeps a fixed-depth hash tree keyed by picture_id and takes tags from the database.
+TAG_LAYOUT = 'tags'
+SHARDED_LAYOUT = 'sharded'
+STORAGE_LAYOUT = os.environ.get('PICTURE_LAYOUT', TAG_LAYOUT)
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+LOOKUP_BATCH_SIZE = 500
+
+# repair_images policies for rows whose file is missing from the server
+RESTORE_POLICY = 'restore'
+DELETE_POLICY = 'delete'
+IGNORE_POLICY = 'ignore'
+REPAIR_BATCH_SIZE = 500
+REPAIR_WORKERS = 4
+
+# Thumbnails are written to THUMBNAIL_DIR/<size>/<picture_id>.png, one directory per size
+THUMBNAIL_DIR = "thumbnails/"
+THUMBNAIL_SIZES = (64, 256)
+THUMBNAIL_WORKERS = None
+THUMBNAIL_QUEUE_SIZE = 32
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Content verification hashes files on a thread pool; files this large are hashed through mmap
+CHECKSUM_WORKERS = 8
+CHECKSUM_QUEUE_SIZE = 64
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# Set by picture_watcher while it keeps ServerImageTable current, replacing tree walks
+SERVER_IMAGE_SOURCE = None
+# Set by tag_index while an index is loaded, so each stored image is indexed straight away
+IMAGE_ADDED_HOOK = None
+
+# Directories already created by this process, so add_image doesn't makedirs every image
+_known_dirs = set()
+
 # Add Image to Pictures Table
 image_insert = insert_table(Pictures)
 
-def add_image(user_id, tags):
-    '''Finds the last image ID in the Pictures table and increments it by 1'''
+def add_image(user_id, tags, source=None):
+    '''
+    Stores an image under the next free picture ID and adds it to the Pictures table.
+    source may be a file path or bytes; thumbnails are generated for it in this process.
+    '''
+    stored = store_image(user_id, tags, source)
+    if stored is None:
+        return False
+    generate_thumbnails(thumbnail_jobs(*stored), workers=0)
+    return True
+
+def store_image(user_id, tags, source=None):
+    '''Writes the original image and its table row. Returns (picture_id, filepath, digest) or None'''
     image_id = find_next_image_id()
-    output_dir = convert_tags_to_dir(tags, user_id)
+    output_dir = image_dir(image_id, user_id, tags)
     image_data = {'picture_id':f"{image_id}", 'user_id': user_id, 'tags': tags}
-    os.makedirs(output_dir, exist_ok=True)
+    ensure_dir(output_dir)
     filepath = os.path.join(output_dir, f"{image_id}.png")
-    with open(filepath, 'w') as new_image:
-        new_image.write(str(image_data))
-    if image_insert(**image_data) is True:
+    if source is None:
+        content = str(image_data)
+    else:
+        content = Path(source) if isinstance(source, (str, os.PathLike)) else source
+    try:
+        digest = write_image_file(filepath, content)
+    except FileNotFoundError:
+        logger.error(f'Source image {source} not found for {user_id}')
+        return None
+    stat = os.stat(filepath)
+    checksum_data = {'checksum': digest, 'checksum_mtime': stat.st_mtime, 'checksum_size': stat.st_size}
+    if image_insert(**image_data, **checksum_data) is True:
         logger.info(f'Added {image_id} image to database')
-        return True
+        if IMAGE_ADDED_HOOK is not None:
+            IMAGE_ADDED_HOOK(image_data['picture_id'], tags)
+        return image_id, filepath, None if source is None else digest
     logger.error(f'Integrity Error adding image: {image_id}, {user_id}, {tags}')
-    return False
+    return None
 
 def load_images(filename):
-    '''Reads in csv, renames headers to match database structure, then adds each image to table'''
-    new_headers = ['user_id', 'tags']
+    '''
+    Reads in csv, renames headers to match database structure, then adds each image to table.
+    An optional third column gives a source image path; their thumbnails are built on a process pool.
+    '''
+    new_headers = ['user_id', 'tags', 'source']
+
+    def stored_images(reader):
+        for image in reader:
+            stored = store_image(image['user_id'], image['tags'], image['source'] or None)
+            if stored is not None:
+                yield from thumbnail_jobs(*stored)
 
     try:
         with open(filename, 'r', newline='') as file:
             reader = csv.DictReader(file, fieldnames=new_headers)
             next(reader)
-            for image in reader:
-                add_image(**image)
+            generate_thumbnails(stored_images(reader))
         logger.info(f"Successfully updated {filename}")
         return True
     except FileNotFoundError:
         logger.error(f"Error: File {filename} not found.")
         return False
 
+def export_images(filename):
+    '''
+    Writes every picture's user and tags to a csv in the layout load_images reads.
+    Picture IDs aren't written; loading assigns new ones. Returns how many were written.
+    '''
+    written = 0
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['USER_ID', 'TAGS'])
+        for picture in iter_table(Pictures):
+            writer.writerow([picture['user_id'], picture['tags']])
+            written += 1
+    logger.info(f"Exported {written} images to {filename}")
+    return written
+
+def thumbnail_path(picture_id, size):
+    '''Returns the thumbnail file path for a picture at the given size'''
+    return os.path.join(THUMBNAIL_DIR, str(size), f"{picture_id}.png")
+
+def thumbnail_jobs(picture_id, filepath, digest):
+    '''Yields (source, size, destination, digest) for each thumbnail that is missing or out of date'''
+    if digest is None:
+        return
+    for size in THUMBNAIL_SIZES:
+        destination = thumbnail_path(picture_id, size)
+        try:
+            with open(f"{destination}.sha256") as recorded:
+                if recorded.read() == digest:
+                    logger.debug(f'Thumbnail {destination} is current, skipping')
+                    continue
+        except FileNotFoundError:
+            pass
+        yield filepath, size, destination, digest
+
+def make_thumbnail(source, size, destination, digest):
+    '''Resizes source to fit within size x size and records the source digest beside it'''
+    with Image.open(source) as original:
+        original.thumbnail((size, size))
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        original.save(f"{destination}.tmp", format='PNG')
+    os.replace(f"{destination}.tmp", destination)
+    with open(f"{destination}.sha256", 'w') as recorded:
+        recorded.write(digest)
+    return destination
+
+def generate_thumbnails(jobs, workers=THUMBNAIL_WORKERS):
+    '''
+    Runs thumbnail jobs on a process pool, keeping at most THUMBNAIL_QUEUE_SIZE jobs in flight.
+    workers=0 runs them in the calling process. Returns the number of thumbnails written.
+    '''
+    if Image is None:
+        for job in jobs:
+            logger.warning(f'Pillow is not installed, skipping thumbnail {job[2]}')
+        return 0
+    if workers == 0:
+        generated = 0
+        for job in jobs:
+            try:
+                make_thumbnail(*job)
+                generated += 1
+            except OSError as error:
+                logger.error(f'Unable to generate thumbnail: {error}')
+        return generated
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        generated = _count_thumbnails(bounded_submit(executor, make_thumbnail, jobs, THUMBNAIL_QUEUE_SIZE))
+    logger.info(f'Generated {generated} thumbnails')
+    return generated
+
+def bounded_submit(executor, func, jobs, limit):
+    '''Submits func(*job) for each job with at most limit in flight, yielding futures as they finish'''
+    pending = set()
+    for job in jobs:
+        if len(pending) >= limit:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from done
+        pending.add(executor.submit(func, *job))
+    yield from wait(pending).done
+
+def _count_thumbnails(futures):
+    '''Counts finished thumbnail jobs, logging any that failed'''
+    count = 0
+    for future in futures:
+        try:
+            logger.debug(f'Generated thumbnail {future.result()}')
+            count += 1
+        except OSError as error:
+            logger.error(f'Unable to generate thumbnail: {error}')
+    return count
+
 def find_next_image_id():
     '''Cycles through Picture IDs to find next unique ID'''
     counter = 1
@@ -57,26 +226,88 @@ def find_next_image_id():
             return next_unique_id
         counter += 1
 
+def tags_to_path(tags):
+    '''Converts a tag string such as "#golf #F1" into its sorted path form "F1/golf"'''
+    return "/".join(sorted(tags.replace('#', '').split()))
+
 def convert_tags_to_dir(tags, user_id):
     '''Converts tags into directory path'''
-    tags = tags.replace('#', '').split()
-    logger.debug(tags)
-    tags.sort()
-    output_dir = PICTURE_DIR+f"{user_id}/"+"/".join(tags)
+    output_dir = PICTURE_DIR+f"{user_id}/"+tags_to_path(tags)
     logger.debug(output_dir)
     return output_dir
 
+def shard_dir(picture_id):
+    '''Converts a picture_id into its fixed-depth hash shard directory'''
+    digest = hashlib.sha1(picture_id.encode()).hexdigest()
+    shards = [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+    return PICTURE_DIR + "/".join(shards)
+
+def image_dir(picture_id, user_id, tags, layout=None):
+    '''Returns the directory an image is stored in under the given (or current) layout'''
+    if (layout or STORAGE_LAYOUT) == SHARDED_LAYOUT:
+        return shard_dir(picture_id)
+    return convert_tags_to_dir(tags, user_id)
+
+def image_path(picture_id, user_id, tags, layout=None):
+    '''Returns the full file path of an image under the given (or current) layout'''
+    return os.path.join(image_dir(picture_id, user_id, tags, layout), f"{picture_id}.png")
+
+def ensure_dir(directory):
+    '''Creates directory once per process rather than once per image'''
+    if directory not in _known_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _known_dirs.add(directory)
+
+def write_image_file(filepath, content):
+    '''
+    Writes an image file from text, bytes or a source file Path and returns its sha256 digest.
+    Recreates the directory if it was removed since it was cached.
+    '''
+    try:
+        return _write_image_file(filepath, content)
+    except FileNotFoundError:
+        if os.path.isdir(os.path.dirname(filepath)):
+            raise
+        _known_dirs.discard(os.path.dirname(filepath))
+        ensure_dir(os.path.dirname(filepath))
+        return _write_image_file(filepath, content)
+
+def _write_image_file(filepath, content):
+    '''Writes content to filepath without any directory handling'''
+    if isinstance(content, Path):
+        shutil.copyfile(content, filepath)
+        return file_digest(filepath)
+    data = content.encode() if isinstance(content, str) else content
+    with open(filepath, 'wb') as new_image:
+        new_image.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+def file_digest(filepath):
+    '''Returns the sha256 of a file, read through mmap when large or in large chunks otherwise'''
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as image:
+        if os.fstat(image.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+        else:
+            for chunk in iter(lambda: image.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def path_to_record(file_path):
+    '''Converts a tag layout path 'pictures/user_id/tags.../file' into a (user_id, tags, file) tuple'''
+    parts = Path(os.path.relpath(file_path, PICTURE_DIR)).parts
+    return (sys.intern(parts[0]), sys.intern("/".join(parts[1:-1])), parts[-1])
+
 def list_user_images(_path, user_data):
     '''Creates list of all images on server based on user_id'''
     if _path.is_file():
         # Stop only at .png files
         if _path.suffix == '.png':
             logger.debug(f'Found file at {_path}')
-            final_path_data = str(_path).split('\\')
             # path follows the format 'pictures/user_id/tags/file'
-            # Second value is user_id, third-second to last is tags, last is image
-            file_data = (final_path_data[1], "/".join(final_path_data[2:-1]), final_path_data[-1])
-            logger.debug (f"Tuple generated for {final_path_data[1]}: {file_data}")
+            file_data = path_to_record(_path)
+            logger.debug (f"Tuple generated for {file_data[0]}: {file_data}")
             user_data.add(file_data)
     elif 'venv' in str(_path.absolute()):
         # Skip the venv folders
@@ -93,43 +324,360 @@ def list_db_images_by_user(user_id):
     image_ids = set()
     user_images = image_search_by_user(user_id)
     for image in user_images:
-        image_data = (image['user_id'], '/'.join(image['tags'].replace('#', "").split()), image['picture_id'])
+        # Rows share interned user_id strings; tag paths are interned so images with the same tags share one
+        image_data = (image.user_id, sys.intern(tags_to_path(image.tags)), f"{image.picture_id}.png")
         image_ids.add(image_data)
     return image_ids
 
-def reconcile_images(user_id):
-    '''Reconciles Pictures entries by User ID'''
+def iter_sharded_files():
+    '''Yields (picture_id, file path) for every image in the sharded tree'''
+    def walk(directory, depth):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if depth < SHARD_DEPTH and entry.is_dir() and len(entry.name) == SHARD_WIDTH:
+                    yield from walk(entry.path, depth + 1)
+                elif depth == SHARD_DEPTH and entry.name.endswith('.png'):
+                    yield entry.name[:-len('.png')], entry.path
+
+    if os.path.isdir(PICTURE_DIR):
+        yield from walk(PICTURE_DIR, 0)
+
+def list_sharded_images(user_id=None):
+    '''Creates (user_id, tags, file) tuples for the sharded tree, taking user and tags from the database'''
+    user_data = set()
+    picture_ids = [picture_id for picture_id, _ in iter_sharded_files()]
+    for start in range(0, len(picture_ids), LOOKUP_BATCH_SIZE):
+        batch = picture_ids[start:start + LOOKUP_BATCH_SIZE]
+        query = PictureTable.select(PictureTable.picture_id, PictureTable.user_id, PictureTable.tags)
+        if user_id is not None:
+            query = query.where(PictureTable.user_id == user_id)
+        rows = query.where(PictureTable.picture_id.in_(batch)).tuples()
+        found = set()
+        for picture_id, owner, tags in rows:
+            found.add(picture_id)
+            user_data.add((owner, tags_to_path(tags), f"{picture_id}.png"))
+        if user_id is None:
+            for picture_id in set(batch) - found:
+                logger.warning(f'Sharded image {picture_id} has no database row, owner unknown')
+                user_data.add(('', '', f"{picture_id}.png"))
+    return user_data
+
+def set_server_image_source(source):
+    '''Registers a function(user_id) answering list_server_images, or None to walk the tree again'''
+    global SERVER_IMAGE_SOURCE  # pylint: disable=W0603
+    SERVER_IMAGE_SOURCE = source
+
+def set_image_added_hook(hook):
+    '''Registers a function(picture_id, tags) called for each image stored, or None to stop'''
+    global IMAGE_ADDED_HOOK  # pylint: disable=W0603
+    IMAGE_ADDED_HOOK = hook
+
+def list_server_images(user_id):
+    '''Lists a user's images on the server under the current layout'''
+    if SERVER_IMAGE_SOURCE is not None:
+        return SERVER_IMAGE_SOURCE(user_id)
+    if STORAGE_LAYOUT == SHARDED_LAYOUT:
+        return list_sharded_images(user_id)
+    start_path = Path(PICTURE_DIR) / user_id
+    if not start_path.exists():
+        return set()
+    return list_user_images(start_path, set())
+
+def migrate_storage(to_layout):
+    '''Moves every image known to the database into to_layout and prunes emptied directories'''
+    from_layout = SHARDED_LAYOUT if to_layout == TAG_LAYOUT else TAG_LAYOUT
+    summary = {'moved': 0, 'missing': 0}
+    rows = PictureTable.select(PictureTable.picture_id, PictureTable.user_id, PictureTable.tags).tuples()
+    for picture_id, user_id, tags in rows.iterator():
+        source = image_path(picture_id, user_id, tags, from_layout)
+        if not os.path.isfile(source):
+            logger.warning(f'Image {picture_id} not found at {source}, skipping')
+            summary['missing'] += 1
+            continue
+        destination_dir = image_dir(picture_id, user_id, tags, to_layout)
+        ensure_dir(destination_dir)
+        os.replace(source, os.path.join(destination_dir, f"{picture_id}.png"))
+        summary['moved'] += 1
+    prune_empty_dirs(PICTURE_DIR)
+    set_storage_layout(to_layout)
+    logger.info(f'Migrated pictures from {from_layout} to {to_layout} layout: {summary}')
+    return summary
+
+def prune_empty_dirs(directory):
+    '''Removes empty directories below directory, bottom up'''
+    for current, _, _ in os.walk(directory, topdown=False):
+        if current != directory and not os.listdir(current):
+            os.rmdir(current)
+            _known_dirs.discard(current)
+
+def set_storage_layout(layout):
+    '''Switches the layout used by add_image, list_server_images and reconcile_images'''
+    global STORAGE_LAYOUT  # pylint: disable=W0603
+    if layout not in (TAG_LAYOUT, SHARDED_LAYOUT):
+        raise ValueError(f'Unknown storage layout: {layout}')
+    STORAGE_LAYOUT = layout
+
+def record_key(record):
+    '''Merge key for a (user_id, tags, file) record, matching a sorted depth-first walk of the tag layout'''
+    user_id, tags, filename = record
+    return (user_id, tuple(tags.split('/')) if tags else (), filename)
+
+def iter_db_records(rows=None):
+    '''
+    Streams every picture row as (user_id, tags, file), ordered by record_key.
+    rows may be any (user_id, tags, picture_id) iterable ordered by user_id; it defaults to PictureTable.
+    '''
+    if rows is None:
+        rows = (PictureTable.select(PictureTable.user_id, PictureTable.tags, PictureTable.picture_id)
+                .order_by(PictureTable.user_id, PictureTable.picture_id).tuples().iterator())
+    # Only one user's rows are held at a time to order them by tag path
+    for _, user_rows in groupby(rows, key=lambda row: row[0]):
+        records = [(user_id, tags_to_path(tags), f"{picture_id}.png") for user_id, tags, picture_id in user_rows]
+        yield from sorted(records, key=record_key)
+
+def iter_server_records(directory=None, user_id=None, tags=()):
+    '''Streams every tag layout image as (user_id, tags, file), ordered by record_key'''
+    directory = directory or PICTURE_DIR
+    if not os.path.isdir(directory):
+        return
+    with os.scandir(directory) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    if user_id is None:
+        for entry in entries:
+            if entry.is_dir() and entry.name != 'venv':
+                yield from iter_server_records(entry.path, entry.name)
+        return
+    # Files in a directory sort before anything in its subdirectories
+    for entry in entries:
+        if entry.is_file() and entry.name.endswith('.png'):
+            yield (user_id, "/".join(tags), entry.name)
+    for entry in entries:
+        if entry.is_dir():
+            yield from iter_server_records(entry.path, user_id, tags + (entry.name,))
+
+def merge_reconcile(db_records, server_records):
+    '''Merge-joins two record streams ordered by record_key, yielding each record found on only one side'''
+    missing = object()
+    db_record = next(db_records, missing)
+    server_record = next(server_records, missing)
+    while db_record is not missing or server_record is not missing:
+        if server_record is missing or (db_record is not missing and record_key(db_record) < record_key(server_record)):
+            yield 'missing_from_server', db_record
+            db_record = next(db_records, missing)
+        elif db_record is missing or record_key(server_record) < record_key(db_record):
+            yield 'missing_from_db', server_record
+            server_record = next(server_records, missing)
+        else:
+            db_record = next(db_records, missing)
+            server_record = next(server_records, missing)
+
+def reconcile_sharded():
+    '''Streams differences for the sharded layout, checking each side against the other in batches'''
+    def leaf_batches():
+        batch = []
+        for picture_id, _ in iter_sharded_files():
+            batch.append(picture_id)
+            if len(batch) >= LOOKUP_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    for batch in leaf_batches():
+        query = PictureTable.select(PictureTable.picture_id).where(PictureTable.picture_id.in_(batch))
+        found = {picture_id for picture_id, in query.tuples()}
+        for picture_id in sorted(set(batch) - found):
+            yield 'missing_from_db', ('', '', f"{picture_id}.png")
+    rows = PictureTable.select(PictureTable.user_id, PictureTable.tags, PictureTable.picture_id).tuples()
+    for user_id, tags, picture_id in rows.iterator():
+        if not os.path.isfile(image_path(picture_id, user_id, tags, SHARDED_LAYOUT)):
+            yield 'missing_from_server', (user_id, tags_to_path(tags), f"{picture_id}.png")
+
+def reconcile_all_images():
+    '''
+    Reconciles every user in one pass. Yields (difference, (user_id, tags, file)) pairs,
+    where difference is 'missing_from_db' or 'missing_from_server'.
+    '''
+    if STORAGE_LAYOUT == SHARDED_LAYOUT:
+        return reconcile_sharded()
+    return merge_reconcile(iter_db_records(), iter_server_records())
+
+def hash_image(picture_id, filepath, stat):
+    '''Hashes one image for verify_images, returning (picture_id, digest, stat)'''
+    return picture_id, file_digest(filepath), stat
+
+def verify_images(user_id=None, workers=CHECKSUM_WORKERS):
+    '''
+    Compares image contents with the checksum recorded in the Pictures table.
+    Files whose mtime and size match the last verification are not re-read; the rest are
+    hashed on a thread pool. Rows without a checksum record the current one.
+    Returns a set of (user_id, tags, file) tuples whose contents no longer match.
+    '''
+    query = PictureTable.select(PictureTable.picture_id, PictureTable.user_id, PictureTable.tags,
+                                PictureTable.checksum, PictureTable.checksum_mtime, PictureTable.checksum_size)
+    if user_id is not None:
+        query = query.where(PictureTable.user_id == user_id)
+    rows = {}
+
+    def jobs():
+        for picture_id, owner, tags, checksum, mtime, size in query.tuples().iterator():
+            filepath = image_path(picture_id, owner, tags)
+            try:
+                stat = os.stat(filepath)
+            except FileNotFoundError:
+                continue  # reported by reconcile_images as missing_from_server
+            if checksum is not None and (stat.st_mtime, stat.st_size) == (mtime, size):
+                continue
+            rows[picture_id] = (owner, tags, checksum)
+            yield picture_id, filepath, stat
+
+    mismatches = set()
+    updates = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in bounded_submit(executor, hash_image, jobs(), CHECKSUM_QUEUE_SIZE):
+            picture_id, digest, stat = future.result()
+            owner, tags, checksum = rows.pop(picture_id)
+            if checksum is not None and digest != checksum:
+                logger.warning(f'Image {picture_id} content does not match its recorded checksum')
+                mismatches.add((owner, tags_to_path(tags), f"{picture_id}.png"))
+            else:
+                updates.append((picture_id, digest, stat))
+    with db.atomic():
+        for picture_id, digest, stat in updates:
+            (PictureTable.update(checksum=digest, checksum_mtime=stat.st_mtime, checksum_size=stat.st_size)
+             .where(PictureTable.picture_id == picture_id).execute())
+    logger.info(f'Verified {len(updates) + len(mismatches)} images, {len(mismatches)} mismatched')
+    return mismatches
+
+def reconcile_images(user_id, verify=False):
+    '''Reconciles Pictures entries by User ID. verify=True also reports content_mismatch'''
     db_images = list_db_images_by_user(user_id)
-    server_images = list_user_images(path, user_id)
+    server_images = list_server_images(user_id)
     if db_images == server_images:
         logger.info(f'Server and Database contain the same images: {db_images}')
     else:
         logger.info(f'Server and Database diverge:\n Server Images: {server_images}\nDatabase Images: {db_images}')
     image_diff = {'missing_from_db': server_images.difference(db_images),
                   'missing_from_server': db_images.difference(server_images)}
+    if verify:
+        image_diff['content_mismatch'] = verify_images(user_id)
     return image_diff
 
+def path_to_tags(tags_path):
+    '''Converts a sorted tag path "F1/golf" back into a tag string "#F1 #golf"'''
+    return " ".join(f"#{tag}" for tag in tags_path.split('/') if tag)
+
+def _batches(records, size):
+    '''Splits an iterable into lists of at most size items'''
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _insert_missing_rows(batch, dry_run):
+    '''Inserts rows for files missing from the database, returning (inserted, skipped)'''
+    user_ids = {user_id for user_id, _, _ in batch}
+    known = {user_id for user_id, in UserTable.select(UserTable.user_id)
+             .where(UserTable.user_id.in_(list(user_ids))).tuples()}
+    rows = [{'picture_id': filename[:-len('.png')], 'user_id': user_id, 'tags': path_to_tags(tags)}
+            for user_id, tags, filename in batch if user_id in known]
+    for user_id, _, filename in batch:
+        if user_id not in known:
+            logger.warning(f'Cannot add {filename} to the database, user {user_id!r} does not exist')
+    if rows and not dry_run:
+        with db.atomic():
+            PictureTable.insert_many(rows).on_conflict_ignore().execute()
+    return len(rows), len(batch) - len(rows)
+
+def _restore_file(user_id, tags_path, filename):
+    '''Writes a placeholder file for a row whose file is missing, as add_image does without a source'''
+    picture_id = filename[:-len('.png')]
+    tags = path_to_tags(tags_path)
+    filepath = image_path(picture_id, user_id, tags)
+    ensure_dir(os.path.dirname(filepath))
+    write_image_file(filepath, str({'picture_id': picture_id, 'user_id': user_id, 'tags': tags}))
+    return filepath
+
+def _repair_missing_files(records, policy, dry_run, executor, workers):
+    '''Applies policy to rows whose file is missing from the server, returning summary counts'''
+    if policy == IGNORE_POLICY:
+        return {'skipped': len(records)}
+    if policy == DELETE_POLICY:
+        if records and not dry_run:
+            picture_ids = [filename[:-len('.png')] for _, _, filename in records]
+            with db.atomic():
+                # pylint: disable=E1120
+                PictureTable.delete().where(PictureTable.picture_id.in_(picture_ids)).execute()
+        return {'deleted': len(records)}
+    if not dry_run:
+        for future in bounded_submit(executor, _restore_file, records, workers):
+            logger.debug(f'Restored {future.result()}')
+    return {'restored': len(records)}
+
+def repair_images(image_diff, policy=RESTORE_POLICY, dry_run=False, workers=REPAIR_WORKERS,
+                  progress=None):  # pylint: disable=R0913,R0917
+    '''
+    Fixes differences found by reconcile_images (a dict) or reconcile_all_images (a stream of pairs).
+    Files missing from the database get rows, inserted in batched transactions. Rows whose file is
+    missing from the server are restored as placeholder files, deleted, or left alone, per policy.
+    dry_run counts what would change without changing it; progress(done, total) is called per batch.
+    Returns a summary of the counts.
+    '''
+    if policy not in (RESTORE_POLICY, DELETE_POLICY, IGNORE_POLICY):
+        raise ValueError(f'Unknown repair policy: {policy}')
+    if isinstance(image_diff, dict):
+        pairs = [(difference, record) for difference, records in image_diff.items()
+                 if difference in ('missing_from_db', 'missing_from_server') for record in records]
+    else:
+        pairs = list(image_diff)
+    summary = {'inserted': 0, 'restored': 0, 'deleted': 0, 'skipped': 0, 'dry_run': dry_run}
+    done = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in _batches(pairs, REPAIR_BATCH_SIZE):
+            missing_from_db = [record for difference, record in batch if difference == 'missing_from_db']
+            if missing_from_db:
+                counts = _insert_missing_rows(missing_from_db, dry_run)
+                summary['inserted'] += counts[0]
+                summary['skipped'] += counts[1]
+            missing_from_server = [record for difference, record in batch if difference == 'missing_from_server']
+            for key, count in _repair_missing_files(missing_from_server, policy, dry_run, executor, workers).items():
+                summary[key] += count
+            done += len(batch)
+            logger.info(f'Repaired {done}/{len(pairs)} image differences')
+            if progress is not None:
+                progress(done, len(pairs))
+    logger.info(f'Image repair finished: {summary}')
+    return summary
+
 
 # Search Images
 def search_image():
     '''Curries the search function to the Pictures table, then searches for picture_id in that table'''
-    _image_search = search_table(Pictures)
+    _image_search = lookup_table(Pictures, 'picture_id', PictureRow)
 
     # All we want for this inner function is picture_id and we can now search for it
     def search(picture_id):
         nonlocal _image_search
-        return _image_search(picture_id=picture_id)
+        return _image_search(picture_id)
 
     return search
 image_search = search_image()
 
+# Search many Pictures by picture_id, returning (pictures found in input order, missing picture_ids)
+images_search = lookup_many_table(Pictures, 'picture_id', PictureRow)
+
 def search_images_by_user():
     '''Returns list of Pictures entries by User ID'''
-    _image_search = search_table_for_many(Pictures)
+    _image_search = lookup_table(Pictures, 'user_id', PictureRow, many=True)
 
     def search(user_id):
         nonlocal _image_search
-        return _image_search(user_id=user_id)
+        return _image_search(user_id)
 
     return search
 image_search_by_user = search_images_by_user()
@@ -0,0 +1,195 @@
+'''
+Background jobs for long-running reconcile and load operations.
+
+Clients submit a job and poll it by ID; a separate worker process claims queued jobs from the
+job table and runs them on a pool of threads. Submitting a job identical to one that is still
+queued or running returns the existing job instead of starting another.
+
+A claim is a lease: the worker renews it while the job runs, and only a job whose lease has lapsed
+(its worker stopped) is put back in the queue, so starting another worker never reruns a live job.
+
+Run the worker with: python jobs.py [workers]
+'''
+# pylint: disable=E1120
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+import main
+import changelog
+from socialnetwork_model import db, JobTable
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+WORKERS = 4
+POLL_INTERVAL = 0.5
+PROGRESS_EVERY = 500
+LEASE_SECONDS = 30
+# Jobs run outside run_worker, such as run_next_job from a test or a script, are claimed as this process
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _reconcile(params, progress):
+    '''Reconciles one user, or every user when no user_id is given'''
+    if params.get('user_id'):
+        image_diff = main.reconcile_images(params['user_id'], params.get('verify', False))
+        return {key: sorted(value) for key, value in image_diff.items()}
+    differences = []
+    for difference, record in main.reconcile_all_images():
+        differences.append({'difference': difference, 'user_id': record[0], 'tags': record[1], 'file': record[2]})
+        if len(differences) % PROGRESS_EVERY == 0:
+            progress(len(differences))
+    return differences
+
+
+def _load(load_function):
+    '''Wraps a main.load_* function as a job taking a filename'''
+    def load(params, _progress):
+        return {'loaded': load_function(params['filename'])}
+    return load
+
+
+# Job kinds: function(params, progress) returning a JSON-serializable result
+JOB_KINDS = {
+    'reconcile': _reconcile,
+    'load_users': _load(main.load_users),
+    'load_statuses': _load(main.load_statuses),
+    'load_images': _load(main.load_images),
+    'compact_changelog': lambda params, _progress: changelog.compact_changelog(**params),
+}
+
+
+def submit_job(kind, params=None):
+    '''
+    Queues a job, or finds the queued or running job with the same kind and params.
+    Returns (job_id, deduplicated).
+    '''
+    if kind not in JOB_KINDS:
+        raise ValueError(f'Unknown job kind: {kind}')
+    params = params or {}
+    dedup_key = f"{kind}:{json.dumps(params, sort_keys=True)}"
+    with db.atomic('IMMEDIATE'):
+        existing = (JobTable.select(JobTable.job_id)
+                    .where((JobTable.dedup_key == dedup_key) & (JobTable.status.in_([QUEUED, RUNNING])))
+                    .order_by(JobTable.job_id).first())
+        if existing is not None:
+            logger.info(f'Job {kind} {params} is already queued as {existing.job_id}')
+            return existing.job_id, True
+        job_id = JobTable.insert(kind=kind, params=json.dumps(params), dedup_key=dedup_key,
+                                 created_at=datetime.now()).execute()
+    logger.info(f'Queued job {job_id}: {kind} {params}')
+    return job_id, False
+
+
+def job_status(job_id):
+    '''Returns a job as a dict with its params and result decoded, or None'''
+    job = JobTable.get_or_none(JobTable.job_id == job_id)
+    if job is None:
+        return None
+    return {'job_id': job.job_id, 'kind': job.kind, 'params': json.loads(job.params), 'status': job.status,
+            'progress': job.progress, 'result': None if job.result is None else json.loads(job.result),
+            'error': job.error, 'created_at': str(job.created_at),
+            'started_at': None if job.started_at is None else str(job.started_at),
+            'finished_at': None if job.finished_at is None else str(job.finished_at)}
+
+
+def lease_expiry():
+    '''When a lease taken or renewed now lapses'''
+    return datetime.now() + timedelta(seconds=LEASE_SECONDS)
+
+
+def claim_job(worker=WORKER_ID):
+    '''Marks the oldest queued job as running under worker's lease and returns it, or None'''
+    with db.atomic('IMMEDIATE'):
+        job = JobTable.select().where(JobTable.status == QUEUED).order_by(JobTable.job_id).first()
+        if job is None:
+            return None
+        JobTable.update(status=RUNNING, started_at=datetime.now(), worker=worker, lease_until=lease_expiry()).where(
+            JobTable.job_id == job.job_id).execute()
+    job.worker = worker
+    return job
+
+
+def renew_leases(worker):
+    '''Extends the lease on every job worker is running. Returns how many were renewed'''
+    return JobTable.update(lease_until=lease_expiry()).where(
+        (JobTable.worker == worker) & (JobTable.status == RUNNING)).execute()
+
+
+def run_job(job):
+    '''Runs a claimed job and records its result or error'''
+    # Results are only recorded while this worker still holds the job
+    owned = (JobTable.job_id == job.job_id) & (JobTable.worker == job.worker)
+
+    def progress(count):
+        JobTable.update(progress=count).where(owned).execute()
+
+    logger.info(f'Running job {job.job_id}: {job.kind} {job.params}')
+    try:
+        result = JOB_KINDS[job.kind](json.loads(job.params), progress)
+        JobTable.update(status=DONE, result=json.dumps(result), finished_at=datetime.now()).where(owned).execute()
+        logger.info(f'Job {job.job_id} finished')
+    except Exception as error:  # pylint: disable=W0718
+        # A failing job must not take the worker down; the error is reported to whoever polls it
+        JobTable.update(status=FAILED, error=repr(error), finished_at=datetime.now()).where(owned).execute()
+        logger.error(f'Job {job.job_id} failed: {error!r}')
+
+
+def run_next_job(worker=WORKER_ID):
+    '''Claims and runs one queued job in this thread. Returns False if none was queued'''
+    job = claim_job(worker)
+    if job is None:
+        return False
+    run_job(job)
+    return True
+
+
+def requeue_interrupted_jobs():
+    '''Puts jobs whose worker stopped renewing their lease back in the queue'''
+    count = JobTable.update(status=QUEUED, started_at=None, worker=None, lease_until=None).where(
+        (JobTable.status == RUNNING)
+        & (JobTable.lease_until.is_null() | (JobTable.lease_until < datetime.now()))).execute()
+    if count:
+        logger.warning(f'Requeued {count} interrupted jobs')
+    return count
+
+
+def run_worker(workers=WORKERS, stop=None):
+    '''
+    Runs queued jobs on a pool of worker threads until stop is set, renewing their leases and
+    requeueing jobs whose lease lapsed
+    '''
+    stop = stop or threading.Event()
+    worker_id = f'{WORKER_ID}:{uuid.uuid4().hex[:8]}'
+    requeue_interrupted_jobs()
+    logger.info(f'Job worker {worker_id} started with {workers} threads')
+
+    def worker():
+        while not stop.is_set():
+            if not run_next_job(worker_id):
+                stop.wait(POLL_INTERVAL)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in range(workers):
+            executor.submit(worker)
+        try:
+            while not stop.is_set():
+                time.sleep(POLL_INTERVAL)
+                renew_leases(worker_id)
+                requeue_interrupted_jobs()
+        except KeyboardInterrupt:
+            stop.set()
+
+
+if __name__ == '__main__':
+    run_worker(int(sys.argv[1]) if len(sys.argv) > 1 else WORKERS)
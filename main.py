@@ -1,13 +1,14 @@
 '''
 main driver for a simple social network project
 '''
-from pathlib import Path
 
 from loguru import logger
 
 import users
 import user_status
 import images
+import socialnetwork_model
+import tag_index
 
 
 def load_users(filename):
@@ -34,11 +35,26 @@ def load_statuses(filename):
 
 def load_images(filename):
     '''
-    Loads csv to database
+    Loads csv to database. An optional third column names a source image file.
     '''
     return images.load_images(filename)
 
 
+def export_users(filename):
+    '''Writes every user to a csv that load_users can read back. Returns how many were written'''
+    return users.export_users(filename)
+
+
+def export_statuses(filename):
+    '''Writes every status to a csv that load_statuses can read back. Returns how many were written'''
+    return user_status.export_statuses(filename)
+
+
+def export_images(filename):
+    '''Writes every picture's user and tags to a csv that load_images can read back. Returns how many were written'''
+    return images.export_images(filename)
+
+
 def add_user(user_id, email, user_name, user_last_name):
     '''
     Creates a new instance of User and stores it in user_collection
@@ -101,6 +117,50 @@ def search_user(user_id):
     return None
 
 
+def find_users(prefix=None, email_domain=None, limit=users.FIND_LIMIT):
+    '''
+    Finds users by the start of their first name, last name or email, by email domain, or both
+
+    Requirements:
+    - Matching is case-insensitive; a domain also matches its subdomains.
+    - Returns up to limit users sorted by last then first name.
+    - Raises ValueError if neither prefix nor email_domain is given.
+    '''
+    found = users.find_users(prefix, email_domain, limit)
+    logger.info(f"main.find_users() found {len(found)} users for prefix={prefix!r} email_domain={email_domain!r}")
+    return found
+
+
+def search_users(user_ids):
+    '''
+    Searches for many users in one call
+
+    Requirements:
+    - Returns (users, missing): the users found, in the order their IDs were given,
+      and the user_ids that were not found.
+    - Repeated IDs are only looked up and returned once.
+    '''
+    found, missing = users.users_search(user_ids)
+    logger.info(f"main.search_users() found {len(found)} users, {len(missing)} missing")
+    return found, missing
+
+
+def user_summary(user_id):
+    '''
+    Returns the user's status count, picture count and last activity from their summary row,
+    or None if the user does not exist.
+    '''
+    return users.summary_search(user_id)
+
+
+def rebuild_user_summaries(verify_only=False):
+    '''
+    Recounts every user's summary counters, returning a list of (user_id, counter, stored, actual)
+    for any that had drifted. verify_only reports drift without fixing it.
+    '''
+    return socialnetwork_model.rebuild_user_summaries(verify_only)
+
+
 def add_status(user_id, status_id, status_text):
     '''
     Adds a new status to the database.
@@ -164,20 +224,85 @@ def search_status(status_id):
     logger.error(f"main.search_status is returning None for {status_id})")
     return None
 
-def add_image(user_id, tags):
-    '''Adds image to Pictures table using supplied information'''
+
+def search_statuses(status_ids):
+    '''
+    Searches for many statuses in one call
+
+    Requirements:
+    - Returns (statuses, missing): the statuses found, in the order their IDs were given,
+      and the status_ids that were not found.
+    - Repeated IDs are only looked up and returned once.
+    '''
+    found, missing = user_status.statuses_search(status_ids)
+    logger.info(f"main.search_statuses() found {len(found)} statuses, {len(missing)} missing")
+    return found, missing
+
+
+def user_timeline(user_id, before=None, limit=user_status.TIMELINE_PAGE_SIZE):
+    '''
+    Returns up to limit of a user's statuses, newest first
+
+    Requirements:
+    - Each status carries its seq; pass the last one as before to get the next, older page.
+    - An unknown user, or a page past their oldest status, returns an empty list.
+    '''
+    statuses = user_status.status_timeline(user_id, before, limit)
+    logger.info(f"main.user_timeline() returned {len(statuses)} statuses for {user_id} before {before}")
+    return statuses
+
+
+def search_pictures(picture_ids):
+    '''
+    Searches for many pictures in one call, returning (pictures in the order their IDs were given, missing IDs)
+    '''
+    found, missing = images.images_search(picture_ids)
+    logger.info(f"main.search_pictures() found {len(found)} pictures, {len(missing)} missing")
+    return found, missing
+
+def search_tags(query, limit=tag_index.QUERY_LIMIT):
+    '''
+    Finds pictures by a boolean tag query such as "#skiing AND (#golf OR #F1) AND NOT #snowboarding"
+
+    Requirements:
+    - Returns {'count': pictures matching, 'picture_ids': up to limit of them, newest first}.
+    - Raises tag_index.TagQueryError for a malformed query.
+    '''
+    result = tag_index.search(query, limit)
+    logger.info(f"main.search_tags() matched {result['count']} pictures for {query!r}")
+    return result
+
+def add_image(user_id, tags, source=None):
+    '''Adds image to Pictures table using supplied information. source is an image file path or bytes'''
     picture_data = {'user_id': user_id,
-                    'tags': tags}
+                    'tags': tags,
+                    'source': source}
     return images.add_image(**picture_data)
 
 def list_user_images(user_id):
     '''Generates list of tuples with image data by user_id'''
-    user_data = set()
-    start_path = Path(images.PICTURE_DIR) / user_id
-    images.list_user_images(start_path, user_data)
+    user_data = images.list_server_images(user_id)
     logger.info(f"List of tuples generated: {user_data}")
     return user_data
 
-def reconcile_images(user_id):
-    '''Generates list of Pictures entries by User ID'''
-    images.reconcile_images(user_id)
+def reconcile_images(user_id, verify=False):
+    '''Generates list of Pictures entries by User ID. verify=True also checks file contents'''
+    return images.reconcile_images(user_id, verify)
+
+def reconcile_all_images():
+    '''
+    Streams (difference, (user_id, tags, file)) pairs for every user in one pass,
+    where difference is 'missing_from_db' or 'missing_from_server'
+    '''
+    return images.reconcile_all_images()
+
+def repair_images(image_diff, policy='restore', dry_run=False, progress=None):
+    '''
+    Fixes the differences returned by reconcile_images or reconcile_all_images.
+    policy decides whether rows missing their file are 'restore'd, 'delete'd or 'ignore'd.
+    '''
+    return images.repair_images(image_diff, policy, dry_run, progress=progress)
+
+def migrate_images(to_layout):
+    '''Moves the pictures directory to another storage layout ('tags' or 'sharded')'''
+    return images.migrate_storage(to_layout)
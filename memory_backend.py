@@ -0,0 +1,244 @@
+'''
+In-memory storage backend for the curried table helpers in socialnetwork_model.
+
+MemoryDataSet builds one MemoryTable per peewee model and implements the part of playhouse's
+DataSet Table interface that insert_table, search_table, update_table, delete_table and
+search_table_for_many rely on. Rows live in a dict keyed by primary key, with a dict index per
+foreign key, so point lookups, cascading deletes and foreign key checks never scan a table.
+Constraint failures raise peewee's IntegrityError, as SQLite would.
+
+The summary and version triggers only exist in SQLite; nothing maintains those tables here.
+'''
+# pylint: disable=W0212
+import operator
+import threading
+
+from peewee import IntegrityError, ForeignKeyField
+
+
+class MemoryTable:
+    '''One table's rows, keyed by primary key, with dict indexes on foreign keys and create_index columns'''
+
+    def __init__(self, dataset, model):
+        self.dataset = dataset
+        self.name = model._meta.table_name
+        self.fields = {field.column_name: field for field in model._meta.sorted_fields}
+        self.primary_key = model._meta.primary_key.column_name
+        self.foreign_keys = {field.column_name: field for field in model._meta.sorted_fields
+                             if isinstance(field, ForeignKeyField)}
+        self.rows = {}
+        # {column: {value: {primary key: None}}}, kept in insertion order like SQLite's rowids.
+        # The primary key is looked up in rows directly
+        self.indexes = {column: {} for column in self.foreign_keys if column != self.primary_key}
+        self.unique = set()
+
+    @property
+    def columns(self):
+        '''Column names, in model order'''
+        return list(self.fields)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _coerce(self, column, value):
+        '''Converts value the way a round trip through SQLite would for a known column'''
+        field = self.fields.get(column)
+        if field is None or value is None:
+            return value
+        return field.python_value(field.db_value(value))
+
+    def _new_row(self, data):
+        '''A complete row from insert data: defaults filled in, values coerced and NOT NULL checked'''
+        row = {}
+        for column, field in self.fields.items():
+            if column in data:
+                value = self._coerce(column, data[column])
+            else:
+                value = field.default() if callable(field.default) else field.default
+            if value is None and not field.null:
+                raise IntegrityError(f'NOT NULL constraint failed: {self.name}.{column}')
+            row[column] = value
+        # Like DataSet, columns the model doesn't know are kept as given
+        row.update({column: value for column, value in data.items() if column not in self.fields})
+        return row
+
+    def _keys_where(self, column, value):
+        '''Primary keys with row[column] == value from an index, or None if column isn't indexed'''
+        if column == self.primary_key:
+            return (value,) if value in self.rows else ()
+        if column in self.indexes:
+            return self.indexes[column].get(value, {})
+        return None
+
+    def _matching(self, query):
+        '''Primary keys of every row matching all of query's column == value terms'''
+        query = {column: self._coerce(column, value) for column, value in query.items()}
+        # Only the smallest index hit is walked; the rest of the query is checked row by row
+        candidates = self.rows
+        for column, value in query.items():
+            keys = self._keys_where(column, value)
+            if keys is not None and len(keys) < len(candidates):
+                candidates = keys
+        return [key for key in candidates
+                if all(self.rows[key].get(column) == value for column, value in query.items())]
+
+    def _check_row(self, row, key):
+        '''Raises IntegrityError if row, stored under key, breaks a unique or foreign key constraint'''
+        for column in self.unique:
+            if any(other != key for other in self.indexes[column].get(row.get(column), ())):
+                raise IntegrityError(f'UNIQUE constraint failed: {self.name}.{column}')
+        for column, field in self.foreign_keys.items():
+            value = row[column]
+            if value is not None and value not in self.dataset[field.rel_model._meta.table_name].rows:
+                raise IntegrityError('FOREIGN KEY constraint failed')
+
+    def _index(self, key, row):
+        for column, index in self.indexes.items():
+            index.setdefault(row.get(column), {})[key] = None
+
+    def _unindex(self, key, row):
+        for column, index in self.indexes.items():
+            keys = index.get(row.get(column))
+            if keys is not None:
+                keys.pop(key, None)
+                if not keys:
+                    del index[row.get(column)]
+
+    def insert(self, **data):
+        '''Inserts a row and returns its primary key'''
+        with self.dataset.lock:
+            row = self._new_row(data)
+            key = row[self.primary_key]
+            if key in self.rows:
+                raise IntegrityError(f'UNIQUE constraint failed: {self.name}.{self.primary_key}')
+            self._check_row(row, key)
+            self.rows[key] = row
+            self._index(key, row)
+            return key
+
+    def find_one(self, **query):
+        '''First row matching query as a dict, or None'''
+        with self.dataset.lock:
+            keys = self._matching(query)
+            return dict(self.rows[keys[0]]) if keys else None
+
+    def find(self, **query):
+        '''Every row matching query, as dicts'''
+        with self.dataset.lock:
+            return [dict(self.rows[key]) for key in self._matching(query)]
+
+    def all(self):
+        '''Every row, as dicts'''
+        with self.dataset.lock:
+            return [dict(row) for row in self.rows.values()]
+
+    def update(self, columns=None, conjunction=None, **data):
+        '''
+        Updates rows where each of columns equals its value in data, setting the rest of data.
+        Every row is updated when columns is empty. Returns the number of rows updated.
+        '''
+        if conjunction not in (None, operator.and_):
+            raise ValueError('MemoryTable only supports AND conjunctions')
+        columns = columns or []
+        query = {column: data[column] for column in columns}
+        changes = {column: self._coerce(column, value) for column, value in data.items() if column not in columns}
+        with self.dataset.lock:
+            keys = self._matching(query)
+            updated = {key: {**self.rows[key], **changes} for key in keys}
+            for key, row in updated.items():
+                new_key = row[self.primary_key]
+                if any(value is None and not self.fields[column].null
+                       for column, value in row.items() if column in self.fields):
+                    raise IntegrityError(f'NOT NULL constraint failed: {self.name}')
+                if new_key != key:
+                    if new_key in self.rows and new_key not in updated:
+                        raise IntegrityError(f'UNIQUE constraint failed: {self.name}.{self.primary_key}')
+                    if self.dataset.referencing(self, key):
+                        raise IntegrityError('FOREIGN KEY constraint failed')
+                self._check_row(row, key)
+            for key in keys:
+                self._unindex(key, self.rows.pop(key))
+            for row in updated.values():
+                self.rows[row[self.primary_key]] = row
+                self._index(row[self.primary_key], row)
+            return len(keys)
+
+    def delete(self, **query):
+        '''Deletes rows matching query, or every row, cascading to child tables. Returns the count'''
+        with self.dataset.lock:
+            keys = self._matching(query)
+            self.dataset.check_delete(self, keys)
+            self.delete_keys(keys)
+            return len(keys)
+
+    def delete_keys(self, keys):
+        '''Removes rows by primary key, after their children. Callers hold the dataset lock'''
+        for child, column in self.dataset.children[self.name]:
+            child_keys = [child_key for key in keys for child_key in child._keys_where(column, key)]
+            child.delete_keys(list(dict.fromkeys(child_keys)))
+        for key in keys:
+            self._unindex(key, self.rows.pop(key))
+
+    def create_index(self, columns, unique=False):
+        '''Indexes a single column for lookups, optionally enforcing uniqueness'''
+        if len(columns) != 1:
+            raise ValueError('MemoryTable indexes cover a single column')
+        column = columns[0]
+        if column == self.primary_key:
+            return
+        with self.dataset.lock:
+            if column not in self.indexes:
+                self.indexes[column] = {}
+                for key, row in self.rows.items():
+                    self.indexes[column].setdefault(row.get(column), {})[key] = None
+            if unique:
+                if any(len(keys) > 1 for value, keys in self.indexes[column].items() if value is not None):
+                    raise IntegrityError(f'UNIQUE constraint failed: {self.name}.{column}')
+                self.unique.add(column)
+
+
+class MemoryDataSet:
+    '''MemoryTables for a list of peewee models, sharing one lock so cascades are atomic'''
+
+    def __init__(self, models):
+        self.lock = threading.RLock()
+        self.tables = {model._meta.table_name: MemoryTable(self, model) for model in models}
+        # {parent table: [(child MemoryTable, foreign key column)]}
+        self.children = {name: [] for name in self.tables}
+        for table in self.tables.values():
+            for column, field in table.foreign_keys.items():
+                self.children[field.rel_model._meta.table_name].append((table, column))
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def referencing(self, table, key):
+        '''True if any child row points at key in table'''
+        return any(child._keys_where(column, key) for child, column in self.children[table.name])
+
+    def check_delete(self, table, keys):
+        '''Raises IntegrityError if deleting keys would orphan rows whose foreign key doesn't cascade'''
+        for child, column in self.children[table.name]:
+            child_keys = [child_key for key in keys for child_key in child._keys_where(column, key)]
+            if child_keys and child.foreign_keys[column].on_delete != 'CASCADE':
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            self.check_delete(child, child_keys)
+
+    def clear(self):
+        '''Empties every table'''
+        with self.lock:
+            for table in self.tables.values():
+                table.rows.clear()
+                for column in table.indexes:
+                    table.indexes[column] = {}
+
+    def warm(self, source):
+        '''Loads every table's rows from source, a DataSet over the SQLite database, parents first'''
+        with self.lock:
+            self.clear()
+            for name, table in self.tables.items():
+                for row in source[name].all():
+                    key = row[table.primary_key]
+                    table.rows[key] = row
+                    table._index(key, row)
+        return {name: len(table) for name, table in self.tables.items()}
@@ -1,11 +1,25 @@
 '''
-Provides a basic frontend
+Provides a basic frontend.
+
+Run without arguments for the interactive menu, or with a subcommand for scripted use; each
+subcommand prints a JSON summary and exits non-zero if anything failed:
+
+    python menu.py load users accounts.csv more_accounts.csv --statuses statuses.csv --images images.csv
+    python menu.py reconcile --all --output differences.ndjson
+    python menu.py export --dir backup/
 '''
 import sys
 import os
+import csv
+import json
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 
 import main
+from socialnetwork_model import Users, Statuses, Pictures
 
 
 logger.remove(0)
@@ -220,6 +234,15 @@ def reconcile_images():
     '''Compares server images to database images'''
     raise NotImplementedError
 
+@log_function
+def rebuild_user_summaries():
+    '''Recounts user summary counters and reports any that had drifted'''
+    drift = main.rebuild_user_summaries()
+    if not drift:
+        print("User summaries are up to date")
+    for user_id, counter, stored, actual in drift:
+        print(f"{user_id}: {counter} was {stored}, rebuilt as {actual}")
+
 @log_function
 def quit_program():
     '''
@@ -229,7 +252,174 @@ def quit_program():
     sys.exit()
 
 
+CLI_WORKERS = 4
+# Loader and table filled for each kind of file, by the name used on the command line
+LOAD_KINDS = {
+    'users': (main.load_users, Users),
+    'statuses': (main.load_statuses, Statuses),
+    'images': (main.load_images, Pictures),
+}
+# Statuses and images reference users, so every users file is loaded before either starts
+LOAD_ORDER = (('users',), ('statuses', 'images'))
+EXPORTS = {'users': main.export_users, 'statuses': main.export_statuses, 'images': main.export_images}
+
+
+def count_csv_rows(filename):
+    '''Data rows in a csv file, not counting its header, or None if it can't be read'''
+    try:
+        with open(filename, 'r', newline='') as file:
+            return max(sum(1 for _ in csv.reader(file)) - 1, 0)
+    except OSError:
+        return None
+
+
+def load_file(kind, filename):
+    '''Loads one file with the main loader for kind. Returns its entry for the JSON summary'''
+    start = time.perf_counter()
+    rows = count_csv_rows(filename)
+    try:
+        error = None if LOAD_KINDS[kind][0](filename) is True else 'file not found'
+    except Exception as exc:  # pylint: disable=W0718
+        # One bad file is reported in the summary rather than ending the whole run
+        error = repr(exc)
+    entry = {'kind': kind, 'file': filename, 'ok': error is None, 'rows': rows,
+             'seconds': round(time.perf_counter() - start, 3)}
+    if error is not None:
+        entry['error'] = error
+    return entry
+
+
+def load_phase(files_by_kind, workers):
+    '''
+    Loads every file of the given kinds at the same time. Image files are the exception and go one
+    after another, since each image is stored under the next free picture_id.
+    Returns per-table throughput and per-file results.
+    '''
+    tables = {kind: LOAD_KINDS[kind][1] for kind in files_by_kind}
+    before = {kind: len(table) for kind, table in tables.items()}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for kind, filenames in files_by_kind.items():
+            if kind == 'images':
+                futures.append(executor.submit(lambda filenames=filenames: [load_file('images', filename)
+                                                                            for filename in filenames]))
+            else:
+                futures.extend(executor.submit(lambda kind=kind, filename=filename: [load_file(kind, filename)])
+                               for filename in filenames)
+        files = [entry for future in futures for entry in future.result()]
+    seconds = time.perf_counter() - start
+    summary = {}
+    for kind, table in tables.items():
+        rows = sum(entry['rows'] or 0 for entry in files if entry['kind'] == kind)
+        inserted = len(table) - before[kind]
+        # Skipped rows already existed, referenced a missing user, or were malformed
+        summary[kind] = {'rows': rows, 'inserted': inserted, 'skipped': rows - inserted,
+                         'rows_per_second': round(inserted / seconds, 1) if seconds else None}
+    return {'seconds': round(seconds, 3), 'tables': summary, 'files': files}
+
+
+def cli_load(args):
+    '''load KIND FILE... [--users FILE...] [--statuses FILE...] [--images FILE...]'''
+    files_by_kind = {kind: list(getattr(args, kind) or []) for kind in LOAD_KINDS}
+    files_by_kind[args.kind] = args.files + files_by_kind[args.kind]
+    start = time.perf_counter()
+    phases = []
+    for level in LOAD_ORDER:
+        level_files = {kind: files_by_kind[kind] for kind in level if files_by_kind[kind]}
+        if level_files:
+            phases.append(load_phase(level_files, args.workers))
+    errors = [entry for phase in phases for entry in phase['files'] if not entry['ok']]
+    return {'command': 'load', 'ok': not errors, 'seconds': round(time.perf_counter() - start, 3),
+            'phases': phases, 'errors': errors}
+
+
+def cli_reconcile(args):
+    '''reconcile --all [--output FILE] | reconcile USER_ID... [--verify]'''
+    start = time.perf_counter()
+    counts = Counter()
+    if args.all:
+        output = open(args.output, 'w', encoding='utf-8') if args.output else None  # pylint: disable=R1732
+        try:
+            for difference, (user_id, tags, filename) in main.reconcile_all_images():
+                counts[difference] += 1
+                if output is not None:
+                    output.write(json.dumps({'difference': difference, 'user_id': user_id, 'tags': tags,
+                                             'file': filename}) + '\n')
+        finally:
+            if output is not None:
+                output.close()
+    else:
+        for user_id in args.user_ids:
+            counts.update({difference: len(found)
+                           for difference, found in main.reconcile_images(user_id, args.verify).items()})
+    return {'command': 'reconcile', 'ok': True, 'seconds': round(time.perf_counter() - start, 3),
+            'differences': dict(counts), 'output': args.output}
+
+
+def cli_export(args):
+    '''export [--dir DIR] [--tables users statuses images]'''
+    start = time.perf_counter()
+    os.makedirs(args.dir, exist_ok=True)
+    paths = {kind: os.path.join(args.dir, f'{kind}.csv') for kind in args.tables}
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        written = dict(zip(paths, executor.map(lambda kind: EXPORTS[kind](paths[kind]), paths)))
+    return {'command': 'export', 'ok': True, 'seconds': round(time.perf_counter() - start, 3),
+            'files': {kind: {'file': paths[kind], 'rows': written[kind]} for kind in paths}}
+
+
+def positive_int(value):
+    '''argparse type for a count of at least one'''
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be a whole number of at least 1, not {value!r}')
+    return number
+
+
+def build_parser():
+    '''Argument parser for the non-interactive subcommands'''
+    parser = argparse.ArgumentParser(prog='menu.py', description='Scriptable social network operations')
+    parser.add_argument('--workers', type=positive_int, default=CLI_WORKERS, help='files loaded or exported at once')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('load', help='load csv files, users before statuses and images')
+    load.add_argument('kind', choices=LOAD_KINDS)
+    load.add_argument('files', nargs='+', metavar='FILE')
+    for kind in LOAD_KINDS:
+        load.add_argument(f'--{kind}', nargs='+', metavar='FILE', help=f'{kind} files to load in the same run')
+    load.set_defaults(handler=cli_load)
+
+    reconcile = commands.add_parser('reconcile', help='compare server images with the database')
+    reconcile.add_argument('user_ids', nargs='*', metavar='USER_ID')
+    reconcile.add_argument('--all', action='store_true', help='reconcile every user in one pass')
+    reconcile.add_argument('--verify', action='store_true', help='also check file contents (per user only)')
+    reconcile.add_argument('--output', help='write each --all difference to this file as JSON lines')
+    reconcile.set_defaults(handler=cli_reconcile)
+
+    export = commands.add_parser('export', help='write tables to csv files that load can read back')
+    export.add_argument('--dir', default='.', help='directory for users.csv, statuses.csv and images.csv')
+    export.add_argument('--tables', nargs='+', choices=EXPORTS, default=list(EXPORTS))
+    export.set_defaults(handler=cli_export)
+    return parser
+
+
+def run_cli(argv):
+    '''Runs one subcommand and prints its JSON summary. Returns the exit status'''
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'reconcile' and args.all == bool(args.user_ids):
+        parser.error('reconcile needs either --all or one or more user IDs')
+    summary = args.handler(args)
+    print(json.dumps(summary))
+    return 0 if summary['ok'] else 1
+
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
     logger.debug("Beginning program.")
     menu_options = {
         'A': load_users,
@@ -248,7 +438,8 @@ if __name__ == '__main__':
         'N': list_images,
         'O': reconcile_images,
         'P': load_images,
-        'Q': quit_program
+        'Q': quit_program,
+        'R': rebuild_user_summaries
     }
     while True:
         user_selection = input("""
@@ -269,6 +460,7 @@ if __name__ == '__main__':
                             O: Reconcile Images
                             P: Load Images
                             Q: Quit
+                            R: Rebuild user summaries
 
                             Please enter your choice: """).upper()
         if user_selection in menu_options:
@@ -0,0 +1,216 @@
+'''
+Optional Linux service that keeps picture state in sync through inotify instead of tree walks.
+
+The watcher records every add, remove and move under images.PICTURE_DIR into PendingChangeTable.
+Readers fold pending changes into ServerImageTable, so reconcile_images answers from the table.
+The whole tree is only rescanned at startup and when the kernel event queue overflows.
+'''
+# pylint: disable=E1120
+import os
+import struct
+import ctypes
+import ctypes.util
+import select
+import threading
+
+from loguru import logger
+
+import images
+from socialnetwork_model import db, ServerImageTable, PendingChangeTable, PictureTable
+
+# inotify event masks, from <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_CLOSE_WRITE = 0x00000008
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+BATCH_SIZE = 500
+ADDED = 'added'
+REMOVED = 'removed'
+
+
+def relative_image_path(file_path):
+    '''Returns a path below PICTURE_DIR with forward slashes, as stored in ServerImageTable'''
+    return os.path.relpath(file_path, images.PICTURE_DIR).replace(os.sep, '/')
+
+
+def image_record(image_path):
+    '''Converts a stored image path to a (user_id, tags, filename) tuple under the current layout'''
+    parts = image_path.split('/')
+    if images.STORAGE_LAYOUT == images.SHARDED_LAYOUT:
+        picture_id = parts[-1][:-len('.png')]
+        row = (PictureTable.select(PictureTable.user_id, PictureTable.tags)
+               .where(PictureTable.picture_id == picture_id).tuples().first())
+        if row is None:
+            return ('', '', parts[-1])
+        return (row[0], images.tags_to_path(row[1]), parts[-1])
+    return (parts[0], '/'.join(parts[1:-1]), parts[-1])
+
+
+def fold_pending_changes():
+    '''Applies recorded changes to ServerImageTable in order and clears them'''
+    # IMMEDIATE takes the write lock up front, so the read-then-write can't lose a race with the watcher
+    with db.atomic('IMMEDIATE'):
+        changes = list(PendingChangeTable.select().order_by(PendingChangeTable.change_id).tuples())
+        for _, change, image_path in changes:
+            if change == ADDED:
+                user_id, tags, filename = image_record(image_path)
+                ServerImageTable.replace(image_path=image_path, user_id=user_id,
+                                         tags=tags, filename=filename).execute()
+            else:
+                # A removed directory takes every image below it
+                ServerImageTable.delete().where(
+                    (ServerImageTable.image_path == image_path) |
+                    (ServerImageTable.image_path.startswith(f"{image_path}/"))).execute()
+        if changes:
+            PendingChangeTable.delete().where(PendingChangeTable.change_id <= changes[-1][0]).execute()
+    return len(changes)
+
+
+def list_watched_images(user_id):
+    '''Answers images.list_server_images from ServerImageTable after folding pending changes'''
+    fold_pending_changes()
+    rows = ServerImageTable.select(ServerImageTable.user_id, ServerImageTable.tags, ServerImageTable.filename)
+    return set(rows.where(ServerImageTable.user_id == user_id).tuples())
+
+
+class PictureWatcher:
+    '''Watches PICTURE_DIR with inotify on a background thread'''
+
+    def __init__(self, root=None):
+        self.root = root or images.PICTURE_DIR
+        self.watches = {}
+        self.rescans = 0
+        self._fd = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this platform')
+
+    def start(self):
+        '''Starts watching, rescans the tree and routes reconcile_images through the watcher'''
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        os.makedirs(self.root, exist_ok=True)
+        self.rescan()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='picture-watcher', daemon=True)
+        self._thread.start()
+        images.set_server_image_source(list_watched_images)
+        logger.info(f'Picture watcher started on {self.root}')
+
+    def stop(self):
+        '''Stops watching; reconcile_images goes back to walking the tree'''
+        images.set_server_image_source(None)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self.watches.clear()
+        logger.info('Picture watcher stopped')
+
+    def rescan(self):
+        '''Rebuilds ServerImageTable from a full walk, adding a watch on every directory'''
+        self.rescans += 1
+        found = []
+        for directory, _, files in os.walk(self.root):
+            self._add_watch(directory)
+            found.extend(os.path.join(directory, name) for name in files if name.endswith('.png'))
+        with db.atomic('IMMEDIATE'):
+            PendingChangeTable.delete().execute()
+            ServerImageTable.delete().execute()
+            rows = []
+            for file_path in found:
+                image_path = relative_image_path(file_path)
+                user_id, tags, filename = image_record(image_path)
+                rows.append({'image_path': image_path, 'user_id': user_id, 'tags': tags, 'filename': filename})
+            for start in range(0, len(rows), BATCH_SIZE):
+                ServerImageTable.insert_many(rows[start:start + BATCH_SIZE]).execute()
+        logger.info(f'Picture watcher rescanned {len(found)} images')
+
+    def _add_watch(self, directory):
+        '''Adds an inotify watch for directory'''
+        watch = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if watch < 0:
+            logger.error(f'Unable to watch {directory}: {os.strerror(ctypes.get_errno())}')
+            return
+        self.watches[watch] = directory
+
+    def _record(self, change, file_path):
+        '''Appends a change to PendingChangeTable'''
+        logger.debug(f'Picture watcher: {change} {file_path}')
+        PendingChangeTable.insert(change=change, image_path=relative_image_path(file_path)).execute()
+
+    def _added_directory(self, directory):
+        '''Watches a new or moved-in directory and records the images already inside it'''
+        for current, _, files in os.walk(directory):
+            self._add_watch(current)
+            for name in files:
+                if name.endswith('.png'):
+                    self._record(ADDED, os.path.join(current, name))
+
+    def _handle(self, watch, mask, name):
+        '''Turns one inotify event into pending changes'''
+        if mask & IN_Q_OVERFLOW:
+            logger.warning('Picture watcher event queue overflowed, rescanning')
+            self.rescan()
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(watch, None)
+            return
+        directory = self.watches.get(watch)
+        if directory is None or not name:
+            return
+        file_path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._added_directory(file_path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._record(REMOVED, file_path)
+        elif name.endswith('.png'):
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._record(ADDED, file_path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._record(REMOVED, file_path)
+
+    def _run(self):
+        '''Reads and dispatches inotify events until stopped'''
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._fd], [], [], 0.2)
+            if not readable:
+                if not self.watches and os.path.isdir(self.root):
+                    # The root was removed and recreated, so every watch was lost
+                    self.rescan()
+                continue
+            try:
+                data = os.read(self._fd, READ_SIZE)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(data):
+                watch, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                self._handle(watch, mask, name)
+
+
+def start_watcher():
+    '''Starts a PictureWatcher on PICTURE_DIR and returns it'''
+    watcher = PictureWatcher()
+    watcher.start()
+    return watcher
@@ -0,0 +1,88 @@
+'''
+Compact row types for query results.
+
+Rows from the search helpers are slotted objects rather than dicts, which saves the per-row dict
+and hash table. Repeated strings (user_id, tags) are interned so rows belonging to the same
+user or sharing tags share one string. Rows still support row['column'], row.get(), keys() and
+dict(row), so callers written against DataSet's dict rows keep working.
+'''
+import sys
+
+
+class Record:
+    '''Base for slotted rows. Subclasses list their columns in __slots__ and interned ones in INTERNED'''
+    __slots__ = ()
+    INTERNED = ()
+
+    def __init__(self, **values):
+        for column in self.__slots__:
+            value = values.get(column)
+            if column in self.INTERNED and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, column, value)
+
+    @classmethod
+    def from_dict(cls, row):
+        '''Builds a record from a DataSet row dict. Columns the record doesn't define are dropped'''
+        return cls(**row)
+
+    def __getitem__(self, column):
+        if column not in self.__slots__:
+            raise KeyError(column)
+        return getattr(self, column)
+
+    def get(self, column, default=None):
+        '''Same as dict.get'''
+        return getattr(self, column) if column in self.__slots__ else default
+
+    def keys(self):
+        '''Column names, so dict(record) and **record work'''
+        return self.__slots__
+
+    def values(self):
+        '''Column values, in column order'''
+        return tuple(getattr(self, column) for column in self.__slots__)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return type(self) is type(other) and self.values() == other.values()
+        if isinstance(other, dict):
+            return dict(self) == other
+        return NotImplemented
+
+    # Records are mutable, so like dicts they aren't hashable
+    __hash__ = None
+
+    def __repr__(self):
+        columns = ', '.join(f'{column}={getattr(self, column)!r}' for column in self.__slots__)
+        return f'{type(self).__name__}({columns})'
+
+
+class UserRow(Record):
+    '''A usertable row'''
+    __slots__ = ('user_id', 'first_name', 'last_name', 'email')
+    INTERNED = ('user_id',)
+
+
+class StatusRow(Record):
+    '''A statustable row'''
+    __slots__ = ('status_id', 'user_id', 'status_text')
+    INTERNED = ('user_id',)
+
+
+class PictureRow(Record):
+    '''A picturetable row, including the cached checksum columns'''
+    __slots__ = ('picture_id', 'user_id', 'tags', 'checksum', 'checksum_mtime', 'checksum_size')
+    INTERNED = ('user_id', 'tags')
+
+
+class TimelineRow(Record):
+    '''A statustable row with its timeline position'''
+    __slots__ = ('status_id', 'user_id', 'status_text', 'seq', 'created_at')
+    INTERNED = ('user_id',)
@@ -0,0 +1,415 @@
+'''
+Optional hash-sharded storage across several SQLite files.
+
+Each user lives on the shard picked by a stable hash of user_id, and that user's statuses and
+pictures are stored on the same shard, so foreign keys, cascades and the summary triggers keep
+working inside one file. Point operations on a user touch one shard; listing, counting and
+reconciling fan out to every shard in parallel and merge the results.
+
+ShardedDataSet puts the same routing behind the DataSet table interface the curried helpers use,
+so SOCIAL_NETWORK_BACKEND=sharded runs users.py, user_status.py and images.py over the shards.
+
+Move rows to a different shard count with: python sharding.py rebalance OLD_COUNT NEW_COUNT
+'''
+# socialnetwork_model opens the sharded backend while it is still being imported, so it and images
+# (which imports it) are imported inside the functions that use them
+# pylint: disable=C0415,W0212
+import os
+import sys
+import json
+import zlib
+import heapq
+import queue
+import operator
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from peewee import SqliteDatabase, IntegrityError, ForeignKeyField
+from playhouse.dataset import DataSet
+from loguru import logger
+
+SHARD_COUNT = int(os.environ.get('SOCIAL_NETWORK_SHARDS', 4))
+SHARD_PATTERN = 'social_network_{index}.db'
+# Tables holding a user's rows, parents first so rows can be copied in order
+SHARDED_TABLES = ('usertable', 'statustable', 'picturetable')
+MOVE_BATCH_SIZE = 500
+PREFETCH_SIZE = 1000
+
+
+def shard_for(user_id, shard_count=SHARD_COUNT):
+    '''Shard index for user_id. crc32 is used rather than hash(), which is salted per process'''
+    return zlib.crc32(user_id.encode('utf-8')) % shard_count
+
+
+def open_shard(path):
+    '''Opens a shard database, creating its tables and triggers if needed'''
+    from socialnetwork_model import initialize_database
+    database = SqliteDatabase(path, pragmas={'foreign_keys': 1})
+    initialize_database(database)
+    return database
+
+
+class Shard:
+    '''One shard file with DataSet tables and the usual curried helpers bound to it'''
+
+    def __init__(self, index, path):
+        from socialnetwork_model import insert_table, search_table, search_table_for_many
+        self.index = index
+        self.path = path
+        self.database = open_shard(path)
+        self.dataset = DataSet(self.database)
+        self.tables = {table: self.dataset[table] for table in SHARDED_TABLES}
+        self.insert = {table: insert_table(self.tables[table]) for table in SHARDED_TABLES}
+        self.search = {table: search_table(self.tables[table]) for table in SHARDED_TABLES}
+        self.search_many = {table: search_table_for_many(self.tables[table]) for table in SHARDED_TABLES}
+
+    def rows(self, table):
+        '''Every row of table on this shard, as dicts'''
+        return list(self.tables[table].all())
+
+    def count(self, table):
+        '''Number of rows in table on this shard'''
+        return self.database.execute_sql(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def picture_rows(self):
+        '''Streams (user_id, tags, picture_id) ordered by user_id, for images.iter_db_records'''
+        cursor = self.database.execute_sql(
+            'SELECT user_id, tags, picture_id FROM picturetable ORDER BY user_id, picture_id')
+        yield from cursor
+
+    def user_ids(self):
+        '''Every user_id on this shard'''
+        return [user_id for user_id, in self.database.execute_sql('SELECT user_id FROM usertable')]
+
+
+class ShardedStore:
+    '''Routes users, statuses and pictures to shard files by user_id'''
+
+    def __init__(self, shard_count=SHARD_COUNT, pattern=SHARD_PATTERN):
+        self.pattern = pattern
+        self.shards = [Shard(index, pattern.format(index=index)) for index in range(shard_count)]
+
+    @property
+    def shard_count(self):
+        '''Number of shards rows are routed across'''
+        return len(self.shards)
+
+    def shard(self, user_id):
+        '''The shard holding user_id and everything that belongs to them'''
+        return self.shards[shard_for(user_id, self.shard_count)]
+
+    def scatter(self, func):
+        '''Calls func(shard) on every shard in parallel and returns the results in shard order'''
+        with ThreadPoolExecutor(max_workers=self.shard_count) as executor:
+            return list(executor.map(func, self.shards))
+
+    def insert(self, table, **row):
+        '''Inserts row into table on the shard of row['user_id']. Returns False on IntegrityError'''
+        return self.shard(row['user_id']).insert[table](**row)
+
+    def search_user(self, user_id):
+        '''Finds a user on their shard, or returns None'''
+        return self.shard(user_id).search['usertable'](user_id=user_id)
+
+    def search_status(self, status_id):
+        '''Finds a status by ID. Statuses are placed by user_id, so every shard is asked'''
+        for found in self.scatter(lambda shard: shard.search['statustable'](status_id=status_id)):
+            if found is not None:
+                return found
+        return None
+
+    def user_statuses(self, user_id):
+        '''Every status of user_id, from their shard'''
+        return self.shard(user_id).search_many['statustable'](user_id=user_id)
+
+    def user_pictures(self, user_id):
+        '''Every picture row of user_id, from their shard'''
+        return self.shard(user_id).search_many['picturetable'](user_id=user_id)
+
+    def delete_user(self, user_id):
+        '''Deletes a user; their statuses and pictures cascade on the same shard'''
+        return self.shard(user_id).tables['usertable'].delete(user_id=user_id) > 0
+
+    def list_table(self, table):
+        '''Every row of table across all shards, as dicts'''
+        return [row for rows in self.scatter(lambda shard: shard.rows(table)) for row in rows]
+
+    def count(self, table):
+        '''Total rows in table across all shards'''
+        return sum(self.scatter(lambda shard: shard.count(table)))
+
+    def reconcile_all_images(self):
+        '''
+        images.reconcile_all_images over every shard. Each shard's picture rows are read on its own
+        thread and merged by user_id, which is enough because a user's rows never span shards.
+        '''
+        import images
+        if images.STORAGE_LAYOUT == images.SHARDED_LAYOUT:
+            raise ValueError('Sharded databases can only be reconciled against the tag layout')
+        streams = [_prefetch(shard.picture_rows()) for shard in self.shards]
+        rows = heapq.merge(*streams, key=lambda row: row[0])
+        return images.merge_reconcile(images.iter_db_records(rows), images.iter_server_records())
+
+    def bulk_load(self, table, rows, processes=True):
+        '''
+        Inserts dict rows into table, loading every shard's partition at the same time.
+        With processes the shards are written from separate processes so the writes don't share the GIL.
+        Rows that already exist are skipped. Returns the number of rows inserted.
+        '''
+        partitions = [[] for _ in self.shards]
+        for row in rows:
+            partitions[shard_for(row['user_id'], self.shard_count)].append(row)
+        jobs = [(shard.path, table, partition) for shard, partition in zip(self.shards, partitions) if partition]
+        if not jobs:
+            return 0
+        executor_type = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with executor_type(max_workers=len(jobs)) as executor:
+            return sum(executor.map(_load_partition, *zip(*jobs)))
+
+    def rebalance(self, shard_count):
+        '''
+        Moves every user whose shard changes under shard_count, along with their statuses and pictures.
+        Rows are copied before the source is deleted, so an interrupted rebalance can be rerun.
+        Shards beyond a smaller shard_count are left empty on disk. Returns counts of what moved.
+        '''
+        targets = [self.shards[index] if index < self.shard_count else Shard(index, self.pattern.format(index=index))
+                   for index in range(shard_count)]
+        moved = {table: 0 for table in SHARDED_TABLES}
+        for source in self.shards:
+            leaving = [user_id for user_id in source.user_ids() if shard_for(user_id, shard_count) != source.index]
+            by_target = {}
+            for user_id in leaving:
+                by_target.setdefault(shard_for(user_id, shard_count), []).append(user_id)
+            for index, user_ids in sorted(by_target.items()):
+                for start in range(0, len(user_ids), MOVE_BATCH_SIZE):
+                    batch = user_ids[start:start + MOVE_BATCH_SIZE]
+                    for table, count in _move_users(source, targets[index], batch).items():
+                        moved[table] += count
+            if leaving:
+                logger.info(f'Moved {len(leaving)} users off shard {source.index}')
+        self.shards = targets
+        logger.info(f'Rebalanced to {shard_count} shards: {moved}')
+        return moved
+
+
+class ShardedTable:
+    '''
+    One table spread across a ShardedStore, with the DataSet table methods the curried helpers call.
+    Queries naming a user_id go to that user's shard; any other query asks every shard. A row whose
+    user_id changes to one on another shard is copied there and then deleted, like a rebalance.
+    Primary keys other than user_id, and columns given a unique index, are checked across shards.
+    '''
+
+    def __init__(self, dataset, model):
+        self.dataset = dataset
+        self.store = dataset.store
+        self.name = model._meta.table_name
+        self.primary_key = model._meta.primary_key.column_name
+        self.unique = [[self.primary_key]] if self.primary_key != 'user_id' else []
+
+    def _table(self, shard):
+        return shard.dataset[self.name]
+
+    def _shards_for(self, query):
+        '''The shards rows matching query can be on'''
+        if 'user_id' in query:
+            return [self.store.shard(str(query['user_id']))]
+        return self.store.shards
+
+    def _check_unique(self, row, *skip):
+        '''Raises IntegrityError if a shard other than those in skip already holds row's unique values'''
+        for columns in self.unique:
+            if not all(column in row for column in columns):
+                continue
+            query = {column: row[column] for column in columns}
+            if any(self._table(shard).find_one(**query) is not None
+                   for shard in self.store.shards if shard not in skip):
+                raise IntegrityError(f"UNIQUE constraint failed: {self.name}.{', '.join(columns)}")
+
+    @property
+    def columns(self):
+        '''Column names, as the first shard has them'''
+        return self._table(self.store.shards[0]).columns
+
+    def __len__(self):
+        return self.store.count(self.name)
+
+    def insert(self, **data):
+        '''Inserts a row on the shard of its user_id and returns its primary key'''
+        if data.get('user_id') is None:
+            raise IntegrityError(f'NOT NULL constraint failed: {self.name}.user_id')
+        shard = self.store.shard(str(data['user_id']))
+        with self.dataset.lock:
+            self._check_unique(data, shard)
+            return self._table(shard).insert(**data)
+
+    def find_one(self, **query):
+        '''First row matching query as a dict, or None, checking shards in order'''
+        for shard in self._shards_for(query):
+            row = self._table(shard).find_one(**query)
+            if row is not None:
+                return row
+        return None
+
+    def find(self, **query):
+        '''Every row matching query, as dicts'''
+        shards = self._shards_for(query)
+        if len(shards) == 1:
+            return list(self._table(shards[0]).find(**query))
+        return [row for rows in self.store.scatter(lambda shard: list(self._table(shard).find(**query)))
+                for row in rows]
+
+    def all(self):
+        '''Every row across all shards, as dicts'''
+        return self.store.list_table(self.name)
+
+    def update(self, columns=None, conjunction=None, **data):
+        '''
+        Updates rows where each of columns equals its value in data, setting the rest of data.
+        Every row is updated when columns is empty. Returns the number of rows updated.
+        '''
+        if conjunction not in (None, operator.and_):
+            raise ValueError('ShardedTable only supports AND conjunctions')
+        columns = columns or []
+        query = {column: data[column] for column in columns}
+        changes = {column: value for column, value in data.items() if column not in columns}
+        updated = 0
+        with self.dataset.lock:
+            moves = []
+            for shard in self._shards_for(query):
+                target = self.store.shard(str(changes['user_id'])) if 'user_id' in changes else shard
+                if target is shard:
+                    self._check_unique(changes, shard)
+                    updated += self._table(shard).update(columns=columns, **data)
+                else:
+                    moves.append((shard, target, list(self._table(shard).find(**query))))
+            # Moved after the updates in place, so a moved row isn't matched again on its new shard
+            for shard, target, rows in moves:
+                for row in rows:
+                    self._move(shard, target, row, {**row, **changes})
+                    updated += 1
+        return updated
+
+    def _move(self, source, target, row, new_row):
+        '''Replaces row on source with new_row on target, which holds the new user_id'''
+        if self.dataset.referencing(source, self.name, row[self.primary_key]):
+            raise IntegrityError('FOREIGN KEY constraint failed')
+        self._check_unique(new_row, source, target)
+        with target.database.atomic():
+            self._table(target).insert(**new_row)
+        self._table(source).delete(**{self.primary_key: row[self.primary_key]})
+
+    def delete(self, **query):
+        '''Deletes rows matching query, or every row, cascading on each shard. Returns the count'''
+        with self.dataset.lock:
+            return sum(self._table(shard).delete(**query) for shard in self._shards_for(query))
+
+    def create_index(self, columns, unique=False):
+        '''Creates the index on every shard. A unique index is also checked and enforced across shards'''
+        with self.dataset.lock:
+            for shard in self.store.shards:
+                self._table(shard).create_index(columns, unique=unique)
+            if not unique or columns in self.unique:
+                return
+            values = [tuple(row[column] for column in columns) for row in self.all()]
+            if len(values) != len(set(values)):
+                raise IntegrityError(f"UNIQUE constraint failed: {self.name}.{', '.join(columns)}")
+            self.unique.append(list(columns))
+
+
+class ShardedDataSet:
+    '''ShardedTables for a list of peewee models, over one ShardedStore'''
+
+    def __init__(self, store, models):
+        self.store = store
+        # Serializes the cross-shard uniqueness checks with the writes they guard, within this process
+        self.lock = threading.RLock()
+        self.tables = {model._meta.table_name: ShardedTable(self, model) for model in models}
+        # {parent table: [(child table, foreign key column)]}
+        self.children = {name: [] for name in self.tables}
+        for model in models:
+            for field in model._meta.sorted_fields:
+                if isinstance(field, ForeignKeyField) and field.rel_model._meta.table_name in self.children:
+                    self.children[field.rel_model._meta.table_name].append((model._meta.table_name, field.column_name))
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def referencing(self, shard, table, key):
+        '''True if any child row on shard points at key in table'''
+        return any(shard.dataset[child].find_one(**{column: key}) is not None
+                   for child, column in self.children[table])
+
+
+def _prefetch(rows, size=PREFETCH_SIZE):
+    '''Reads rows on a background thread into a bounded queue, so several shards can be read at once'''
+    done = object()
+    buffer = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for row in rows:
+                while not stop.is_set():
+                    try:
+                        buffer.put(row, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+        finally:
+            buffer.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while (row := buffer.get()) is not done:
+            yield row
+    finally:
+        # Lets the reader finish if the consumer stopped early
+        stop.set()
+
+
+def _placeholders(values):
+    '''SQL parameter list for values'''
+    return ', '.join('?' * len(values))
+
+
+def _move_users(source, target, user_ids):
+    '''Copies user_ids and their rows from source to target, then deletes them from source'''
+    counts = {}
+    with target.database.atomic():
+        for table in SHARDED_TABLES:
+            cursor = source.database.execute_sql(
+                f'SELECT * FROM {table} WHERE user_id IN ({_placeholders(user_ids)})', user_ids)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+            counts[table] = len(rows)
+            if rows:
+                target.database.cursor().executemany(
+                    f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({_placeholders(columns)})", rows)
+    with source.database.atomic():
+        # Statuses and pictures go with the user through ON DELETE CASCADE
+        source.database.execute_sql(f'DELETE FROM usertable WHERE user_id IN ({_placeholders(user_ids)})', user_ids)
+        source.database.execute_sql(
+            f'DELETE FROM usersummarytable WHERE user_id IN ({_placeholders(user_ids)})', user_ids)
+    return counts
+
+
+def _load_partition(path, table, rows):
+    '''Inserts one shard's rows in a single transaction. Runs in a worker process for bulk_load'''
+    database = open_shard(path)
+    columns = list(rows[0])
+    with database.atomic():
+        # rowcount leaves out the rows written by the summary and version triggers
+        inserted = database.cursor().executemany(
+            f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({_placeholders(columns)})",
+            [tuple(row[column] for column in columns) for row in rows]).rowcount
+    database.close()
+    return inserted
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'rebalance':
+        sys.exit('Usage: python sharding.py rebalance OLD_COUNT NEW_COUNT')
+    print(json.dumps(ShardedStore(int(sys.argv[2])).rebalance(int(sys.argv[3]))))
@@ -1,10 +1,27 @@
 '''Database Definition'''
+import os
+import re
 
-from peewee import SqliteDatabase, Model, CharField, ForeignKeyField, IntegrityError
-from playhouse.dataset import DataSet
+from peewee import (SqliteDatabase, Model, CharField, ForeignKeyField, IntegrityError, AutoField, FloatField,
+                    IntegerField, DateTimeField, TextField, sort_models)
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.sqlite_ext import AutoIncrementField
+from playhouse.dataset import DataSet, Table as DataSetTable
 from loguru import logger
 
+from memory_backend import MemoryDataSet
+
 db = SqliteDatabase('social_network.db', pragmas={'foreign_keys': 1})
+# Bound parameters per statement on SQLite builds before 3.32; IN lists are batched under it
+SQLITE_MAX_VARIABLES = 999
+
+# Storage behind the curried table helpers: 'sqlite' (social_network.db) or 'memory' (memory_backend)
+SQLITE_BACKEND = 'sqlite'
+MEMORY_BACKEND = 'memory'
+SHARDED_BACKEND = 'sharded'
+BACKEND = os.environ.get('SOCIAL_NETWORK_BACKEND', SQLITE_BACKEND)
+# With the memory backend, load social_network.db into memory at startup for cache-warm serving
+WARM_FROM_SQLITE = bool(os.environ.get('SOCIAL_NETWORK_WARM'))
 
 
 class BaseModel(Model):
@@ -25,28 +42,385 @@ class StatusTable(BaseModel):
     status_id = CharField(primary_key=True)
     user_id = ForeignKeyField(UserTable, on_delete='CASCADE')
     status_text = CharField()
+    # Assigned by STATUS_SEQUENCE_TRIGGERS, increasing in insert order; (user_id, seq) is indexed for timelines
+    seq = IntegerField(null=True)
+    created_at = DateTimeField(null=True)
 
 class PictureTable(BaseModel):
     '''Picture Information definition'''
     picture_id = CharField(primary_key=True)
     user_id = ForeignKeyField(UserTable, on_delete='CASCADE')
     tags = CharField(max_length=100)
+    # sha256 of the file, and the mtime/size it was last confirmed at so unchanged files aren't re-hashed
+    checksum = CharField(null=True)
+    checksum_mtime = FloatField(null=True)
+    checksum_size = IntegerField(null=True)
 
+class ServerImageTable(BaseModel):
+    '''Images on disk as last seen by the picture watcher, keyed by path below the pictures directory'''
+    image_path = CharField(primary_key=True)
+    user_id = CharField(index=True)
+    tags = CharField()
+    filename = CharField()
 
-db.connect()
-db.create_tables([UserTable, StatusTable, PictureTable])
-db.close()
+class PendingChangeTable(BaseModel):
+    '''File adds and removes recorded by the picture watcher, not yet folded into ServerImageTable'''
+    change_id = AutoField()
+    change = CharField()
+    image_path = CharField()
 
-ds = DataSet(db)
-Users = ds["usertable"]
-Statuses = ds["statustable"]
-Pictures = ds["picturetable"]
-# Users.insert(user_id='index_creation')
-# Statuses.insert(status_id='index_creation')
-# Users.create_index(["user_id"], unique=True)
-# Statuses.create_index(["status_id"], unique=True)
-# Users.delete(user_id='index_creation')
-# Statuses.delete(status_id='index_creation')
+class UserSummaryTable(BaseModel):
+    '''Per-user counters, kept current by the triggers in SUMMARY_TRIGGERS'''
+    user_id = ForeignKeyField(UserTable, primary_key=True, on_delete='CASCADE')
+    status_count = IntegerField(default=0)
+    picture_count = IntegerField(default=0)
+    last_activity = DateTimeField(null=True)
+
+class JobTable(BaseModel):
+    '''Background reconcile and load jobs, claimed and run by the jobs.py worker process'''
+    job_id = AutoField()
+    kind = CharField()
+    params = TextField()
+    dedup_key = CharField(index=True)
+    status = CharField(default='queued', index=True)
+    progress = IntegerField(default=0)
+    result = TextField(null=True)
+    error = TextField(null=True)
+    created_at = DateTimeField()
+    started_at = DateTimeField(null=True)
+    finished_at = DateTimeField(null=True)
+    # The worker running the job, and when its claim lapses unless that worker renews it
+    worker = CharField(null=True)
+    lease_until = DateTimeField(null=True)
+
+
+def _count_triggers(table, counter, content):
+    '''
+    Triggers keeping counter in usersummarytable in step with inserts, deletes and moves in table.
+    Only a move or a change to the content column counts as activity; bookkeeping writes such as
+    checksums and sequence numbers leave the summary alone.
+    '''
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_summary_insert AFTER INSERT ON {table} BEGIN
+            UPDATE usersummarytable SET {counter} = {counter} + 1, last_activity = CURRENT_TIMESTAMP
+            WHERE user_id = NEW.user_id;
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_summary_delete AFTER DELETE ON {table} BEGIN
+            UPDATE usersummarytable SET {counter} = {counter} - 1 WHERE user_id = OLD.user_id;
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_summary_update AFTER UPDATE OF user_id, {content} ON {table}
+        WHEN OLD.user_id IS NOT NEW.user_id OR OLD.{content} IS NOT NEW.{content} BEGIN
+            UPDATE usersummarytable SET {counter} = {counter} - 1
+            WHERE user_id = OLD.user_id AND OLD.user_id IS NOT NEW.user_id;
+            UPDATE usersummarytable SET {counter} = {counter} + (OLD.user_id IS NOT NEW.user_id),
+                last_activity = CURRENT_TIMESTAMP
+            WHERE user_id = NEW.user_id;
+        END""",
+    ]
+
+SUMMARY_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS usertable_summary_insert AFTER INSERT ON usertable BEGIN
+        INSERT OR IGNORE INTO usersummarytable (user_id, status_count, picture_count) VALUES (NEW.user_id, 0, 0);
+    END""",
+    *_count_triggers('statustable', 'status_count', 'status_text'),
+    *_count_triggers('picturetable', 'picture_count', 'tags'),
+]
+
+class TableVersionTable(BaseModel):
+    '''Write counter per table, bumped by VERSION_TRIGGERS so caches can tell when a table changed'''
+    table_name = CharField(primary_key=True)
+    version = IntegerField(default=0)
+
+VERSIONED_TABLES = ['usertable', 'statustable', 'picturetable']
+
+# Columns each table publishes, primary key first: what the changelog records and the cached responses
+# serve. Picture checksums and status sequence numbers are local bookkeeping and aren't published.
+CHANGELOG_COLUMNS = {
+    'usertable': ['user_id', 'first_name', 'last_name', 'email'],
+    'statustable': ['status_id', 'user_id', 'status_text'],
+    'picturetable': ['picture_id', 'user_id', 'tags'],
+}
+
+
+def _version_triggers(table, columns):
+    '''Triggers bumping table's version on inserts, deletes and updates that change a published column'''
+    bump = f"UPDATE tableversiontable SET version = version + 1 WHERE table_name = '{table}';"
+    changed = ' OR '.join(f'OLD.{column} IS NOT NEW.{column}' for column in columns)
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_version_insert AFTER INSERT ON {table} BEGIN
+            {bump}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_version_update AFTER UPDATE OF {', '.join(columns)} ON {table}
+        WHEN {changed} BEGIN
+            {bump}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_version_delete AFTER DELETE ON {table} BEGIN
+            {bump}
+        END""",
+    ]
+
+VERSION_TRIGGERS = [trigger for table in VERSIONED_TABLES
+                    for trigger in _version_triggers(table, CHANGELOG_COLUMNS[table])]
+
+
+class ChangeLogTable(BaseModel):
+    '''
+    Every insert, update and delete on the CHANGELOG_COLUMNS tables, appended by CHANGELOG_TRIGGERS.
+    AUTOINCREMENT keeps seq increasing even after old entries are compacted away.
+    '''
+    seq = AutoIncrementField()
+    table_name = CharField()
+    operation = CharField()
+    row_key = CharField()
+    # JSON of the row after the change, NULL for deletes
+    data = TextField(null=True)
+    changed_at = DateTimeField(index=True)
+
+    class Meta:
+        '''Compaction looks up every entry for one row'''
+        indexes = ((('table_name', 'row_key', 'seq'), False),)
+
+class ChangeLogStateTable(BaseModel):
+    '''Changelog bookkeeping, such as the highest seq removed by retention'''
+    name = CharField(primary_key=True)
+    value = IntegerField(default=0)
+
+
+def _changelog_triggers(table, columns):
+    '''Triggers appending every change to table's columns to changelogtable'''
+    key = columns[0]
+    new_row = 'json_object(' + ', '.join(f"'{column}', NEW.{column}" for column in columns) + ')'
+    changed = ' OR '.join(f'OLD.{column} IS NOT NEW.{column}' for column in columns)
+    insert = 'INSERT INTO changelogtable (table_name, operation, row_key, data, changed_at)'
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_changelog_insert AFTER INSERT ON {table} BEGIN
+            {insert} VALUES ('{table}', 'insert', NEW.{key}, {new_row}, CURRENT_TIMESTAMP);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_changelog_update AFTER UPDATE OF {', '.join(columns)} ON {table}
+        WHEN {changed} BEGIN
+            {insert} SELECT '{table}', 'delete', OLD.{key}, NULL, CURRENT_TIMESTAMP WHERE OLD.{key} IS NOT NEW.{key};
+            {insert} VALUES ('{table}', 'update', NEW.{key}, {new_row}, CURRENT_TIMESTAMP);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_changelog_delete AFTER DELETE ON {table} BEGIN
+            {insert} VALUES ('{table}', 'delete', OLD.{key}, NULL, CURRENT_TIMESTAMP);
+        END""",
+    ]
+
+CHANGELOG_TRIGGERS = [trigger for table, columns in CHANGELOG_COLUMNS.items()
+                      for trigger in _changelog_triggers(table, columns)]
+
+
+class SequenceTable(BaseModel):
+    '''Last value handed out by each named sequence'''
+    name = CharField(primary_key=True)
+    value = IntegerField(default=0)
+
+# Created after add_missing_columns, since databases from before seq existed only get it then
+STATUS_SEQUENCE_TRIGGERS = [
+    'CREATE INDEX IF NOT EXISTS statustable_user_id_seq ON statustable (user_id, seq)',
+    """CREATE TRIGGER IF NOT EXISTS statustable_sequence_assign AFTER INSERT ON statustable
+    WHEN NEW.seq IS NULL BEGIN
+        UPDATE sequencetable SET value = value + 1 WHERE name = 'statustable';
+        UPDATE statustable SET seq = (SELECT value FROM sequencetable WHERE name = 'statustable'),
+            created_at = COALESCE(NEW.created_at, CURRENT_TIMESTAMP)
+        WHERE status_id = NEW.status_id;
+    END""",
+    # Rows copied in with their seq (shard moves) keep it, and later statuses still sort after them
+    """CREATE TRIGGER IF NOT EXISTS statustable_sequence_advance AFTER INSERT ON statustable
+    WHEN NEW.seq IS NOT NULL BEGIN
+        UPDATE sequencetable SET value = MAX(value, NEW.seq) WHERE name = 'statustable';
+    END""",
+]
+
+
+class UserDomainTable(BaseModel):
+    '''
+    Each user's lower-cased email domain with its labels reversed (com.goodmail), kept by
+    USER_SEARCH_TRIGGERS, so a domain and its subdomains are one index range
+    '''
+    user_id = ForeignKeyField(UserTable, primary_key=True, on_delete='CASCADE')
+    reversed_domain = CharField(null=True, index=True)
+
+def reversed_domain_sql(email):
+    '''
+    SQL for the lower-cased domain of the email expression with its labels reversed, or NULL without an @.
+    Leading and trailing dots are dropped, as users.reversed_domain does. Plain SQL rather than a Python
+    function so writers on any connection, including SQLAlchemy's, keep it; the labels are split by a
+    recursive CTE over instr/substr, which takes any characters an email may hold.
+    '''
+    domain = f"trim(lower(substr({email}, instr({email}, '@') + 1)), '.')"
+    # Each step moves the first label of rest to the front of reversed; the row with nothing left is the answer
+    return (f"CASE WHEN instr({email}, '@') > 0 THEN (WITH RECURSIVE labels(rest, reversed) AS ("
+            f"SELECT {domain} || '.', NULL UNION ALL "
+            f"SELECT substr(rest, instr(rest, '.') + 1), "
+            f"substr(rest, 1, instr(rest, '.') - 1) || coalesce('.' || reversed, '') FROM labels WHERE rest != '') "
+            f"SELECT reversed FROM labels WHERE rest = '') END")
+
+# The NOCASE indexes serve case-insensitive prefix ranges over names and emails
+USER_SEARCH_TRIGGERS = [
+    *[f'CREATE INDEX IF NOT EXISTS usertable_{column}_nocase ON usertable ({column} COLLATE NOCASE)'
+      for column in ('first_name', 'last_name', 'email')],
+    f"""CREATE TRIGGER IF NOT EXISTS usertable_domain_insert AFTER INSERT ON usertable BEGIN
+        INSERT OR REPLACE INTO userdomaintable (user_id, reversed_domain)
+        VALUES (NEW.user_id, {reversed_domain_sql('NEW.email')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS usertable_domain_update AFTER UPDATE OF user_id, email ON usertable
+    WHEN NEW.email IS NOT OLD.email OR NEW.user_id IS NOT OLD.user_id BEGIN
+        DELETE FROM userdomaintable WHERE user_id = OLD.user_id;
+        INSERT OR REPLACE INTO userdomaintable (user_id, reversed_domain)
+        VALUES (NEW.user_id, {reversed_domain_sql('NEW.email')});
+    END""",
+]
+
+
+def table_versions():
+    '''Returns {table_name: version} for every versioned table'''
+    return dict(db.execute_sql('SELECT table_name, version FROM tableversiontable').fetchall())
+
+
+def rebuild_user_summaries(verify_only=False, database=None):
+    '''
+    Recounts every user's statuses and pictures from the source tables.
+    Returns a list of (user_id, counter, stored, actual) for each counter that had drifted,
+    and rewrites usersummarytable unless verify_only is set.
+    '''
+    database = database or db
+    actual_sql = """SELECT u.user_id AS user_id,
+        (SELECT COUNT(*) FROM statustable s WHERE s.user_id = u.user_id) AS status_count,
+        (SELECT COUNT(*) FROM picturetable p WHERE p.user_id = u.user_id) AS picture_count
+        FROM usertable u"""
+    with database.atomic():
+        stored = {row[0]: row[1:] for row in
+                  database.execute_sql('SELECT user_id, status_count, picture_count FROM usersummarytable')}
+        drift = []
+        for user_id, status_count, picture_count in database.execute_sql(actual_sql).fetchall():
+            old_status_count, old_picture_count = stored.get(user_id, (None, None))
+            if old_status_count != status_count:
+                drift.append((user_id, 'status_count', old_status_count, status_count))
+            if old_picture_count != picture_count:
+                drift.append((user_id, 'picture_count', old_picture_count, picture_count))
+        if drift and not verify_only:
+            database.execute_sql(f"""INSERT OR REPLACE INTO usersummarytable (user_id, status_count, picture_count, last_activity)
+                SELECT a.user_id, a.status_count, a.picture_count, s.last_activity
+                FROM ({actual_sql}) a
+                LEFT JOIN usersummarytable s ON s.user_id = a.user_id""")
+    if drift:
+        logger.warning(f'User summaries had drifted: {drift}')
+    return drift
+
+
+def add_missing_columns(model, database=None):
+    '''Adds nullable fields to tables created before those fields existed'''
+    # pylint: disable=W0212
+    database = database or db
+    existing = {column.name for column in database.get_columns(model._meta.table_name)}
+    migrator = SqliteMigrator(database)
+    missing = [field for field in model._meta.sorted_fields if field.column_name not in existing]
+    migrate(*[migrator.add_column(model._meta.table_name, field.column_name, field) for field in missing])
+    return [field.column_name for field in missing]
+
+
+def backfill_status_sequence(database=None):
+    '''
+    Numbers statuses written before seq existed, in insertion order, and moves the sequence past them.
+    Their created_at stays NULL since when they were written isn't known.
+    '''
+    database = database or db
+    summary_update = next(trigger for trigger in SUMMARY_TRIGGERS if 'statustable_summary_update' in trigger)
+    with database.atomic():
+        # Numbering isn't activity, so it mustn't bump every user's last_activity
+        database.execute_sql('DROP TRIGGER IF EXISTS statustable_summary_update')
+        numbered = database.execute_sql("""UPDATE statustable SET seq = numbered.base + numbered.n
+            FROM (SELECT rowid AS id, ROW_NUMBER() OVER (ORDER BY rowid) AS n,
+                  (SELECT value FROM sequencetable WHERE name = 'statustable') AS base
+                  FROM statustable WHERE seq IS NULL) AS numbered
+            WHERE statustable.rowid = numbered.id""").rowcount
+        database.execute_sql("""UPDATE sequencetable SET value = MAX(value, (SELECT IFNULL(MAX(seq), 0) FROM statustable))
+            WHERE name = 'statustable'""")
+        database.execute_sql(summary_update)
+    return numbered
+
+
+def create_triggers(database, statements):
+    '''
+    Runs CREATE TRIGGER and CREATE INDEX statements. A trigger that already exists with a different
+    definition, from an older version of this module, is dropped and created again.
+    Returns the names of the replaced triggers.
+    '''
+    existing = dict(database.execute_sql("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall())
+    replaced = []
+    for statement in statements:
+        trigger = re.match(r'CREATE TRIGGER IF NOT EXISTS (\w+)', statement)
+        # SQLite stores the statement as written, less IF NOT EXISTS
+        if trigger and existing.get(trigger[1]) not in (None, statement.replace(' IF NOT EXISTS', '', 1)):
+            logger.info(f'Replacing trigger {trigger[1]} in {database.database}')
+            database.execute_sql(f'DROP TRIGGER {trigger[1]}')
+            replaced.append(trigger[1])
+        database.execute_sql(statement)
+    return replaced
+
+
+MODELS = [UserTable, StatusTable, PictureTable, ServerImageTable, PendingChangeTable, UserSummaryTable,
+          TableVersionTable, JobTable, ChangeLogTable, ChangeLogStateTable, SequenceTable, UserDomainTable]
+
+
+def schema_sql(models):
+    '''
+    CREATE TABLE and CREATE INDEX statements for models, IF NOT EXISTS, parents first as create_tables
+    orders them. Executing these on another database creates the schema there without rebinding the
+    models, which stay on db for every thread.
+    '''
+    # pylint: disable=W0212
+    for model in sort_models(models):
+        yield model._schema._create_table(safe=True).query()
+        for index in model._schema._create_indexes(safe=True):
+            yield index.query()
+
+
+def initialize_database(database):
+    '''Creates the tables, columns and triggers in database, which may be a shard rather than db'''
+    with database.connection_context():
+        new_summaries = not database.table_exists('usersummarytable')
+        new_domains = not database.table_exists('userdomaintable')
+        for sql, params in schema_sql(MODELS):
+            database.execute_sql(sql, params)
+        add_missing_columns(PictureTable, database)
+        add_missing_columns(JobTable, database)
+        added_status_columns = add_missing_columns(StatusTable, database)
+        for table_name in VERSIONED_TABLES:
+            TableVersionTable.insert(table_name=table_name).on_conflict_ignore().execute(database)
+        SequenceTable.insert(name='statustable').on_conflict_ignore().execute(database)
+        if 'seq' in added_status_columns:
+            backfill_status_sequence(database)
+        replaced = create_triggers(database, SUMMARY_TRIGGERS + VERSION_TRIGGERS + CHANGELOG_TRIGGERS
+                                   + STATUS_SEQUENCE_TRIGGERS + USER_SEARCH_TRIGGERS)
+        # Domains written by an older definition of the trigger are recomputed with the current one
+        if new_domains or 'usertable_domain_insert' in replaced:
+            database.execute_sql(f"""INSERT OR REPLACE INTO userdomaintable (user_id, reversed_domain)
+                SELECT user_id, {reversed_domain_sql('email')} FROM usertable""")
+        if new_summaries:
+            rebuild_user_summaries(database=database)
+
+
+def open_backend(backend=BACKEND, warm=WARM_FROM_SQLITE):
+    '''
+    Returns the dataset the curried helpers use: a DataSet over db, a MemoryDataSet, or a ShardedDataSet
+    over the shard files in the working directory (see sharding.py). The memory backend has no triggers,
+    so nothing maintains summaries or versions there, and code querying the peewee models directly
+    only works with the SQLite backend.
+    '''
+    if backend == SQLITE_BACKEND:
+        return DataSet(db)
+    if backend == MEMORY_BACKEND:
+        memory = MemoryDataSet([UserTable, StatusTable, PictureTable, UserSummaryTable])
+        if warm:
+            logger.info(f'Warmed memory backend from {db.database}: {memory.warm(DataSet(db))}')
+        return memory
+    if backend == SHARDED_BACKEND:
+        import sharding  # pylint: disable=C0415
+        return sharding.ShardedDataSet(sharding.ShardedStore(),
+                                       [UserTable, StatusTable, PictureTable, UserSummaryTable])
+    raise ValueError(f'Unknown storage backend: {backend}')
 
 
 def insert_table(database):
@@ -63,10 +437,16 @@ def insert_table(database):
     return insert
 
 
-def search_table(database):
-    '''Generic function to search a single item into a table. Curried in individual modules'''
+def search_table(database, row_type=None):
+    '''
+    Generic function to search a single item into a table. Curried in individual modules.
+    Rows are dicts, or row_type records (see records.py) when one is given.
+    '''
     def search(**kwargs):
-        return database.find_one(**kwargs)
+        row = database.find_one(**kwargs)
+        if row is None or row_type is None:
+            return row
+        return row_type.from_dict(row)
 
     return search
 
@@ -85,9 +465,110 @@ def delete_table(database):
 
     return delete
 
-def search_table_for_many(database):
-    '''Generic function to search for all items that match search in a table. Curried in individual modules'''
+def search_table_for_many(database, row_type=None):
+    '''
+    Generic function to search for all items that match search in a table. Curried in individual modules.
+    With row_type, returns a list of records built while streaming, so no row dicts are kept.
+    '''
     def search_many(**kwargs):
-        return database.find(**kwargs)
+        rows = database.find(**kwargs)
+        if row_type is None:
+            return rows
+        # A peewee query caches every row it yields unless iterated with iterator()
+        rows = rows.iterator() if hasattr(rows, 'iterator') else rows
+        return [row_type.from_dict(row) for row in rows]
 
     return search_many
+
+
+def iter_table(database):
+    '''Streams every row of a table as dicts, without a peewee query caching them all'''
+    rows = database.all()
+    return rows.iterator() if hasattr(rows, 'iterator') else iter(rows)
+
+
+def lookup_table(database, column, row_type=None, many=False):
+    '''
+    Generic function to find the rows where column equals a value, for the hot primary and foreign key
+    searches. Curried in individual modules. Returns one row or None, or a list when many is set.
+    On SQLite the parameterized SQL is built once here; every call runs the same statement text,
+    so the connection's sqlite3 statement cache reuses it instead of DataSet rebuilding the query.
+    Other backends go through find_one/find like the other helpers.
+    '''
+    if not isinstance(database, DataSetTable):
+        find = search_table_for_many(database, row_type) if many else search_table(database, row_type)
+        return lambda value: find(**{column: value})
+
+    columns = database.columns
+    quoted = ', '.join(f'"{name}"' for name in columns)
+    sql = f'SELECT {quoted} FROM "{database.name}" WHERE "{column}" = ?' + ('' if many else ' LIMIT 1')
+    connection = database.model_class._meta.database  # pylint: disable=W0212
+
+    def make_row(values):
+        row = dict(zip(columns, values))
+        return row if row_type is None else row_type.from_dict(row)
+
+    def lookup(value):
+        cursor = connection.execute_sql(sql, (value,))
+        if many:
+            return [make_row(values) for values in cursor]
+        values = cursor.fetchone()
+        return None if values is None else make_row(values)
+
+    return lookup
+
+
+def lookup_many_table(database, column, row_type=None, batch_size=SQLITE_MAX_VARIABLES):
+    '''
+    Generic function to find the rows for many values of a unique column at once. Curried in individual modules.
+    Returns (rows, missing): rows in the order their values were first given, and the values not found.
+    On SQLite the values go in IN (...) batches of batch_size; full batches reuse one cached statement.
+    '''
+    if not isinstance(database, DataSetTable):
+        find = search_table(database, row_type)
+
+        def fetch(batch):
+            rows = (find(**{column: value}) for value in batch)
+            return {row[column]: row for row in rows if row is not None}
+    else:
+        columns = database.columns
+        quoted = ', '.join(f'"{name}"' for name in columns)
+        position = columns.index(column)
+        connection = database.model_class._meta.database  # pylint: disable=W0212
+
+        def fetch(batch):
+            placeholders = ', '.join('?' * len(batch))
+            cursor = connection.execute_sql(
+                f'SELECT {quoted} FROM "{database.name}" WHERE "{column}" IN ({placeholders})', batch)
+            rows = {}
+            for values in cursor:
+                row = dict(zip(columns, values))
+                rows[values[position]] = row if row_type is None else row_type.from_dict(row)
+            return rows
+
+    def lookup_many(values):
+        values = list(dict.fromkeys(values))
+        found = {}
+        for start in range(0, len(values), batch_size):
+            found.update(fetch(values[start:start + batch_size]))
+        return ([found[value] for value in values if value in found],
+                [value for value in values if value not in found])
+
+    return lookup_many
+
+
+# The memory and sharded backends never touch social_network.db unless memory is warmed from it
+if BACKEND == SQLITE_BACKEND or WARM_FROM_SQLITE:
+    initialize_database(db)
+
+ds = open_backend()
+Users = ds["usertable"]
+Statuses = ds["statustable"]
+Pictures = ds["picturetable"]
+Summaries = ds["usersummarytable"]
+# Users.insert(user_id='index_creation')
+# Statuses.insert(status_id='index_creation')
+# Users.create_index(["user_id"], unique=True)
+# Statuses.create_index(["status_id"], unique=True)
+# Users.delete(user_id='index_creation')
+# Statuses.delete(status_id='index_creation')
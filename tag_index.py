@@ -0,0 +1,370 @@
+'''
+In-process bitmap index answering boolean tag queries over pictures, such as
+"#skiing AND #snowboarding AND NOT #F1".
+
+Tags are numbered on first sight and every picture gets a row number; each tag keeps a bitmap of
+the rows carrying it, held in a Python int so AND, OR and NOT are single big-integer operations in C.
+Pictures added through images.add_image are indexed as they are stored, and everything else
+(retags, deletes, other writers) is picked up from the changelog before each query. A snapshot
+on disk lets a new process start from the saved bitmaps and only read the changes since.
+
+Rebuild the snapshot with: python tag_index.py
+Query with: python tag_index.py "#skiing AND NOT #F1"
+'''
+import os
+import re
+import sys
+import json
+import pickle
+import threading
+from itertools import islice
+
+from loguru import logger
+
+import images
+import changelog
+from socialnetwork_model import db, table_versions
+
+SNAPSHOT_PATH = os.environ.get('TAG_INDEX_SNAPSHOT', 'tag_index.snapshot')
+SNAPSHOT_FORMAT = 2
+QUERY_LIMIT = 100
+# Deepest parenthesis nesting a query may use, well inside Python's recursion limit
+MAX_QUERY_DEPTH = 100
+
+_TOKENS = re.compile(r'\(|\)|[^\s()]+')
+_NONZERO = re.compile(rb'[^\x00]')
+_OPERATORS = ('AND', 'OR', 'NOT')
+
+
+class TagQueryError(ValueError):
+    '''Raised for a malformed tag query'''
+
+
+def bitmask(rows):
+    '''A bitmap with the given rows set, built in one pass rather than one big-int copy per row'''
+    if not rows:
+        return 0
+    buffer = bytearray(max(rows) // 8 + 1)
+    for row in rows:
+        buffer[row >> 3] |= 1 << (row & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def iter_rows(bitmap):
+    '''The rows set in bitmap, highest (newest) first'''
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'big')
+    top = len(data) - 1
+    # The regex skips runs of empty bytes in C, so sparse results don't cost a Python step per byte
+    for match in _NONZERO.finditer(data):
+        byte, base = data[match.start()], (top - match.start()) * 8
+        for bit in range(7, -1, -1):
+            if byte >> bit & 1:
+                yield base + bit
+
+
+def check_snapshot(state):
+    '''Raises ValueError unless state has the format and shape save writes, so a bad snapshot is never half-loaded'''
+    if not isinstance(state, dict) or state.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError('Not a tag index snapshot of the current format')
+    tags, bitmaps, picture_ids, row_tags = state['tags'], state['bitmaps'], state['picture_ids'], state['row_tags']
+    valid = (isinstance(tags, list) and all(isinstance(tag, str) for tag in tags) and len(set(tags)) == len(tags)
+             and isinstance(bitmaps, list) and len(bitmaps) == len(tags)
+             and all(isinstance(bitmap, int) for bitmap in bitmaps)
+             and isinstance(picture_ids, list) and len(set(picture_ids)) == len(picture_ids)
+             and isinstance(row_tags, list) and len(row_tags) == len(picture_ids)
+             and all(row is None or (isinstance(row, tuple) and all(
+                 isinstance(tag_id, int) and 0 <= tag_id < len(tags) for tag_id in row)) for row in row_tags)
+             and isinstance(state['live'], int) and isinstance(state['position'], int))
+    if not valid:
+        raise ValueError('Malformed tag index snapshot')
+
+
+class TagIndex:
+    '''Per-tag bitmaps over picture rows, kept current from the changelog'''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        '''Empties the index'''
+        with self._lock:
+            self.tag_ids = {}
+            self.bitmaps = []
+            # Row numbers are never reused: a deleted picture keeps its row, with tags None and out of live
+            self.rows = {}
+            self.picture_ids = []
+            self.row_tags = []
+            self.live = 0
+            self.position = None
+            self.version = None
+            self.database_id = None
+
+    def _tag_id(self, tag):
+        tag_id = self.tag_ids.get(tag)
+        if tag_id is None:
+            tag_id = self.tag_ids[tag] = len(self.bitmaps)
+            self.bitmaps.append(0)
+        return tag_id
+
+    def _row(self, picture_id):
+        row = self.rows.get(picture_id)
+        if row is None:
+            row = self.rows[picture_id] = len(self.picture_ids)
+            self.picture_ids.append(picture_id)
+            self.row_tags.append(None)
+        return row
+
+    def apply(self, changes):
+        '''
+        Folds picturetable changelog entries into the bitmaps. Each bitmap is rewritten at most once
+        per call, with only the net difference between its rows before and after the changes.
+        '''
+        with self._lock:
+            before = {}
+            for change in changes:
+                if change['table'] != 'picturetable':
+                    continue
+                row = self._row(change['key'])
+                before.setdefault(row, self.row_tags[row])
+                if change['operation'] == 'delete':
+                    self.row_tags[row] = None
+                else:
+                    tags = (change['data'] or {}).get('tags') or ''
+                    self.row_tags[row] = tuple(sorted({self._tag_id(tag) for tag in tags.split()}))
+            added, removed = {}, {}
+            live_added, live_removed = [], []
+            for row, old_tags in before.items():
+                new_tags = self.row_tags[row]
+                if (old_tags is None) != (new_tags is None):
+                    (live_removed if new_tags is None else live_added).append(row)
+                old_tags, new_tags = set(old_tags or ()), set(new_tags or ())
+                for tag_id in new_tags - old_tags:
+                    added.setdefault(tag_id, []).append(row)
+                for tag_id in old_tags - new_tags:
+                    removed.setdefault(tag_id, []).append(row)
+            for tag_id in added.keys() | removed.keys():
+                self.bitmaps[tag_id] = ((self.bitmaps[tag_id] & ~bitmask(removed.get(tag_id)))
+                                        | bitmask(added.get(tag_id)))
+            self.live = (self.live & ~bitmask(live_removed)) | bitmask(live_added)
+            return len(before)
+
+    def add(self, picture_id, tags):
+        '''Indexes a newly stored picture; registered as the images.add_image hook'''
+        self.apply([{'table': 'picturetable', 'operation': 'insert', 'key': picture_id, 'data': {'tags': tags}}])
+
+    def rebuild(self):
+        '''Indexes every picture from the table. Returns how many were read'''
+        with self._lock:
+            self.clear()
+            # Bits are set in one growing buffer per tag, each turned into its bitmap once at the end
+            buffers = []
+            with db.atomic():
+                self.position = changelog.latest_seq()
+                self.version = table_versions().get('picturetable')
+                self.database_id = changelog.database_id()
+                for picture_id, tags in db.execute_sql('SELECT picture_id, tags FROM picturetable ORDER BY rowid'):
+                    row = self._row(picture_id)
+                    self.row_tags[row] = tuple(sorted({self._tag_id(tag) for tag in (tags or '').split()}))
+                    for tag_id in self.row_tags[row]:
+                        if tag_id == len(buffers):
+                            buffers.append(bytearray())
+                        buffer = buffers[tag_id]
+                        if len(buffer) <= row >> 3:
+                            buffer.extend(bytes((row >> 3) - len(buffer) + 1))
+                        buffer[row >> 3] |= 1 << (row & 7)
+            self.bitmaps = [int.from_bytes(buffer, 'little') for buffer in buffers]
+            self.live = (1 << len(self.picture_ids)) - 1
+            logger.info(f'Rebuilt tag index: {len(self.rows)} pictures, {len(self.tag_ids)} tags')
+            return len(self.rows)
+
+    def refresh(self):
+        '''Applies changes since the last refresh, rebuilding if retention removed them. Returns changes read'''
+        with self._lock:
+            version = table_versions().get('picturetable')
+            if self.position is None:
+                self.rebuild()
+                return None
+            if version == self.version:
+                return 0
+            read = 0
+            try:
+                for changes in changelog.iter_changes(self.position):
+                    self.apply(changes)
+                    self.position = changes[-1]['seq']
+                    read += len(changes)
+            except changelog.ChangesTruncated:
+                logger.warning('Tag index fell behind changelog retention; rebuilding')
+                self.rebuild()
+                return None
+            self.version = version
+            return read
+
+    def evaluate(self, query):
+        '''The bitmap of pictures matching query. Raises TagQueryError'''
+        with self._lock:
+            return _Parser(self, query).parse()
+
+    def search(self, query, limit=QUERY_LIMIT):
+        '''Newest first, up to limit picture_ids matching query and how many match in all'''
+        self.refresh()
+        with self._lock:
+            bitmap = self.evaluate(query)
+            picture_ids = [self.picture_ids[row] for row in islice(iter_rows(bitmap), limit)]
+        return {'count': bitmap.bit_count(), 'picture_ids': picture_ids}
+
+    def save(self, path=SNAPSHOT_PATH):
+        '''Writes the index to path, replacing any older snapshot only once the new one is complete'''
+        with self._lock:
+            state = {'format': SNAPSHOT_FORMAT, 'database_id': self.database_id, 'position': self.position,
+                     'version': self.version, 'tags': list(self.tag_ids), 'bitmaps': self.bitmaps,
+                     'picture_ids': self.picture_ids, 'row_tags': self.row_tags, 'live': self.live}
+            with open(f'{path}.tmp', 'wb') as file:
+                pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{path}.tmp', path)
+        logger.info(f'Saved tag index snapshot to {path} at changelog seq {state["position"]}')
+
+    def load(self, path=SNAPSHOT_PATH):
+        '''Restores a snapshot written by save. Returns False if there is none usable for this database'''
+        try:
+            with open(path, 'rb') as file:
+                state = pickle.load(file)
+            check_snapshot(state)
+        except OSError as error:
+            logger.info(f'No tag index snapshot loaded from {path}: {error}')
+            return False
+        except Exception as error:  # pylint: disable=W0718
+            # Unpickling a damaged or foreign file can raise nearly anything; the caller rebuilds instead
+            logger.warning(f'Ignoring unusable tag index snapshot {path}: {error!r}')
+            return False
+        # The changelog positions of a deleted and recreated database restart, so a snapshot of the old one
+        # must not be caught up from the new one's changelog
+        if state['database_id'] != changelog.database_id():
+            logger.warning(f'Ignoring tag index snapshot {path} written for another database')
+            return False
+        with self._lock:
+            self.tag_ids = {tag: tag_id for tag_id, tag in enumerate(state['tags'])}
+            self.bitmaps = state['bitmaps']
+            self.picture_ids = state['picture_ids']
+            self.rows = {picture_id: row for row, picture_id in enumerate(self.picture_ids)}
+            self.row_tags = state['row_tags']
+            self.live = state['live']
+            self.position = state['position']
+            self.version = state['version']
+            self.database_id = state['database_id']
+        return True
+
+
+class _Parser:
+    '''
+    Recursive descent over a tag query, evaluating as it goes. NOT binds tightest, then AND, then OR;
+    adjacent terms are ANDed, and parentheses group. Tags not in the index match nothing.
+    '''
+
+    def __init__(self, index, query):
+        self.index = index
+        self.tokens = _TOKENS.findall(query)
+        self.position = 0
+        self.depth = 0
+
+    def peek(self):
+        '''The next token, with operators upper-cased, or None at the end'''
+        if self.position == len(self.tokens):
+            return None
+        token = self.tokens[self.position]
+        return token.upper() if token.upper() in _OPERATORS else token
+
+    def take(self):
+        '''Consumes and returns the next token'''
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        '''Evaluates the whole query'''
+        if not self.tokens:
+            raise TagQueryError('Empty tag query')
+        bitmap = self.union()
+        if self.peek() is not None:
+            raise TagQueryError(f'Unexpected {self.peek()!r} in tag query')
+        return bitmap
+
+    def union(self):
+        '''term (OR term)*'''
+        bitmap = self.intersection()
+        while self.peek() == 'OR':
+            self.take()
+            bitmap |= self.intersection()
+        return bitmap
+
+    def intersection(self):
+        '''factor ([AND] factor)*'''
+        bitmap = self.factor()
+        while self.peek() not in (None, 'OR', ')'):
+            if self.peek() == 'AND':
+                self.take()
+            bitmap &= self.factor()
+        return bitmap
+
+    def factor(self):
+        '''NOT factor | ( union ) | tag'''
+        # A run of NOTs is folded here rather than recursed into, since only its parity matters
+        negate = False
+        while self.peek() == 'NOT':
+            self.take()
+            negate = not negate
+        bitmap = self.operand()
+        return self.index.live & ~bitmap if negate else bitmap
+
+    def operand(self):
+        '''( union ) | tag'''
+        token = self.take()
+        if token == '(':
+            self.depth += 1
+            if self.depth > MAX_QUERY_DEPTH:
+                raise TagQueryError(f'Tag query nests parentheses more than {MAX_QUERY_DEPTH} deep')
+            bitmap = self.union()
+            if self.take() != ')':
+                raise TagQueryError('Unbalanced parentheses in tag query')
+            self.depth -= 1
+            return bitmap
+        if token in (None, ')', 'AND', 'OR'):
+            raise TagQueryError(f'Expected a tag, got {token or "end of query"!r}')
+        tag_id = self.index.tag_ids.get(token)
+        return 0 if tag_id is None else self.index.bitmaps[tag_id]
+
+
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+
+def get_index(snapshot=SNAPSHOT_PATH):
+    '''
+    The process's tag index, loaded from snapshot (or built) on first use and registered so
+    images.add_image keeps it current
+    '''
+    global _INDEX  # pylint: disable=W0603
+    with _INDEX_LOCK:
+        if _INDEX is None:
+            index = TagIndex()
+            index.load(snapshot)
+            if index.refresh() is None:
+                # Rebuilt from the table; save so the next process starts from the snapshot
+                index.save(snapshot)
+            images.set_image_added_hook(index.add)
+            _INDEX = index
+        return _INDEX
+
+
+def search(query, limit=QUERY_LIMIT):
+    '''Pictures matching a boolean tag query: {'count', 'picture_ids' newest first}. Raises TagQueryError'''
+    return get_index().search(query, limit)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        print(json.dumps(search(' '.join(sys.argv[1:]))))
+    else:
+        rebuilt = TagIndex()
+        rebuilt.rebuild()
+        rebuilt.save()
@@ -0,0 +1,416 @@
+'''
+Tests api.py through the Flask test client
+'''
+# pylint: disable=R0904
+import os
+import gzip
+import json
+import time
+import shutil
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import api
+import jobs
+import main
+import changelog
+import events
+import analytics
+import tag_index
+from socialnetwork_model import db, Users, Statuses, Pictures, JobTable, ChangeLogStateTable
+from images import PICTURE_DIR
+
+
+class TestApi(unittest.TestCase):
+    '''Defines test cases for api.py'''
+
+    def setUp(self):
+        '''Adds a known user, status and picture row, and clears the pictures directory'''
+        self.client = api.app.test_client()
+        # Admission limits are only exercised by the tests that set them
+        limits = patch.dict(api.ROUTE_LIMITS, clear=True)
+        limits.start()
+        self.addCleanup(limits.stop)
+        Users.insert(user_id='chaygood', email='chaygood@uw.edu', first_name='Cameron', last_name='Haygood')
+        Statuses.insert(status_id='chaygood0001', user_id='chaygood', status_text='This is my default test status!')
+        Pictures.insert(picture_id='0000000001', user_id='chaygood', tags='#F1 #golf')
+        shutil.rmtree(PICTURE_DIR, ignore_errors=True)
+
+    def tearDown(self):
+        '''Empties the tables and pictures directory'''
+        JobTable.delete().execute()  # pylint: disable=E1120
+        ChangeLogStateTable.delete().execute()  # pylint: disable=E1120
+        Pictures.delete()
+        Statuses.delete()
+        Users.delete()
+        shutil.rmtree(PICTURE_DIR, ignore_errors=True)
+
+    def test_users(self):
+        '''Tests that /users lists every user'''
+        response = self.client.get('/users')
+        self.assertEqual(response.get_json(), [{'user_id': 'chaygood', 'first_name': 'Cameron',
+                                                'last_name': 'Haygood', 'email': 'chaygood@uw.edu'}])
+
+    def test_multi_get(self):
+        '''Tests /users?ids= and POST /statuses return rows in input order with missing IDs'''
+        user = {'user_id': 'chaygood', 'first_name': 'Cameron', 'last_name': 'Haygood', 'email': 'chaygood@uw.edu'}
+        response = self.client.get('/users?ids=nobody,chaygood')
+        self.assertEqual(response.get_json(), {'users': [user], 'missing': ['nobody']})
+        response = self.client.post('/statuses', json={'ids': ['chaygood0001', 'chaygood0001', 'gone']})
+        self.assertEqual([status['status_id'] for status in response.get_json()['statuses']], ['chaygood0001'])
+        self.assertEqual(response.get_json()['missing'], ['gone'])
+        self.assertEqual(self.client.post('/users', json={}).status_code, 400)
+        self.assertEqual(self.client.post('/users', json=['chaygood']).status_code, 400)
+        with patch.object(api, 'MAX_IDS', 1):
+            self.assertEqual(self.client.get('/users?ids=a,b').status_code, 400)
+
+    def test_user_timeline(self):
+        '''Tests /users/<user_id>/timeline pages backwards with next_before'''
+        Statuses.insert(status_id='chaygood0002', user_id='chaygood', status_text='newer')
+        body = self.client.get('/users/chaygood/timeline?limit=1').get_json()
+        self.assertEqual([status['status_text'] for status in body['statuses']], ['newer'])
+        body = self.client.get(f"/users/chaygood/timeline?limit=1&before={body['next_before']}").get_json()
+        self.assertEqual([status['status_id'] for status in body['statuses']], ['chaygood0001'])
+        body = self.client.get(f"/users/chaygood/timeline?before={body['next_before']}").get_json()
+        self.assertEqual(body, {'statuses': [], 'next_before': None})
+        self.assertEqual(self.client.get('/users/chaygood/timeline?limit=0').status_code, 400)
+
+    def test_find_users(self):
+        '''Tests /users?prefix= and ?email_domain= search names, emails and domains'''
+        body = self.client.get('/users?prefix=cam').get_json()
+        self.assertEqual([user['user_id'] for user in body['users']], ['chaygood'])
+        body = self.client.get('/users?email_domain=UW.edu&prefix=nobody').get_json()
+        self.assertEqual(body, {'users': []})
+        self.assertEqual(self.client.get('/users?prefix=').status_code, 400)
+
+    def test_changes(self):
+        '''Tests /changes pages through updates and deletes after a given seq'''
+        start = changelog.latest_seq()
+        Users.update(['user_id'], user_id='chaygood', email='new@uw.edu')
+        Users.delete(user_id='chaygood')
+        body = self.client.get(f'/changes?since={start}&limit=2').get_json()
+        self.assertEqual([(change['table'], change['operation'], change['key']) for change in body['changes']],
+                         [('usertable', 'update', 'chaygood'), ('statustable', 'delete', 'chaygood0001')])
+        self.assertEqual(body['changes'][0]['data']['email'], 'new@uw.edu')
+        body = self.client.get(f"/changes?since={body['next_since']}").get_json()
+        self.assertEqual([change['operation'] for change in body['changes']], ['delete', 'delete'])
+        self.assertEqual(body['next_since'], body['latest'])
+        self.assertEqual(self.client.get('/changes?limit=0').status_code, 400)
+
+    def test_changelog_compaction(self):
+        '''Compaction keeps the latest entry per row; retention makes older positions resync with 410'''
+        start = changelog.latest_seq()
+        Users.update(['user_id'], user_id='chaygood', email='first@uw.edu')
+        Users.update(['user_id'], user_id='chaygood', email='second@uw.edu')
+        db.execute_sql("UPDATE changelogtable SET changed_at = datetime('now', '-2 hours') WHERE seq > ?", (start,))
+        result = changelog.compact_changelog(compact_after=3600, retention=10 ** 9, max_rows=None)
+        self.assertEqual(result['compacted'], 1)
+        changes = self.client.get(f'/changes?since={start}').get_json()['changes']
+        self.assertEqual([change['data']['email'] for change in changes], ['second@uw.edu'])
+        changelog.compact_changelog(compact_after=3600, retention=10 ** 9, max_rows=1)
+        response = self.client.get('/changes?since=0')
+        self.assertEqual(response.status_code, 410)
+        truncated = response.get_json()['truncated_through']
+        changes = self.client.get(f'/changes?since={truncated}').get_json()['changes']
+        self.assertEqual([change['data']['email'] for change in changes], ['second@uw.edu'])
+
+    def test_iter_changes(self):
+        '''iter_changes pages through everything after since, and raises once retention removed part of it'''
+        start = changelog.latest_seq()
+        for email in ('first@uw.edu', 'second@uw.edu', 'third@uw.edu'):
+            Users.update(['user_id'], user_id='chaygood', email=email)
+        pages = list(changelog.iter_changes(start, page_size=2))
+        self.assertEqual([[change['data']['email'] for change in page] for page in pages],
+                         [['first@uw.edu', 'second@uw.edu'], ['third@uw.edu']])
+        self.assertEqual(list(changelog.iter_changes(changelog.latest_seq())), [])
+        changelog.compact_changelog(compact_after=10 ** 9, retention=10 ** 9, max_rows=1)
+        with self.assertRaises(changelog.ChangesTruncated):
+            list(changelog.iter_changes(start))
+
+    def test_tag_stats(self):
+        '''Tests /stats/tags and /stats/tags/pairs follow inserts, retags and deletes'''
+        Pictures.insert(picture_id='0000000002', user_id='chaygood', tags='#golf #skiing')
+        self.assertEqual(self.client.get('/stats/tags?limit=1').get_json(), [{'tag': '#golf', 'pictures': 2}])
+        self.assertEqual(self.client.get('/stats/tags/pairs', query_string={'tag': '#skiing'}).get_json(),
+                         [{'tags': ['#golf', '#skiing'], 'pictures': 1}])
+        Pictures.update(['picture_id'], picture_id='0000000002', tags='#F1 #skiing')
+        Pictures.delete(picture_id='0000000001')
+        self.assertEqual(self.client.get('/stats/tags').get_json(),
+                         [{'tag': '#F1', 'pictures': 1}, {'tag': '#skiing', 'pictures': 1}])
+        self.assertEqual(self.client.get('/stats/tags/pairs').get_json(),
+                         [{'tags': ['#F1', '#skiing'], 'pictures': 1}])
+        self.assertEqual(self.client.get('/stats/tags?limit=0').status_code, 400)
+
+    def test_tag_stats_incremental(self):
+        '''Tag stats apply only new changes, and rebuild when retention has removed their position'''
+        stats = analytics.TagStats()
+        self.assertIsNone(stats.refresh())
+        self.assertEqual(stats.refresh(), 0)
+        Pictures.insert(picture_id='0000000002', user_id='chaygood', tags='#golf #golf')
+        self.assertEqual(stats.refresh(), 1)
+        self.assertEqual(stats.tags['#golf'], 2)
+        Pictures.insert(picture_id='0000000003', user_id='chaygood', tags='#golf')
+        changelog.compact_changelog(compact_after=10 ** 9, retention=10 ** 9, max_rows=0)
+        self.assertIsNone(stats.refresh())
+        self.assertEqual(stats.top_tags(1), [{'tag': '#golf', 'pictures': 3}])
+
+    def test_picture_search(self):
+        '''Tests /pictures/search evaluates boolean tag queries and rejects malformed ones'''
+        Pictures.insert(picture_id='0000000002', user_id='chaygood', tags='#golf #skiing')
+        with patch.object(tag_index, '_INDEX', tag_index.TagIndex()):
+            response = self.client.get('/pictures/search', query_string={'q': '#golf AND NOT #F1'})
+            self.assertEqual(response.get_json(), {'count': 1, 'picture_ids': ['0000000002']})
+            response = self.client.get('/pictures/search', query_string={'q': '#golf AND (#F1'})
+            self.assertEqual(response.status_code, 400)
+
+    def test_statuses_per_user(self):
+        '''Tests /stats/statuses_per_user reports the distribution of statuses across users'''
+        Users.insert(user_id='quiet', email='quiet@uw.edu', first_name='Quiet', last_name='User')
+        Statuses.insert(status_id='chaygood0002', user_id='chaygood', status_text='Another')
+        body = self.client.get('/stats/statuses_per_user').get_json()
+        self.assertEqual(body['distribution'], [{'statuses': 0, 'users': 1}, {'statuses': 2, 'users': 1}])
+        self.assertEqual((body['users'], body['statuses'], body['mean'], body['max']), (2, 2, 1.0, 2))
+        Statuses.delete(status_id='chaygood0002')
+        self.assertEqual(self.client.get('/stats/statuses_per_user').get_json()['statuses'], 1)
+
+    def publisher(self, buffer_size=events.SUBSCRIBER_BUFFER):
+        '''Swaps in a publisher that only polls when the test calls poll()'''
+        publisher = events.ChangePublisher(interval=3600, buffer_size=buffer_size)
+        self.addCleanup(publisher.stop)
+        patcher = patch.object(api, 'PUBLISHER', publisher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return publisher
+
+    def test_events(self):
+        '''Tests /events pushes matching inserts to subscribers and unsubscribes on close'''
+        publisher = self.publisher()
+        with self.client.get('/events?tables=statuses', buffered=False) as response:
+            stream = iter(response.response)
+            self.assertEqual(next(stream), b': connected\n\n')
+            Pictures.insert(picture_id='0000000002', user_id='chaygood', tags='#golf')
+            Statuses.insert(status_id='chaygood0002', user_id='chaygood', status_text='Pushed!')
+            self.assertEqual(publisher.poll(), 2)
+            lines = next(stream).decode().split('\n')
+            self.assertEqual(lines[1], 'event: statuses.insert')
+            self.assertEqual(json.loads(lines[2][len('data: '):])['data']['status_text'], 'Pushed!')
+        self.assertEqual(publisher.subscribers, set())
+        self.assertEqual(self.client.get('/events?tables=nothing').status_code, 400)
+
+    def test_events_overflow_and_resume(self):
+        '''Tests a slow subscriber is dropped after its buffer and resumes from the changelog'''
+        publisher = self.publisher(buffer_size=1)
+        start = changelog.latest_seq()
+        with self.client.get('/events', headers={'Last-Event-ID': str(start)}, buffered=False) as response:
+            stream = iter(response.response)
+            next(stream)
+            Statuses.insert(status_id='chaygood0002', user_id='chaygood', status_text='first')
+            Statuses.insert(status_id='chaygood0003', user_id='chaygood', status_text='second')
+            publisher.poll()
+            self.assertEqual(publisher.dropped, 1)
+            self.assertIn(b'"status_text":"first"', next(stream).replace(b' ', b''))
+            overflow = next(stream).decode().split('\n')
+        self.assertEqual(overflow[0], 'event: overflow')
+        reconnect_from = json.loads(overflow[1][len('data: '):])['reconnect_from']
+        with self.client.get('/events', headers={'Last-Event-ID': str(reconnect_from)}, buffered=False) as response:
+            stream = iter(response.response)
+            next(stream)
+            self.assertIn(b'"status_text":"second"', next(stream).replace(b' ', b''))
+
+    def test_diff(self):
+        '''Tests that /diff/<user_id> reports the picture row without a file'''
+        response = self.client.get('/diff/chaygood')
+        self.assertEqual(response.get_json(), {'missing_from_db': [],
+                                               'missing_from_server': [['chaygood', 'F1/golf', '0000000001.png']]})
+
+    def test_differences(self):
+        '''Tests that /differences reports every user's differences as JSON, NDJSON and pages'''
+        main.add_image('chaygood', '#skiing #golf')
+        stray = os.path.join(PICTURE_DIR, 'chaygood', 'surfing', '0000000009.png')
+        os.makedirs(os.path.dirname(stray))
+        with open(stray, 'w') as image:
+            image.write('copied outside the application')
+        expected = [{'difference': 'missing_from_server', 'user_id': 'chaygood', 'tags': 'F1/golf',
+                     'file': '0000000001.png'},
+                    {'difference': 'missing_from_db', 'user_id': 'chaygood', 'tags': 'surfing',
+                     'file': '0000000009.png'}]
+        self.assertEqual(self.client.get('/differences').get_json(), expected)
+        lines = self.client.get('/differences?format=ndjson').get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], expected)
+        page = self.client.get('/differences?limit=1&offset=1').get_json()
+        self.assertEqual(page, {'differences': expected[1:], 'next_offset': None})
+
+    def test_differences_bad_page(self):
+        '''Tests that /differences rejects out of range limits and negative offsets'''
+        for query in ('limit=0', 'limit=-5', 'limit=10001', 'limit=2&offset=-1'):
+            self.assertEqual(self.client.get(f'/differences?{query}').status_code, 400, query)
+
+    def test_differences_empty(self):
+        '''Tests that /differences returns an empty JSON array when everything is in sync'''
+        Pictures.delete()
+        self.assertEqual(self.client.get('/differences').get_json(), [])
+
+    def test_diff_verify(self):
+        '''Tests that /diff/<user_id>?verify=1 adds content mismatches'''
+        main.add_image('chaygood', '#golf', b'original bytes')
+        with open(os.path.join(PICTURE_DIR, 'chaygood', 'golf', '0000000002.png'), 'wb') as image:
+            image.write(b'swapped')
+        response = self.client.get('/diff/chaygood?verify=1')
+        self.assertEqual(response.get_json()['content_mismatch'], [['chaygood', 'golf', '0000000002.png']])
+
+    def test_user_summary(self):
+        '''Tests that /users/<user_id>/summary serves the counters, or {} for an unknown user'''
+        summary = self.client.get('/users/chaygood/summary').get_json()
+        self.assertEqual((summary['status_count'], summary['picture_count']), (1, 1))
+        self.assertEqual(self.client.get('/users/nobody/summary').get_json(), {})
+
+    def test_users_include(self):
+        '''Tests that /users?include= nests each user's statuses and pictures'''
+        Users.insert(user_id='test01', email='test01@uw.edu', first_name='Bad', last_name='Outcomes')
+        users = self.client.get('/users?include=statuses,pictures').get_json()
+        self.assertEqual([user['user_id'] for user in users], ['chaygood', 'test01'])
+        self.assertEqual(users[0]['statuses'], [{'status_id': 'chaygood0001', 'user_id': 'chaygood',
+                                                 'status_text': 'This is my default test status!'}])
+        self.assertEqual(users[0]['pictures'], [{'picture_id': '0000000001', 'user_id': 'chaygood',
+                                                 'tags': '#F1 #golf'}])
+        self.assertEqual((users[1]['statuses'], users[1]['pictures']), ([], []))
+        self.assertEqual(self.client.get('/users?include=friends').status_code, 400)
+
+    def test_users_keyset_pages(self):
+        '''Tests paging through /users with limit and after'''
+        Users.insert(user_id='test01', email='test01@uw.edu', first_name='Bad', last_name='Outcomes')
+        page = self.client.get('/users?limit=1&include=statuses').get_json()
+        self.assertEqual([user['user_id'] for user in page['users']], ['chaygood'])
+        self.assertEqual(page['next_after'], 'chaygood')
+        page = self.client.get('/users?limit=1&after=chaygood').get_json()
+        self.assertEqual([user['user_id'] for user in page['users']], ['test01'])
+        page = self.client.get('/users?limit=1&after=test01').get_json()
+        self.assertEqual(page, {'users': [], 'next_after': None})
+        for limit in (0, -1, api.MAX_USER_PAGE + 1):
+            self.assertEqual(self.client.get(f'/users?limit={limit}&include=statuses').status_code, 400, limit)
+
+    def test_compressed_cache(self):
+        '''Tests gzip negotiation and that cached bodies are replaced when the table changes'''
+        response = self.client.get('/statuses', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.data))), 1)
+        hits = self.client.get('/metrics').get_json().get('response_cache_hits', 0)
+        self.client.get('/statuses', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(self.client.get('/metrics').get_json()['response_cache_hits'], hits + 1)
+        Statuses.insert(status_id='chaygood0002', user_id='chaygood', status_text='Another status')
+        response = self.client.get('/statuses', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(len(json.loads(gzip.decompress(response.data))), 2)
+        self.assertNotIn('Content-Encoding', self.client.get('/statuses').headers)
+        self.assertIn('gzip_compression_ratio', self.client.get('/metrics').get_json())
+
+    def test_admission_rate_limit(self):
+        '''Tests that requests beyond the token bucket are shed with 429 and Retry-After'''
+        with patch.dict(api.ROUTE_LIMITS, {'diff': api.RouteLimit(concurrency=2, rate=0.5, burst=1, max_wait=0)}):
+            self.assertEqual(self.client.get('/diff/chaygood').status_code, 200)
+            response = self.client.get('/diff/chaygood')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], '2')
+        self.assertGreaterEqual(self.client.get('/metrics').get_json()['diff_rate_limited'], 1)
+
+    def test_admission_concurrency_limit(self):
+        '''Tests that a request waiting longer than max_wait for a slot is shed'''
+        limit = api.RouteLimit(concurrency=1, rate=100, burst=100, max_wait=0.05)
+        with patch.dict(api.ROUTE_LIMITS, {'differences': limit}):
+            limit.slots.acquire()
+            self.assertEqual(self.client.get('/differences').status_code, 429)
+            limit.slots.release()
+            response = self.client.get('/differences')
+            self.assertEqual(response.get_json(), [{'difference': 'missing_from_server', 'user_id': 'chaygood',
+                                                    'tags': 'F1/golf', 'file': '0000000001.png'}])
+            response.close()
+            self.assertTrue(limit.slots.acquire(blocking=False))
+        self.assertGreaterEqual(self.client.get('/metrics').get_json()['differences_shed'], 1)
+
+    def test_jobs(self):
+        '''Tests submitting, deduplicating, running and polling a reconcile job'''
+        response = self.client.post('/jobs', json={'kind': 'reconcile', 'params': {'user_id': 'chaygood'}})
+        self.assertEqual(response.status_code, 202)
+        job_id = response.get_json()['job_id']
+        duplicate = self.client.post('/jobs', json={'kind': 'reconcile', 'params': {'user_id': 'chaygood'}})
+        self.assertEqual(duplicate.get_json(), {'job_id': job_id, 'deduplicated': True})
+        self.assertEqual(self.client.get(f'/jobs/{job_id}').get_json()['status'], 'queued')
+
+        self.assertTrue(jobs.run_next_job())
+        job = self.client.get(f'/jobs/{job_id}').get_json()
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['result'], {'missing_from_db': [],
+                                         'missing_from_server': [['chaygood', 'F1/golf', '0000000001.png']]})
+        self.assertEqual(self.client.get('/jobs/999999').status_code, 404)
+        self.assertEqual(self.client.post('/jobs', json={'kind': 'format_disk'}).status_code, 400)
+        self.assertEqual(self.client.post('/jobs', json=['reconcile']).status_code, 400)
+        self.assertEqual(self.client.post('/jobs', json={'kind': 'reconcile', 'params': ['chaygood']}).status_code,
+                         400)
+
+    def test_failed_job(self):
+        '''Tests that a job raising an error is marked failed with the error'''
+        job_id, _ = jobs.submit_job('load_users', {})
+        self.assertTrue(jobs.run_next_job())
+        job = jobs.job_status(job_id)
+        self.assertEqual(job['status'], 'failed')
+        self.assertIn('KeyError', job['error'])
+
+    def test_second_worker_leaves_running_job(self):
+        '''Tests that a worker starting while another runs a job doesn't run it again'''
+        started, release, runs = threading.Event(), threading.Event(), []
+
+        def blocking_job(_params, _progress):
+            runs.append(threading.current_thread().name)
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        stops = [threading.Event(), threading.Event()]
+        with patch.dict(jobs.JOB_KINDS, {'blocking': blocking_job}), patch.object(jobs, 'POLL_INTERVAL', 0.01):
+            job_id, _ = jobs.submit_job('blocking')
+            workers = [threading.Thread(target=jobs.run_worker, args=(1, stops[0]))]
+            workers[0].start()
+            self.assertTrue(started.wait(5))
+            workers.append(threading.Thread(target=jobs.run_worker, args=(1, stops[1])))
+            workers[1].start()
+            time.sleep(0.2)
+            self.assertEqual(jobs.job_status(job_id)['status'], 'running')
+            release.set()
+            while jobs.job_status(job_id)['status'] == 'running':
+                time.sleep(0.01)
+            for stop, worker in zip(stops, workers):
+                stop.set()
+                worker.join()
+        self.assertEqual((jobs.job_status(job_id)['status'], len(runs)), ('done', 1))
+
+    def test_lapsed_lease_is_requeued(self):
+        '''Tests that only a running job whose lease has lapsed goes back in the queue'''
+        lapsed, _ = jobs.submit_job('load_users', {'filename': 'lapsed.csv'})
+        live, _ = jobs.submit_job('load_users', {'filename': 'live.csv'})
+        jobs.claim_job('stopped-worker')
+        jobs.claim_job('live-worker')
+        JobTable.update(lease_until=datetime.now() - timedelta(seconds=1)).where(  # pylint: disable=E1120
+            JobTable.job_id == lapsed).execute()
+        self.assertEqual(jobs.requeue_interrupted_jobs(), 1)
+        self.assertEqual((jobs.job_status(lapsed)['status'], jobs.job_status(live)['status']), ('queued', 'running'))
+
+    def test_snapshot_reads(self):
+        '''Tests that reads come from the snapshot, with its age in a header, until it is refreshed'''
+        snapshot = 'test_snapshot.db'
+        try:
+            with api.app.app_context():
+                api.refresh_snapshot(snapshot)
+            Statuses.insert(status_id='chaygood0002', user_id='chaygood', status_text='Written after the snapshot')
+            response = self.client.get('/statuses')
+            self.assertEqual(len(response.get_json()), 1)
+            self.assertIn('X-Snapshot-Age', response.headers)
+            self.assertIn('X-Snapshot-Age', self.client.get('/users?include=statuses').headers)
+            self.assertNotIn('X-Snapshot-Age', self.client.get('/users/chaygood/timeline').headers)
+            with api.app.app_context():
+                api.refresh_snapshot(snapshot)
+            self.assertEqual(len(self.client.get('/statuses').get_json()), 2)
+        finally:
+            api.disable_snapshot()
+            os.remove(snapshot)
+        self.assertNotIn('X-Snapshot-Age', self.client.get('/statuses').headers)
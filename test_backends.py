@@ -0,0 +1,188 @@
+'''
+Conformance tests every storage backend behind the curried table helpers must pass
+'''
+# pylint: disable=E1101,C0103
+import shutil
+import tempfile
+import unittest
+
+from peewee import SqliteDatabase, IntegrityError
+from playhouse.dataset import DataSet
+
+from memory_backend import MemoryDataSet
+from sharding import ShardedDataSet, ShardedStore
+from records import UserRow, StatusRow
+from socialnetwork_model import (initialize_database, insert_table, search_table, update_table, delete_table,
+                                 search_table_for_many, lookup_table, lookup_many_table, UserTable, StatusTable, PictureTable,
+                                 UserSummaryTable)
+
+
+class BackendConformance:
+    '''Test cases run against self.dataset, which each backend's TestCase provides in open_dataset'''
+
+    def open_dataset(self):
+        '''Returns an empty dataset with usertable, statustable and picturetable'''
+        raise NotImplementedError
+
+    def setUp(self):
+        '''Opens an empty dataset with one user and one status'''
+        self.dataset = self.open_dataset()
+        self.users = self.dataset['usertable']
+        self.statuses = self.dataset['statustable']
+        self.pictures = self.dataset['picturetable']
+        self.assertTrue(insert_table(self.users)(user_id='chaygood', email='chaygood@uw.edu',
+                                                 first_name='Cameron', last_name='Haygood'))
+        self.assertTrue(insert_table(self.statuses)(status_id='chaygood0001', user_id='chaygood',
+                                                    status_text='This is my default test status!'))
+
+    def test_insert_and_search(self):
+        '''Inserted rows come back as dicts with every column, missing rows as None'''
+        self.assertEqual(search_table(self.users)(user_id='chaygood'),
+                         {'user_id': 'chaygood', 'first_name': 'Cameron', 'last_name': 'Haygood',
+                          'email': 'chaygood@uw.edu'})
+        self.assertEqual(search_table(self.users)(email='chaygood@uw.edu')['user_id'], 'chaygood')
+        self.assertIsNone(search_table(self.users)(user_id='nobody'))
+        self.assertIsNone(search_table(self.users)(user_id='chaygood', email='other@uw.edu'))
+
+    def test_insert_constraints(self):
+        '''Duplicate keys, missing NOT NULL columns and unknown parents are rejected'''
+        insert_user = insert_table(self.users)
+        self.assertFalse(insert_user(user_id='chaygood', email='e', first_name='f', last_name='l'))
+        self.assertFalse(insert_user(user_id='noemail', first_name='f', last_name='l'))
+        self.assertFalse(insert_table(self.statuses)(status_id='orphan', user_id='nobody', status_text='x'))
+        self.assertIsNone(search_table(self.users)(user_id='noemail'))
+
+    def test_values_are_coerced(self):
+        '''Values are stored as the column's type, as a SQLite round trip would'''
+        insert_table(self.statuses)(status_id=42, user_id='chaygood', status_text=7)
+        status = search_table(self.statuses)(status_id='42')
+        self.assertEqual(status['status_text'], '7')
+
+    def test_lookup(self):
+        '''Key lookups match find_one and find, as dicts or records'''
+        lookup_user = lookup_table(self.users, 'user_id')
+        self.assertEqual(lookup_user('chaygood'), search_table(self.users)(user_id='chaygood'))
+        self.assertIsNone(lookup_user('nobody'))
+        self.assertEqual(lookup_table(self.users, 'user_id', UserRow)('chaygood').email, 'chaygood@uw.edu')
+        insert_table(self.statuses)(status_id='chaygood0002', user_id='chaygood', status_text='text')
+        statuses = lookup_table(self.statuses, 'user_id', StatusRow, many=True)('chaygood')
+        self.assertEqual([status.status_id for status in statuses], ['chaygood0001', 'chaygood0002'])
+        self.assertEqual(lookup_table(self.statuses, 'user_id', many=True)('nobody'), [])
+
+    def test_lookup_many(self):
+        '''Multi-gets keep input order, drop repeats and report missing values, across batches'''
+        insert_table(self.users)(user_id='other', email='e', first_name='f', last_name='l')
+        found, missing = lookup_many_table(self.users, 'user_id', UserRow, batch_size=2)(
+            ['nobody', 'other', 'chaygood', 'other', 'gone'])
+        self.assertEqual([user.user_id for user in found], ['other', 'chaygood'])
+        self.assertEqual(missing, ['nobody', 'gone'])
+        self.assertEqual(lookup_many_table(self.users, 'user_id')([]), ([], []))
+
+    def test_search_many(self):
+        '''Every match comes back, in insertion order'''
+        insert_status = insert_table(self.statuses)
+        for i in range(2, 6):
+            insert_status(status_id=f'chaygood000{i}', user_id='chaygood', status_text='text')
+        found = list(search_table_for_many(self.statuses)(user_id='chaygood'))
+        self.assertEqual([status['status_id'] for status in found], [f'chaygood000{i}' for i in range(1, 6)])
+        self.assertEqual(list(search_table_for_many(self.statuses)(user_id='nobody')), [])
+        self.assertEqual(len(self.statuses), 5)
+
+    def test_update(self):
+        '''Updates match on the key columns, set the rest and return the row count'''
+        update_user = update_table(self.users)
+        self.assertEqual(update_user(['user_id'], user_id='chaygood', email='new@uw.edu'), 1)
+        self.assertEqual(search_table(self.users)(user_id='chaygood')['email'], 'new@uw.edu')
+        self.assertEqual(update_user(['user_id'], user_id='nobody', email='new@uw.edu'), 0)
+        self.assertEqual(search_table(self.users)(email='new@uw.edu')['user_id'], 'chaygood')
+
+    def test_update_constraints(self):
+        '''Updates can't point at a missing parent or orphan children'''
+        with self.assertRaises(IntegrityError):
+            update_table(self.statuses)(['status_id'], status_id='chaygood0001', user_id='nobody')
+        with self.assertRaises(IntegrityError):
+            update_table(self.users)(['email'], email='chaygood@uw.edu', user_id='renamed')
+        self.assertEqual(search_table(self.statuses)(status_id='chaygood0001')['user_id'], 'chaygood')
+
+    def test_delete_cascades(self):
+        '''Deleting a user deletes their statuses and pictures'''
+        insert_table(self.pictures)(picture_id='0000000001', user_id='chaygood', tags='#F1 #golf')
+        self.assertEqual(delete_table(self.users)(user_id='chaygood'), 1)
+        self.assertIsNone(search_table(self.statuses)(status_id='chaygood0001'))
+        self.assertIsNone(search_table(self.pictures)(picture_id='0000000001'))
+        self.assertEqual(delete_table(self.users)(user_id='chaygood'), 0)
+
+    def test_delete_all(self):
+        '''Delete with no query empties the table'''
+        insert_table(self.users)(user_id='other', email='e', first_name='f', last_name='l')
+        self.assertEqual(delete_table(self.users)(), 2)
+        self.assertEqual(len(self.users), 0)
+        self.assertEqual(len(self.statuses), 0)
+
+    def test_unique_index(self):
+        '''A unique index rejects duplicates, including ones already in the table'''
+        self.users.create_index(['email'], unique=True)
+        self.assertFalse(insert_table(self.users)(user_id='other', email='chaygood@uw.edu',
+                                                  first_name='f', last_name='l'))
+        insert_table(self.statuses)(status_id='chaygood0002', user_id='chaygood', status_text='dup')
+        insert_table(self.statuses)(status_id='chaygood0003', user_id='chaygood', status_text='dup')
+        with self.assertRaises(IntegrityError):
+            self.statuses.create_index(['status_text'], unique=True)
+
+
+class TestSqliteBackend(BackendConformance, unittest.TestCase):
+    '''The DataSet backend over a scratch SQLite file'''
+
+    def open_dataset(self):
+        scratch = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, scratch)
+        database = SqliteDatabase(f'{scratch}/backend.db', pragmas={'foreign_keys': 1})
+        initialize_database(database)
+        self.addCleanup(database.close)
+        return DataSet(database)
+
+
+class TestMemoryBackend(BackendConformance, unittest.TestCase):
+    '''The in-memory backend'''
+
+    def open_dataset(self):
+        return MemoryDataSet([UserTable, StatusTable, PictureTable, UserSummaryTable])
+
+    def test_warm(self):
+        '''warm copies every row from a SQLite dataset and rebuilds the indexes'''
+        source = TestSqliteBackend.open_dataset(self)
+        insert_table(source['usertable'])(user_id='warm', email='e', first_name='f', last_name='l')
+        insert_table(source['statustable'])(status_id='warm0001', user_id='warm', status_text='text')
+        counts = self.dataset.warm(source)
+        self.assertEqual(counts['usertable'], 1)
+        self.assertIsNone(search_table(self.users)(user_id='chaygood'))
+        self.assertEqual(len(list(search_table_for_many(self.statuses)(user_id='warm'))), 1)
+
+
+class TestShardedBackend(BackendConformance, unittest.TestCase):
+    '''The sharded backend over three scratch shard files'''
+
+    def open_dataset(self):
+        scratch = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, scratch)
+        store = ShardedStore(3, f'{scratch}/shard_{{index}}.db')
+        for shard in store.shards:
+            self.addCleanup(shard.database.close)
+        return ShardedDataSet(store, [UserTable, StatusTable, PictureTable, UserSummaryTable])
+
+    def test_rows_follow_user(self):
+        '''Rows land on their user's shard, and move there when their user_id changes'''
+        store = self.dataset.store
+        other = next(user_id for user_id in (f'user{i}' for i in range(100))
+                     if store.shard(user_id) is not store.shard('chaygood'))
+        insert_table(self.users)(user_id=other, email='e', first_name='f', last_name='l')
+        self.assertIsNotNone(store.shard(other).search['usertable'](user_id=other))
+        self.assertEqual(update_table(self.statuses)(['status_id'], status_id='chaygood0001', user_id=other), 1)
+        self.assertIsNotNone(store.shard(other).search['statustable'](status_id='chaygood0001'))
+        self.assertIsNone(store.shard('chaygood').search['statustable'](status_id='chaygood0001'))
+        self.assertFalse(insert_table(self.statuses)(status_id='chaygood0001', user_id='chaygood', status_text='x'))
+        self.assertEqual(len(self.statuses), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,13 +3,25 @@ This module tests the main.py, users.py, and user_status.py code
 '''
 # pylint: disable=R0904
 import os
+import csv
+import sys
+import time
+import tempfile
 import unittest
 import shutil
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 import main
+import socialnetwork_model
 from socialnetwork_model import ds, Users, Statuses, Pictures
+import images
+import picture_watcher
 from images import PICTURE_DIR
+from records import UserRow, PictureRow
+
+# Tests of code that queries the peewee models directly or relies on SQLite triggers
+sqlite_only = unittest.skipIf(socialnetwork_model.BACKEND != socialnetwork_model.SQLITE_BACKEND,
+                              'needs the SQLite backend')
 
 
 class TestMain(unittest.TestCase):
@@ -219,6 +231,120 @@ class TestMain(unittest.TestCase):
 
         self.assertIsNone(main.search_user(self.new_user.user_id))
 
+    def test_search_users(self):
+        '''Searching many users returns them in input order along with the IDs not found'''
+        main.add_user(self.new_user.user_id, self.new_user.email, self.new_user.first_name, self.new_user.last_name)
+        found, missing = main.search_users(['nobody', self.new_user.user_id, self.known_user.user_id])
+        self.assertEqual([user['user_id'] for user in found], [self.new_user.user_id, self.known_user.user_id])
+        self.assertEqual(missing, ['nobody'])
+
+    def test_search_statuses_and_pictures(self):
+        '''Searching many statuses or pictures reports the IDs not found'''
+        found, missing = main.search_statuses([self.known_user.known_status_id, self.known_user.new_status_id])
+        self.assertEqual([status['status_text'] for status in found], [self.known_user.known_status_text])
+        self.assertEqual(missing, [self.known_user.new_status_id])
+        found, missing = main.search_pictures([self.known_user.known_picture_id])
+        self.assertEqual((found[0]['tags'], missing), (self.known_user.known_tags, []))
+
+    def test_search_returns_records(self):
+        '''Searches return slotted records that still behave like the old row dicts'''
+        user = main.search_user(self.known_user.user_id)
+        self.assertIsInstance(user, UserRow)
+        self.assertEqual(dict(user), {'user_id': 'chaygood', 'first_name': 'Cameron', 'last_name': 'Haygood',
+                                      'email': 'chaygood@uw.edu'})
+        self.assertEqual(user.get('missing', 'default'), 'default')
+        with self.assertRaises(KeyError):
+            _ = user['missing']
+        pictures = main.images.image_search_by_user(self.known_user.user_id)
+        self.assertIsInstance(pictures[0], PictureRow)
+        self.assertIs(pictures[0].user_id, user.user_id)
+        self.assertEqual(main.search_status(self.known_user.known_status_id).user_id, 'chaygood')
+
+    @sqlite_only
+    def test_find_users(self):
+        '''Finds users case-insensitively by name or email prefix and by email domain'''
+        main.add_user('jdoe', 'jane@Mail.GoodMail.com', 'Jane', 'Doe')
+        main.add_user('jroe', 'john@goodmail.com', 'John', 'Roe')
+        main.add_user('other', 'haystack@notgoodmail.com', 'Hay', 'Stack')
+        self.assertEqual([user.user_id for user in main.find_users(prefix='ha')], ['chaygood', 'other'])
+        self.assertEqual([user.user_id for user in main.find_users(prefix='JA')], ['jdoe'])
+        self.assertEqual([user.user_id for user in main.find_users(prefix='chaygood@')], ['chaygood'])
+        self.assertEqual([user.user_id for user in main.find_users(email_domain='goodmail.com')], ['jdoe', 'jroe'])
+        self.assertEqual([user.user_id for user in main.find_users(email_domain='MAIL.goodmail.com')], ['jdoe'])
+        self.assertEqual([user.user_id for user in main.find_users(prefix='j', email_domain='uw.edu')], [])
+        self.assertEqual(len(main.find_users(prefix='h', limit=1)), 1)
+        self.assertIsInstance(main.find_users(prefix='Haygood')[0], UserRow)
+        main.update_user('jroe', 'john@uw.edu', 'John', 'Roe')
+        self.assertEqual([user.user_id for user in main.find_users(email_domain='uw.edu')], ['chaygood', 'jroe'])
+        with self.assertRaises(ValueError):
+            main.find_users()
+
+    @sqlite_only
+    def test_find_users_unusual_emails(self):
+        '''Emails with control characters or a trailing dot are stored and found; so are top code point prefixes'''
+        self.assertTrue(main.add_user('tab', 'tab@good\tmail.com', 'Tab', 'User'))
+        self.assertTrue(main.add_user('dot', 'x@GoodMail.COM.', 'Dot', 'User'))
+        self.assertTrue(main.update_user('tab', 'tab@uw.edu\n', 'Tab', 'User'))
+        scratch = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, scratch)
+        accounts = os.path.join(scratch, 'accounts.csv')
+        with open(accounts, 'w', newline='', encoding='utf-8') as file:
+            csv.writer(file).writerows([['USER_ID', 'NAME', 'LASTNAME', 'EMAIL'],
+                                        ['newline', 'New', 'Line', 'new@good\nmail.com'],
+                                        ['top', '\U0010ffff', 'Point', 'top@uw.edu']])
+        self.assertTrue(main.load_users(accounts))
+        self.assertEqual([user.user_id for user in main.find_users(email_domain='goodmail.com')], ['dot'])
+        self.assertEqual([user.user_id for user in main.find_users(email_domain='good\nmail.com')], ['newline'])
+        self.assertEqual([user.user_id for user in main.find_users(email_domain='edu\n')], ['tab'])
+        self.assertEqual([user.user_id for user in main.find_users(prefix='\U0010ffff')], ['top'])
+        self.assertEqual(main.find_users(prefix='\U0010ffff\U0010ffff'), [])
+
+    @sqlite_only
+    def test_domain_trigger_upgrade(self):
+        '''Replacing an older domain trigger recomputes the domains it stored'''
+        main.add_user('dot', 'x@GoodMail.COM.', 'Dot', 'User')
+        database = socialnetwork_model.db
+        database.execute_sql("UPDATE userdomaintable SET reversed_domain = '.com.goodmail' WHERE user_id = 'dot'")
+        database.execute_sql('DROP TRIGGER usertable_domain_insert')
+        database.execute_sql('CREATE TRIGGER usertable_domain_insert AFTER INSERT ON usertable BEGIN SELECT 1; END')
+        socialnetwork_model.initialize_database(database)
+        self.assertEqual([user.user_id for user in main.find_users(email_domain='goodmail.com')], ['dot'])
+
+    @sqlite_only
+    def test_user_timeline(self):
+        '''Timelines page through a user's statuses newest first by seq'''
+        for i in range(2, 7):
+            main.add_status(self.known_user.user_id, f'chaygood000{i}', f'status {i}')
+        page = main.user_timeline(self.known_user.user_id, limit=2)
+        self.assertEqual([status.status_id for status in page], ['chaygood0006', 'chaygood0005'])
+        self.assertIsNotNone(page[0].created_at)
+        older = main.user_timeline(self.known_user.user_id, before=page[-1].seq, limit=10)
+        self.assertEqual([status.status_id for status in older],
+                         ['chaygood0004', 'chaygood0003', 'chaygood0002', 'chaygood0001'])
+        self.assertEqual(main.user_timeline(self.known_user.user_id, before=older[-1].seq), [])
+        self.assertEqual(main.user_timeline(self.new_user.user_id), [])
+
+    @sqlite_only
+    def test_user_timeline_uses_index(self):
+        '''The timeline query is answered from the (user_id, seq) index'''
+        # pylint: disable=C0415
+        from user_status import db
+        plan = db.execute_sql('EXPLAIN QUERY PLAN SELECT status_id FROM statustable '
+                              'WHERE user_id = ? AND seq < ? ORDER BY seq DESC LIMIT 20', ('chaygood', 10)).fetchall()
+        self.assertIn('statustable_user_id_seq', ' '.join(str(row[-1]) for row in plan))
+        self.assertNotIn('TEMP B-TREE', ' '.join(str(row[-1]) for row in plan))
+
+    @sqlite_only
+    def test_backfill_status_sequence(self):
+        '''Statuses written before seq existed are numbered in insert order, and new ones follow them'''
+        main.add_status(self.known_user.user_id, 'chaygood0002', 'second')
+        socialnetwork_model.db.execute_sql('UPDATE statustable SET seq = NULL')
+        self.assertEqual(socialnetwork_model.backfill_status_sequence(), 2)
+        main.add_status(self.known_user.user_id, 'chaygood0003', 'third')
+        timeline = main.user_timeline(self.known_user.user_id)
+        self.assertEqual([status.status_id for status in timeline], ['chaygood0003', 'chaygood0002', 'chaygood0001'])
+        self.assertEqual(len({status.seq for status in timeline}), 3)
+
     def test_add_status(self):
         '''
         Creates a new instance of UserStatus and stores it in
@@ -328,6 +454,10 @@ class TestMain(unittest.TestCase):
         result = main.list_user_images(self.known_user.user_id)
         self.assertTrue(result == {('chaygood', 'golf/skiing/snowboarding', '0000000002.png')})
 
+    def test_list_user_images_without_directory(self):
+        '''Tests that a user with no pictures directory has no images listed'''
+        self.assertEqual(main.list_user_images('nobody'), set())
+
     # def test_add_image_conflict(self):
     #     print('breakpoint 1')
     #     self.assertFalse(main.add_image(self.known_user.user_id,
@@ -342,3 +472,179 @@ class TestMain(unittest.TestCase):
     def test_load_images(self):
         '''Tests loading images from csv'''
         self.assertTrue(main.load_images(self.images_csv_filename))
+
+    def test_reconcile_images(self):
+        '''Tests that an image row without a file on the server is reported as missing from the server'''
+        main.add_image(self.known_user.user_id, self.known_user.new_tags)
+        image_diff = main.reconcile_images(self.known_user.user_id)
+        self.assertEqual(image_diff['missing_from_db'], set())
+        self.assertEqual(image_diff['missing_from_server'], {('chaygood', 'F1/golf', '0000000001.png')})
+
+    @sqlite_only
+    def test_sharded_layout(self):
+        '''Tests adding, listing and reconciling images in the sharded layout'''
+        images.set_storage_layout(images.SHARDED_LAYOUT)
+        try:
+            self.assertTrue(main.add_image(self.known_user.user_id, self.known_user.new_tags))
+            self.assertTrue(os.path.isfile(os.path.join(images.shard_dir('0000000002'), '0000000002.png')))
+            result = main.list_user_images(self.known_user.user_id)
+            self.assertEqual(result, {('chaygood', 'golf/skiing/snowboarding', '0000000002.png')})
+            image_diff = main.reconcile_images(self.known_user.user_id)
+            self.assertEqual(image_diff['missing_from_db'], set())
+        finally:
+            images.set_storage_layout(images.TAG_LAYOUT)
+
+    @sqlite_only
+    def test_migrate_images(self):
+        '''Tests migrating images from the tag layout to the sharded layout and back'''
+        main.add_image(self.known_user.user_id, self.known_user.new_tags)
+        self.assertEqual(main.migrate_images(images.SHARDED_LAYOUT), {'moved': 1, 'missing': 1})
+        try:
+            self.assertFalse(os.path.exists(os.path.join(PICTURE_DIR, self.known_user.user_id)))
+            self.assertEqual(main.list_user_images(self.known_user.user_id),
+                             {('chaygood', 'golf/skiing/snowboarding', '0000000002.png')})
+        finally:
+            main.migrate_images(images.TAG_LAYOUT)
+        self.assertEqual(main.list_user_images(self.known_user.user_id),
+                         {('chaygood', 'golf/skiing/snowboarding', '0000000002.png')})
+
+    def test_add_image_from_bytes(self):
+        '''Tests that image bytes are stored as the original file'''
+        self.assertTrue(main.add_image(self.known_user.user_id, self.known_user.new_tags, b'\x89PNG raw bytes'))
+        with open(images.image_path('0000000002', self.known_user.user_id, self.known_user.new_tags), 'rb') as image:
+            self.assertEqual(image.read(), b'\x89PNG raw bytes')
+
+    def test_add_image_missing_source(self):
+        '''Tests that a missing source file is not added to the database'''
+        self.assertFalse(main.add_image(self.known_user.user_id, self.known_user.new_tags, 'missing.png'))
+        self.assertIsNone(main.images.image_search('0000000002'))
+
+    @unittest.skipIf(images.Image is None, 'Pillow is not installed')
+    def test_add_image_thumbnails(self):
+        '''Tests that thumbnails are generated per size and only regenerated when the source changes'''
+        source = os.path.join(PICTURE_DIR, 'source.png')
+        os.makedirs(PICTURE_DIR, exist_ok=True)
+        images.Image.new('RGB', (512, 512)).save(source)
+        try:
+            self.assertTrue(main.add_image(self.known_user.user_id, self.known_user.new_tags, source))
+            for size in images.THUMBNAIL_SIZES:
+                with images.Image.open(images.thumbnail_path('0000000002', size)) as thumbnail:
+                    self.assertEqual(thumbnail.size, (size, size))
+            stored = images.image_path('0000000002', self.known_user.user_id, self.known_user.new_tags)
+            self.assertEqual(list(images.thumbnail_jobs('0000000002', stored, images.file_digest(stored))), [])
+        finally:
+            shutil.rmtree(images.THUMBNAIL_DIR, ignore_errors=True)
+
+    @sqlite_only
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+    def test_picture_watcher(self):
+        '''Tests that reconcile_images answers from watcher state as files are added and removed'''
+        watcher = picture_watcher.start_watcher()
+        try:
+            main.add_image(self.known_user.user_id, self.known_user.new_tags)
+            stray = os.path.join(PICTURE_DIR, self.known_user.user_id, 'golf', '0000000009.png')
+            os.makedirs(os.path.dirname(stray), exist_ok=True)
+            with open(stray, 'w') as image:
+                image.write('copied outside the application')
+            expected = {('chaygood', 'golf', '0000000009.png')}
+            for _ in range(50):
+                if main.reconcile_images(self.known_user.user_id)['missing_from_db'] == expected:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(main.reconcile_images(self.known_user.user_id)['missing_from_db'], expected)
+            os.remove(stray)
+            for _ in range(50):
+                if not main.reconcile_images(self.known_user.user_id)['missing_from_db']:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(main.reconcile_images(self.known_user.user_id)['missing_from_db'], set())
+            self.assertEqual(watcher.rescans, 1)
+        finally:
+            watcher.stop()
+
+    @sqlite_only
+    def test_reconcile_images_verify(self):
+        '''Tests that verify reports changed file contents and skips re-hashing unchanged files'''
+        main.add_image(self.known_user.user_id, self.known_user.new_tags, b'original bytes')
+        self.assertEqual(main.reconcile_images(self.known_user.user_id, verify=True)['content_mismatch'], set())
+        with patch('images.hash_image') as hash_image:
+            main.reconcile_images(self.known_user.user_id, verify=True)
+            hash_image.assert_not_called()
+        filepath = images.image_path('0000000002', self.known_user.user_id, self.known_user.new_tags)
+        with open(filepath, 'wb') as image:
+            image.write(b'corrupted')
+        self.assertEqual(main.reconcile_images(self.known_user.user_id, verify=True)['content_mismatch'],
+                         {('chaygood', 'golf/skiing/snowboarding', '0000000002.png')})
+
+    @sqlite_only
+    def test_repair_images(self):
+        '''Tests dry-run and real repairs of a reconcile result'''
+        stray = os.path.join(PICTURE_DIR, self.known_user.user_id, 'golf', '0000000009.png')
+        os.makedirs(os.path.dirname(stray), exist_ok=True)
+        with open(stray, 'w') as image:
+            image.write('copied outside the application')
+        image_diff = main.reconcile_images(self.known_user.user_id)
+        progress = MagicMock()
+
+        summary = main.repair_images(image_diff, dry_run=True, progress=progress)
+        self.assertEqual(summary, {'inserted': 1, 'restored': 1, 'deleted': 0, 'skipped': 0, 'dry_run': True})
+        self.assertEqual(main.reconcile_images(self.known_user.user_id), image_diff)
+        progress.assert_called_with(2, 2)
+
+        summary = main.repair_images(image_diff)
+        self.assertEqual(summary['inserted'], 1)
+        self.assertEqual(main.images.image_search('0000000009')['tags'], '#golf')
+        self.assertEqual(main.reconcile_images(self.known_user.user_id),
+                         {'missing_from_db': set(), 'missing_from_server': set()})
+
+    @sqlite_only
+    def test_repair_images_delete(self):
+        '''Tests that the delete policy removes rows whose file is missing'''
+        summary = main.repair_images(main.reconcile_all_images(), policy='delete')
+        self.assertEqual(summary['deleted'], 1)
+        self.assertIsNone(main.images.image_search(self.known_user.known_picture_id))
+
+    @sqlite_only
+    def test_user_summary(self):
+        '''Tests that summary counters follow status and picture writes'''
+        main.add_status(self.known_user.user_id, self.known_user.new_status_id, self.known_user.new_status_text)
+        main.add_image(self.known_user.user_id, self.known_user.new_tags)
+        summary = main.user_summary(self.known_user.user_id)
+        self.assertEqual((summary['status_count'], summary['picture_count']), (2, 2))
+        self.assertIsNotNone(summary['last_activity'])
+        main.delete_status(self.known_user.known_status_id)
+        self.assertEqual(main.user_summary(self.known_user.user_id)['status_count'], 1)
+        self.assertIsNone(main.user_summary(self.new_user.user_id))
+
+    @sqlite_only
+    def test_user_summary_ignores_bookkeeping(self):
+        '''Tests that checksums written by a verify pass are not counted as user activity'''
+        main.add_image(self.known_user.user_id, self.known_user.new_tags, b'original bytes')
+        Pictures.update(['picture_id'], picture_id='0000000002', checksum=None)
+        main.socialnetwork_model.Summaries.update(['user_id'], user_id=self.known_user.user_id,
+                                                  last_activity='2000-01-01 00:00:00')
+        before = main.user_summary(self.known_user.user_id)
+        main.reconcile_images(self.known_user.user_id, verify=True)
+        self.assertIsNotNone(main.images.image_search('0000000002')['checksum'])
+        self.assertEqual(main.user_summary(self.known_user.user_id), before)
+
+    @sqlite_only
+    def test_table_versions_ignore_checksums(self):
+        '''Tests that checksum writes leave the picture table version, and cached responses, alone'''
+        main.add_image(self.known_user.user_id, self.known_user.new_tags, b'original bytes')
+        Pictures.update(['picture_id'], picture_id='0000000002', checksum=None)
+        version = socialnetwork_model.table_versions()['picturetable']
+        main.reconcile_images(self.known_user.user_id, verify=True)
+        self.assertEqual(socialnetwork_model.table_versions()['picturetable'], version)
+        Pictures.update(['picture_id'], picture_id='0000000002', tags='#curling')
+        self.assertEqual(socialnetwork_model.table_versions()['picturetable'], version + 1)
+
+    @sqlite_only
+    def test_rebuild_user_summaries(self):
+        '''Tests that drifted counters are reported and repaired'''
+        self.assertEqual(main.rebuild_user_summaries(), [])
+        main.socialnetwork_model.Summaries.update(['user_id'], user_id=self.known_user.user_id, status_count=7)
+        self.assertEqual(main.rebuild_user_summaries(verify_only=True),
+                         [(self.known_user.user_id, 'status_count', 7, 1)])
+        self.assertEqual(main.rebuild_user_summaries(), [(self.known_user.user_id, 'status_count', 7, 1)])
+        self.assertEqual(main.user_summary(self.known_user.user_id)['status_count'], 1)
@@ -4,14 +4,23 @@ Tests menu.py by mocking user inputs
 
 import os
 import io
+import json
+import shutil
+import tempfile
 import unittest
-from contextlib import redirect_stdout
+from contextlib import redirect_stderr, redirect_stdout
 from unittest.mock import patch
 from unittest.mock import MagicMock
 
 import main
 import menu
+import socialnetwork_model
 from socialnetwork_model import ds, Users, Statuses
+from images import PICTURE_DIR
+
+# Reconciling reads the peewee models directly, which only the SQLite backend has
+sqlite_only = unittest.skipIf(socialnetwork_model.BACKEND != socialnetwork_model.SQLITE_BACKEND,
+                              'needs the SQLite backend')
 
 
 class TestMenu(unittest.TestCase):
@@ -246,3 +255,61 @@ class TestMenu(unittest.TestCase):
         with patch('builtins.input', side_effect=[self.known_user_id, '#golf', '#F1', '']):
             menu.add_image()
             # self.assertEqual(main.search_user(self.test_user.id)['user_id'], self.test_user.id)
+
+    def run_cli(self, *argv):
+        '''Runs menu.py with argv, returning (exit status, parsed JSON summary)'''
+        string_capture = io.StringIO()
+        with redirect_stdout(string_capture):
+            status = menu.run_cli(list(argv))
+        return status, json.loads(string_capture.getvalue())
+
+    def test_cli_load(self):
+        '''Tests load runs users before statuses and images and reports throughput and errors as JSON'''
+        self.addCleanup(shutil.rmtree, PICTURE_DIR, ignore_errors=True)
+        status, summary = self.run_cli('load', 'users', self.accounts_csv_filepath,
+                                       '--statuses', self.status_updates_csv_filepath,
+                                       '--images', os.path.join(self.current_dir, 'test_images.csv'))
+        self.assertEqual(status, 0)
+        self.assertEqual([list(phase['tables']) for phase in summary['phases']], [['users'], ['statuses', 'images']])
+        self.assertEqual(summary['phases'][0]['tables']['users']['inserted'], 100)
+        self.assertEqual(summary['phases'][1]['tables']['images']['inserted'], 100)
+        statuses = summary['phases'][1]['tables']['statuses']
+        self.assertEqual(statuses['inserted'] + statuses['skipped'], statuses['rows'])
+        self.assertTrue(main.search_status('Dix.Aronoff82_552'))
+
+        status, summary = self.run_cli('load', 'users', self.accounts_csv_filepath, self.wrong_accounts_filename)
+        self.assertEqual(status, 1)
+        self.assertEqual(summary['phases'][0]['tables']['users']['inserted'], 0)
+        self.assertEqual([error['file'] for error in summary['errors']], [self.wrong_accounts_filename])
+
+    def test_cli_workers(self):
+        '''Tests --workers below 1 is rejected as a usage error before any work starts'''
+        for workers in ('0', '-2', 'many'):
+            with redirect_stderr(io.StringIO()), self.assertRaises(SystemExit) as exit_status:
+                menu.run_cli(['--workers', workers, 'export'])
+            self.assertEqual(exit_status.exception.code, 2)
+
+    def test_cli_export(self):
+        '''Tests export writes csv files that load reads back'''
+        scratch = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, scratch)
+        status, summary = self.run_cli('export', '--dir', scratch, '--tables', 'users', 'statuses')
+        self.assertEqual((status, summary['files']['users']['rows'], summary['files']['statuses']['rows']), (0, 1, 1))
+        self.users.delete()
+        status, summary = self.run_cli('load', 'users', summary['files']['users']['file'],
+                                       '--statuses', summary['files']['statuses']['file'])
+        self.assertEqual(status, 0)
+        self.assertEqual(main.search_status(self.known_status_id)['status_text'], self.known_status_text)
+
+    @sqlite_only
+    def test_cli_reconcile(self):
+        '''Tests reconcile --all reports difference counts and needs --all or user IDs'''
+        self.addCleanup(shutil.rmtree, PICTURE_DIR, ignore_errors=True)
+        main.add_image(self.known_user_id, '#golf')
+        os.remove(os.path.join(PICTURE_DIR, self.known_user_id, 'golf', '0000000001.png'))
+        status, summary = self.run_cli('reconcile', '--all')
+        self.assertEqual((status, summary['differences']), (0, {'missing_from_server': 1}))
+        status, summary = self.run_cli('reconcile', self.known_user_id)
+        self.assertEqual(summary['differences'], {'missing_from_db': 0, 'missing_from_server': 1})
+        with patch('sys.stderr', io.StringIO()), self.assertRaises(SystemExit):
+            menu.run_cli(['reconcile'])
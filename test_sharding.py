@@ -0,0 +1,126 @@
+'''
+Tests the hash-sharded store in sharding.py
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import images
+import sharding
+import socialnetwork_model
+from images import PICTURE_DIR
+
+
+class TestSharding(unittest.TestCase):
+    '''Defines test cases for sharding.py'''
+
+    def setUp(self):
+        '''Opens a three shard store in a scratch directory with a few users, statuses and pictures'''
+        self.scratch = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.scratch)
+        self.store = sharding.ShardedStore(3, os.path.join(self.scratch, 'shard_{index}.db'))
+        for i in range(12):
+            self.store.insert('usertable', user_id=f'user{i}', email=f'user{i}@uw.edu',
+                              first_name='First', last_name='Last')
+            self.store.insert('statustable', status_id=f'status{i}', user_id=f'user{i}', status_text='text')
+            self.store.insert('picturetable', picture_id=str(i).zfill(10), user_id=f'user{i}', tags='#golf')
+        shutil.rmtree(PICTURE_DIR, ignore_errors=True)
+        self.addCleanup(shutil.rmtree, PICTURE_DIR, ignore_errors=True)
+
+    def test_shard_for_is_stable(self):
+        '''Same user_id always maps to the same shard, within range'''
+        self.assertEqual(sharding.shard_for('chaygood', 3), sharding.shard_for('chaygood', 3))
+        self.assertTrue(all(0 <= sharding.shard_for(f'user{i}', 3) < 3 for i in range(100)))
+
+    def test_models_stay_on_db(self):
+        '''Creating shard schemas on several threads never rebinds the models away from db'''
+        self.store.scatter(lambda shard: sharding.open_shard(os.path.join(self.scratch, f'extra_{shard.index}.db')))
+        self.assertIs(socialnetwork_model.UserTable._meta.database, socialnetwork_model.db)
+        self.assertIs(socialnetwork_model.JobTable._meta.database, socialnetwork_model.db)
+
+    def test_rows_are_colocated(self):
+        '''A user's statuses and pictures live on the user's shard'''
+        for i in range(12):
+            shard = self.store.shard(f'user{i}')
+            self.assertIsNotNone(shard.search['usertable'](user_id=f'user{i}'))
+            self.assertIsNotNone(shard.search['statustable'](status_id=f'status{i}'))
+            self.assertIsNotNone(shard.search['picturetable'](picture_id=str(i).zfill(10)))
+        self.assertEqual(len(self.store.user_statuses('user4')), 1)
+
+    def test_point_and_scatter_reads(self):
+        '''Searches go to one shard; lists and counts cover every shard'''
+        self.assertEqual(self.store.search_user('user3')['email'], 'user3@uw.edu')
+        self.assertIsNone(self.store.search_user('nobody'))
+        self.assertEqual(self.store.search_status('status7')['user_id'], 'user7')
+        self.assertIsNone(self.store.search_status('missing'))
+        self.assertEqual(self.store.count('usertable'), 12)
+        self.assertEqual(len(self.store.list_table('statustable')), 12)
+
+    def test_foreign_keys_per_shard(self):
+        '''Statuses for unknown users are rejected, and deleting a user cascades'''
+        self.assertFalse(self.store.insert('statustable', status_id='orphan', user_id='nobody', status_text='x'))
+        self.assertTrue(self.store.delete_user('user5'))
+        self.assertEqual(self.store.count('statustable'), 11)
+        self.assertEqual(self.store.count('picturetable'), 11)
+
+    def test_bulk_load(self):
+        '''Bulk loads split rows across shards and skip rows that already exist'''
+        users = [{'user_id': f'bulk{i}', 'email': 'e', 'first_name': 'f', 'last_name': 'l'} for i in range(30)]
+        self.assertEqual(self.store.bulk_load('usertable', users, processes=False), 30)
+        self.assertEqual(self.store.bulk_load('usertable', users, processes=False), 0)
+        self.assertEqual(self.store.count('usertable'), 42)
+
+    def test_reconcile_all_images(self):
+        '''Differences from every shard are merged into one stream'''
+        images.write_image_file(images.image_path('0000000001', 'user1', '#golf', images.TAG_LAYOUT), b'')
+        images.write_image_file(os.path.join(PICTURE_DIR, 'user1', 'extra.png'), b'')
+        differences = list(self.store.reconcile_all_images())
+        missing_from_server = [record for difference, record in differences if difference == 'missing_from_server']
+        self.assertEqual(len(missing_from_server), 11)
+        self.assertNotIn(('user1', 'golf', '0000000001.png'), missing_from_server)
+        self.assertIn(('missing_from_db', ('user1', '', 'extra.png')), differences)
+
+    def test_rebalance(self):
+        '''Growing and shrinking the shard count moves users with their rows'''
+        moved = self.store.rebalance(5)
+        self.assertEqual(moved['usertable'], moved['statustable'])
+        self.assertEqual(self.store.shard_count, 5)
+        for count in (5, 2):
+            if count != 5:
+                self.store.rebalance(count)
+            self.assertEqual(self.store.count('usertable'), 12)
+            for i in range(12):
+                self.assertEqual(self.store.shard(f'user{i}').index, sharding.shard_for(f'user{i}', count))
+                self.assertEqual(len(self.store.user_pictures(f'user{i}')), 1)
+        summaries = sum(shard.database.execute_sql('SELECT SUM(status_count) FROM usersummarytable').fetchone()[0]
+                        or 0 for shard in self.store.shards)
+        self.assertEqual(summaries, 12)
+
+    def test_sharded_backend(self):
+        '''SOCIAL_NETWORK_BACKEND=sharded runs main's user and status functions on the shard files'''
+        script = ("import main\n"
+                  "assert main.add_user('chaygood', 'chaygood@uw.edu', 'Cameron', 'Haygood')\n"
+                  "assert main.add_status('chaygood', 'chaygood0001', 'Sharded status')\n"
+                  "assert not main.add_status('nobody', 'orphan0001', 'No such user')\n"
+                  "assert main.update_user('chaygood', 'new@uw.edu', 'Cameron', 'Haygood')\n"
+                  "print(main.search_user('chaygood').email)\n")
+        env = {**os.environ, 'SOCIAL_NETWORK_BACKEND': 'sharded', 'SOCIAL_NETWORK_SHARDS': '3',
+               'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))}
+        result = subprocess.run([sys.executable, '-c', script], cwd=self.scratch, env=env,
+                                capture_output=True, text=True, check=False)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), 'new@uw.edu')
+        self.assertFalse(os.path.exists(os.path.join(self.scratch, 'social_network.db')))
+        store = sharding.ShardedStore(3, os.path.join(self.scratch, 'social_network_{index}.db'))
+        shard = store.shard('chaygood')
+        self.assertEqual(shard.search['statustable'](status_id='chaygood0001')['status_text'], 'Sharded status')
+        self.assertEqual(shard.database.execute_sql(
+            "SELECT status_count FROM usersummarytable WHERE user_id = 'chaygood'").fetchone()[0], 1)
+        self.assertEqual(store.count('usertable'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
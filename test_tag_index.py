@@ -0,0 +1,140 @@
+'''
+Tests the bitmap tag index in tag_index.py
+'''
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import main
+import images
+import changelog
+import tag_index
+from socialnetwork_model import Users, Pictures, ChangeLogStateTable
+from images import PICTURE_DIR
+
+
+class TestTagIndex(unittest.TestCase):
+    '''Defines test cases for tag_index.py'''
+
+    def setUp(self):
+        '''Adds a user with four tagged pictures and builds an index over them'''
+        Users.insert(user_id='chaygood', email='chaygood@uw.edu', first_name='Cameron', last_name='Haygood')
+        for picture_id, tags in (('0000000001', '#skiing #snowboarding'), ('0000000002', '#skiing #F1'),
+                                 ('0000000003', '#golf'), ('0000000004', '#skiing #snowboarding #golf')):
+            Pictures.insert(picture_id=picture_id, user_id='chaygood', tags=tags)
+        self.index = tag_index.TagIndex()
+        self.index.refresh()
+        shutil.rmtree(PICTURE_DIR, ignore_errors=True)
+
+    def tearDown(self):
+        '''Empties the tables, pictures directory and add_image hook'''
+        images.set_image_added_hook(None)
+        ChangeLogStateTable.delete().execute()  # pylint: disable=E1120
+        Pictures.delete()
+        Users.delete()
+        shutil.rmtree(PICTURE_DIR, ignore_errors=True)
+
+    def matches(self, query):
+        '''picture_ids matching query, oldest first'''
+        return sorted(self.index.search(query)['picture_ids'])
+
+    def test_operators(self):
+        '''AND, OR, NOT, parentheses and implicit AND evaluate with NOT > AND > OR precedence'''
+        self.assertEqual(self.matches('#skiing AND #snowboarding AND NOT #F1'), ['0000000001', '0000000004'])
+        self.assertEqual(self.matches('#skiing #golf'), ['0000000004'])
+        self.assertEqual(self.matches('#F1 OR #golf AND NOT #skiing'), ['0000000002', '0000000003'])
+        self.assertEqual(self.matches('(#F1 OR #golf) and not #skiing'), ['0000000003'])
+        self.assertEqual(self.matches('NOT #skiing'), ['0000000003'])
+        self.assertEqual(self.matches('#unknown OR #F1'), ['0000000002'])
+
+    def test_results_are_newest_first_and_counted(self):
+        '''search reports the full count but only limit picture_ids, newest first'''
+        self.assertEqual(self.index.search('#skiing', limit=2), {'count': 3, 'picture_ids': ['0000000004',
+                                                                                            '0000000002']})
+
+    def test_malformed_queries(self):
+        '''Malformed queries raise TagQueryError'''
+        for query in ('', '#golf AND', '(#golf', '#golf)', 'OR #golf', 'NOT'):
+            with self.assertRaises(tag_index.TagQueryError, msg=query):
+                self.index.evaluate(query)
+        with self.assertRaises(tag_index.TagQueryError):
+            self.index.evaluate('(' * 5000 + '#golf' + ')' * 5000)
+
+    def test_repeated_not(self):
+        '''Long runs of NOT fold by parity instead of recursing'''
+        self.assertEqual(self.matches('NOT ' * 5000 + '#skiing'), ['0000000001', '0000000002', '0000000004'])
+        self.assertEqual(self.matches('NOT ' * 5001 + '#skiing'), ['0000000003'])
+
+    def test_follows_changes(self):
+        '''Retags and deletes are picked up from the changelog before the next query'''
+        Pictures.update(['picture_id'], picture_id='0000000002', tags='#golf')
+        Pictures.delete(picture_id='0000000003')
+        self.assertEqual(self.matches('#golf'), ['0000000002', '0000000004'])
+        self.assertEqual(self.matches('NOT #skiing'), ['0000000002'])
+        self.assertEqual(self.index.refresh(), 0)
+
+    def test_add_image_hook(self):
+        '''Images stored while the index is registered are indexed without a changelog read'''
+        images.set_image_added_hook(self.index.add)
+        main.add_image('chaygood', '#curling')
+        self.assertEqual(self.index.evaluate('#curling').bit_count(), 1)
+        self.assertEqual(self.index.search('#curling')['count'], 1)
+
+    def test_snapshot(self):
+        '''A loaded snapshot answers queries and catches up on changes made after it was saved'''
+        scratch = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, scratch)
+        snapshot = os.path.join(scratch, 'tags.snapshot')
+        self.index.save(snapshot)
+        Pictures.insert(picture_id='0000000005', user_id='chaygood', tags='#golf')
+        restored = tag_index.TagIndex()
+        self.assertTrue(restored.load(snapshot))
+        self.assertEqual(restored.refresh(), 1)
+        self.assertEqual(restored.search('#golf')['count'], 3)
+        self.assertFalse(tag_index.TagIndex().load(os.path.join(scratch, 'missing')))
+
+    def test_snapshot_of_recreated_database(self):
+        '''A snapshot saved before the database was deleted and recreated is not loaded'''
+        scratch = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, scratch)
+        snapshot = os.path.join(scratch, 'tags.snapshot')
+        self.index.save(snapshot)
+        # A recreated database starts without the old one's ID
+        ChangeLogStateTable.delete().execute()  # pylint: disable=E1120
+        self.assertFalse(tag_index.TagIndex().load(snapshot))
+
+    def test_damaged_snapshot(self):
+        '''Snapshots that don't unpickle or don't have the saved shape are ignored and the index rebuilt'''
+        scratch = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, scratch)
+        snapshot = os.path.join(scratch, 'tags.snapshot')
+        state = {'format': tag_index.SNAPSHOT_FORMAT, 'database_id': changelog.database_id(), 'position': 0,
+                 'version': None, 'tags': ['#golf'], 'bitmaps': [], 'picture_ids': [], 'row_tags': [], 'live': 0}
+        for contents in (b'not a pickle', pickle.dumps(['a', 'list']), pickle.dumps({'format': 2}),
+                         pickle.dumps(state), pickle.dumps({**state, 'bitmaps': [1], 'row_tags': [(5,)]})):
+            with open(snapshot, 'wb') as file:
+                file.write(contents)
+            restored = tag_index.TagIndex()
+            self.assertFalse(restored.load(snapshot), contents)
+            self.assertIsNone(restored.refresh())
+            self.assertEqual(restored.search('#golf')['count'], 2)
+
+    def test_rebuilds_after_retention(self):
+        '''An index whose changelog position was removed by retention rebuilds from the table'''
+        Pictures.delete(picture_id='0000000001')
+        changelog.compact_changelog(compact_after=10 ** 9, retention=10 ** 9, max_rows=0)
+        self.assertIsNone(self.index.refresh())
+        self.assertEqual(self.matches('#snowboarding'), ['0000000004'])
+
+    def test_main_search_tags(self):
+        '''main.search_tags answers from the process-wide index'''
+        with patch.object(tag_index, '_INDEX', self.index):
+            self.assertEqual(main.search_tags('#golf AND NOT #snowboarding'),
+                             {'count': 1, 'picture_ids': ['0000000003']})
+
+
+if __name__ == '__main__':
+    unittest.main()
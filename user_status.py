@@ -7,22 +7,46 @@ from loguru import logger
 # from peewee import IntegrityError
 
 
-from socialnetwork_model import insert_table, Statuses, search_table, update_table, delete_table
+from socialnetwork_model import (db, insert_table, Statuses, lookup_table, lookup_many_table, update_table,
+                                 delete_table, iter_table)
+from records import StatusRow, TimelineRow
+
+TIMELINE_PAGE_SIZE = 20
 
 status_insert = insert_table(Statuses)
 
 def search_status():
     '''Curries the search function to the Statuses table, then searches for status_id in that table'''
-    _status_search = search_table(Statuses)
+    _status_search = lookup_table(Statuses, 'status_id', StatusRow)
 
     # All we want for this inner function is status_id and we can now search for it
     def search(status_id):
         nonlocal _status_search
-        return _status_search(status_id=status_id)
+        return _status_search(status_id)
 
     return search
 status_search = search_status()
 
+# Search many Statuses by status_id, returning (statuses found in input order, missing status_ids)
+statuses_search = lookup_many_table(Statuses, 'status_id', StatusRow)
+
+def search_timeline():
+    '''Curries the timeline query, then returns a page of one user's statuses, newest first'''
+    # Walks the (user_id, seq) index down from the cursor, so a page costs the same however many statuses
+    # the user has. Only the SQLite backend assigns seq.
+    _sql = ('SELECT status_id, user_id, status_text, seq, created_at FROM statustable '
+            'WHERE user_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?')
+    _newest = 2 ** 63 - 1
+
+    def timeline(user_id, before=None, limit=TIMELINE_PAGE_SIZE):
+        nonlocal _sql
+        columns = TimelineRow.__slots__
+        rows = db.execute_sql(_sql, (user_id, _newest if before is None else before, limit))
+        return [TimelineRow(**dict(zip(columns, row))) for row in rows]
+
+    return timeline
+status_timeline = search_timeline()
+
 def update_status():
     '''Curries the update function to the Statuses table, then updates the status in that table'''
     _status_update = update_table(Statuses)
@@ -71,3 +95,15 @@ def load_statuses(filename):
     except FileNotFoundError:
         logger.error(f"Error: File {filename} not found.")
         return False
+
+def export_statuses(filename):
+    '''Writes every status to a csv in the layout load_statuses reads. Returns how many were written'''
+    written = 0
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['STATUS_ID', 'USER_ID', 'STATUS_TEXT'])
+        for status in iter_table(Statuses):
+            writer.writerow([status['status_id'], status['user_id'], status['status_text']])
+            written += 1
+    logger.info(f"Exported {written} statuses to {filename}")
+    return written
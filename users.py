@@ -2,11 +2,19 @@
 Classes for user information for the social network project
 '''
 # pylint: disable=R0903
+import sys
 import csv
 from loguru import logger
 
 
-from socialnetwork_model import insert_table, Users, search_table, update_table, delete_table
+from socialnetwork_model import (db, insert_table, Users, Summaries, search_table, lookup_table, lookup_many_table,
+                                 update_table, delete_table, iter_table)
+from records import UserRow
+
+FIND_LIMIT = 100
+PREFIX_COLUMNS = ('first_name', 'last_name', 'email')
+# NOCASE folds only ASCII letters, so prefixes are folded the same way before building ranges
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
 
 # Add User
 user_insert = insert_table(Users)
@@ -14,16 +22,79 @@ user_insert = insert_table(Users)
 # Search User
 def search_user():
     '''Curries the search function to the Users table, then searches for user_id in that table'''
-    _user_search = search_table(Users)
+    _user_search = lookup_table(Users, 'user_id', UserRow)
 
     # All we want for this inner function is user_id and we can now search for it
     def search(user_id):
         nonlocal _user_search
-        return _user_search(user_id=user_id)
+        return _user_search(user_id)
 
     return search
 user_search = search_user()
 
+# Search many Users by user_id, returning (users found in input order, missing user_ids)
+users_search = lookup_many_table(Users, 'user_id', UserRow)
+
+def prefix_range(prefix):
+    '''
+    (low, high) bounds matching every string starting with prefix under NOCASE. high is None when
+    nothing sorts above the prefix, which only happens when it is all U+10FFFF.
+    '''
+    low = prefix.translate(_ASCII_LOWER)
+    stem = low.rstrip(chr(sys.maxunicode))
+    if not stem:
+        return low, None
+    following = ord(stem[-1]) + 1
+    # Surrogates can't be encoded for SQLite, and no string holds one, so the bound skips past them
+    if 0xD800 <= following <= 0xDFFF:
+        following = 0xE000
+    return low, stem[:-1] + chr(following)
+
+def reversed_domain(domain):
+    '''goodmail.com -> com.goodmail, the form stored in userdomaintable. SQLite's lower() only folds ASCII'''
+    return '.'.join(reversed(domain.translate(_ASCII_LOWER).strip('.').split('.')))
+
+# Find Users
+def find_users_by():
+    '''
+    Curries user search by name or email prefix and email domain, then returns matching users.
+    Only the SQLite backend keeps the indexes and reversed_domain column this relies on.
+    '''
+    _select = 'SELECT u.user_id, u.first_name, u.last_name, u.email FROM usertable u'
+    _join = ' JOIN userdomaintable d ON d.user_id = u.user_id'
+    # A domain matches itself and its subdomains: com.goodmail, or anything from com.goodmail. to com.goodmail/
+    _domain = '(d.reversed_domain = ? OR (d.reversed_domain >= ? AND d.reversed_domain < ?))'
+
+    def find(prefix=None, email_domain=None, limit=FIND_LIMIT):
+        nonlocal _select, _join, _domain
+        domain_params = ()
+        if email_domain:
+            domain = reversed_domain(email_domain)
+            domain_params = (domain, domain + '.', domain + '/')
+        if prefix:
+            # One range scan per column's NOCASE index, each stopping at limit rows
+            low, high = prefix_range(prefix)
+            bounds = (low,) if high is None else (low, high)
+            upper = '' if high is None else ' AND u.{column} COLLATE NOCASE < ?'
+            join, domain_filter = (_join, f' AND {_domain}') if domain_params else ('', '')
+            queries = [(f'{_select}{join} WHERE u.{column} COLLATE NOCASE >= ?{upper.format(column=column)}'
+                        f'{domain_filter} ORDER BY u.{column} COLLATE NOCASE LIMIT ?',
+                        (*bounds, *domain_params, limit)) for column in PREFIX_COLUMNS]
+        elif domain_params:
+            queries = [(f'{_select}{_join} WHERE {_domain} LIMIT ?', (*domain_params, limit))]
+        else:
+            raise ValueError('find_users needs a prefix or an email_domain')
+        found = {}
+        for sql, params in queries:
+            for row in db.execute_sql(sql, params):
+                found.setdefault(row[0], row)
+        users = [UserRow(**dict(zip(UserRow.__slots__, row))) for row in found.values()]
+        users.sort(key=lambda user: (user.last_name.lower(), user.first_name.lower(), user.user_id))
+        return users[:limit]
+
+    return find
+find_users = find_users_by()
+
 # Delete User
 def delete_user():
     '''Curries the delete function to the Users table, then deletes user_id in that table'''
@@ -49,6 +120,19 @@ def update_user():
 user_update = update_user()
 
 
+# Search User Summary
+def search_summary():
+    '''Curries the search function to the Summaries table, then searches for user_id in that table'''
+    _summary_search = search_table(Summaries)
+
+    def search(user_id):
+        nonlocal _summary_search
+        return _summary_search(user_id=user_id)
+
+    return search
+summary_search = search_summary()
+
+
 def load_users(filename):
     '''Reads in the called csv, renames the headers to match the database structure, then adds each user to the table'''
     new_headers = ['user_id', 'first_name', 'last_name', 'email']
@@ -64,3 +148,15 @@ def load_users(filename):
     except FileNotFoundError:
         logger.error(f"Error: File {filename} not found.")
         return False
+
+def export_users(filename):
+    '''Writes every user to a csv in the layout load_users reads. Returns how many were written'''
+    written = 0
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['USER_ID', 'NAME', 'LASTNAME', 'EMAIL'])
+        for user in iter_table(Users):
+            writer.writerow([user['user_id'], user['first_name'], user['last_name'], user['email']])
+            written += 1
+    logger.info(f"Exported {written} users to {filename}")
+    return written